@@ -1,6 +1,8 @@
 const std = @import("std");
 const windows = std.os.windows;
 const builtin = @import("builtin");
+const copy = @import("../utils/copy.zig");
+const Context = @import("../utils/context.zig").Context;
 
 // Update Package struct to match your JSON structure
 const Package = struct {
@@ -150,21 +152,9 @@ fn create_popaman_directory(arg_root_dir: []const u8) !void {
 }
 
 // checks to see if popaman is alreadyinstalled
-pub fn verify_install() !bool {
-    // Use arena allocator instead of page_allocator directly
-    var arena = std.heap.ArenaAllocator.init(std.heap.page_allocator);
-    defer arena.deinit();
-    const allocator = arena.allocator();
-
-    var buffer: [std.fs.max_path_bytes]u8 = undefined;
-    const exe_path = try std.fs.selfExePath(&buffer);
-    const exe_dir = std.fs.path.dirname(exe_path) orelse return error.InvalidPath;
-    const parent_dir = std.fs.path.dirname(exe_dir) orelse return error.InvalidPath;
-
-    const packages_path = try std.fs.path.join(allocator, &[_][]const u8{ parent_dir, "lib", "packages.json" });
-
-    // Check if both the file exists and is accessible
-    const file = std.fs.cwd().openFile(packages_path, .{}) catch |err| {
+pub fn verify_install(ctx: *Context) !bool {
+    // opening packages.json here is not wasted, the commands read the registry from it
+    _ = ctx.registryFile() catch |err| {
         switch (err) {
             error.FileNotFound => return false,
             error.AccessDenied => {
@@ -174,8 +164,6 @@ pub fn verify_install() !bool {
             else => return err,
         }
     };
-    defer file.close();
-
     return true;
 }
 
@@ -272,40 +260,7 @@ pub fn createInstallBat(install_bat_path: []const u8, uninstall_bat_path: []cons
 }
 
 fn copyPackageFiles(allocator: std.mem.Allocator, source_path: []const u8, dest_dir: []const u8) !void {
-    // Create the destination directory if it doesn't exist
-    try std.fs.cwd().makePath(dest_dir);
-
-    var source_dir = try std.fs.cwd().openDir(source_path, .{ .iterate = true });
-    defer source_dir.close();
-
-    var walker = try source_dir.walk(allocator);
-    errdefer walker.deinit();
-    defer walker.deinit();
-
-    while (try walker.next()) |entry| {
-        const source_file_path = try std.fs.path.join(allocator, &[_][]const u8{ source_path, entry.path });
-        defer allocator.free(source_file_path);
-
-        const dest_file_path = try std.fs.path.join(allocator, &[_][]const u8{ dest_dir, entry.path });
-        defer allocator.free(dest_file_path);
-
-        switch (entry.kind) {
-            .file => {
-                // Create parent directory if needed
-                const dest_parent = std.fs.path.dirname(dest_file_path);
-                if (dest_parent) |parent| {
-                    try std.fs.cwd().makePath(parent);
-                }
-
-                // Copy the file
-                try std.fs.copyFileAbsolute(source_file_path, dest_file_path, .{});
-            },
-            .directory => {
-                try std.fs.cwd().makePath(dest_file_path);
-            },
-            else => {},
-        }
-    }
+    try copy.copyTree(allocator, source_path, dest_dir, .{});
 }
 
 const SevenZipConfig = struct {
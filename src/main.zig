@@ -1,13 +1,18 @@
 const std = @import("std");
 const install = @import("install/install.zig");
 const run = @import("run/run.zig");
+const Context = @import("utils/context.zig").Context;
 
 pub fn main() !void {
-    const installed = try install.verify_install();
+    // shared by the install check and the command, so the root is resolved once
+    var ctx = Context{};
+    defer ctx.deinit();
+
+    const installed = try install.verify_install(&ctx);
     
     if (installed) {
-        try run.run_popaman();
+        try run.run_popaman(&ctx);
     } else {
         try install.install_popaman();
     }
-}
\ No newline at end of file
+}
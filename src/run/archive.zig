@@ -0,0 +1,282 @@
+const std = @import("std");
+const copy = @import("../utils/copy.zig");
+
+// extraction of package archives without 7zr
+//
+// zip archives and tarballs, plain or compressed with gzip, xz or zstd, are extracted by
+// popaman itself. every file is decompressed straight from the archive into its place
+// under the destination, a buffer at a time, so memory use stays the same whatever the
+// size of the archive and no intermediate .tar is ever written. 7z archives still go
+// through 7zr
+//
+// POPAMAN_EXTRACT picks who extracts zip archives:
+//   auto  popaman itself (default)
+//   7zr   7zr, as before popaman could. tarballs are always extracted natively, 7zr
+//         cannot unpack a compressed tarball in one step
+
+pub const Mode = enum { auto, @"7zr" };
+
+pub const Format = enum {
+    zip,
+    tar,
+    tar_gz,
+    tar_xz,
+    tar_zst,
+    seven_zip,
+
+    // whether popaman extracts the format itself in the given mode
+    pub fn isNative(format: Format, mode: Mode) bool {
+        return switch (format) {
+            .seven_zip => false,
+            .zip => mode == .auto,
+            .tar, .tar_gz, .tar_xz, .tar_zst => true,
+        };
+    }
+};
+
+// longest suffixes first, .tar.gz must not be taken for .gz
+const suffixes = [_]struct { []const u8, Format }{
+    .{ ".tar.gz", .tar_gz },
+    .{ ".tar.xz", .tar_xz },
+    .{ ".tar.zst", .tar_zst },
+    .{ ".tgz", .tar_gz },
+    .{ ".txz", .tar_xz },
+    .{ ".tzst", .tar_zst },
+    .{ ".tar", .tar },
+    .{ ".zip", .zip },
+    .{ ".7z", .seven_zip },
+};
+
+// size of the reads from the archive and the writes of extracted tar members
+const buffer_size = 64 * 1024;
+
+// zip "version made by" host of archives made on unix, which carry a unix mode
+const zip_host_unix = 3;
+
+pub fn modeFromEnv() Mode {
+    var buf: [64]u8 = undefined;
+    var fba = std.heap.FixedBufferAllocator.init(&buf);
+    const value = std.process.getEnvVarOwned(fba.allocator(), "POPAMAN_EXTRACT") catch return .auto;
+    return std.meta.stringToEnum(Mode, value) orelse .auto;
+}
+
+// the archive format of path going by its extension, null when it is no archive
+pub fn formatOf(path: []const u8) ?Format {
+    for (suffixes) |suffix| {
+        if (std.ascii.endsWithIgnoreCase(path, suffix[0])) return suffix[1];
+    }
+    return null;
+}
+
+// extracts a zip or tar archive into dest and returns how many files it held
+// exec bits and symlinks are restored, other permissions and owners are not. symlinks
+// are created after every other member and only when they point inside dest, see Links
+pub fn extract(allocator: std.mem.Allocator, archive_path: []const u8, dest: std.fs.Dir, format: Format) !usize {
+    const file = try std.fs.cwd().openFile(archive_path, .{});
+    defer file.close();
+
+    var links = Links.init(allocator);
+    defer links.deinit();
+
+    if (format == .zip) {
+        const count = try extractZip(file, dest, &links);
+        try links.create(dest);
+        return count;
+    }
+
+    var buffered = std.io.bufferedReaderSize(buffer_size, file.reader());
+    const reader = buffered.reader();
+    const count = switch (format) {
+        .tar => try extractTar(dest, reader, &links),
+        .tar_gz => blk: {
+            var gzip = std.compress.gzip.decompressor(reader);
+            break :blk try extractTar(dest, gzip.reader(), &links);
+        },
+        .tar_xz => blk: {
+            var xz = try std.compress.xz.decompress(allocator, reader);
+            defer xz.deinit();
+            break :blk try extractTar(dest, xz.reader(), &links);
+        },
+        .tar_zst => blk: {
+            const window = try allocator.alloc(u8, std.compress.zstd.DecompressorOptions.default_window_buffer_len);
+            defer allocator.free(window);
+            var zstd = std.compress.zstd.decompressor(reader, .{ .window_buffer = window });
+            break :blk try extractTar(dest, zstd.reader(), &links);
+        },
+        .zip, .seven_zip => unreachable,
+    };
+    try links.create(dest);
+    return count;
+}
+
+fn extractZip(file: std.fs.File, dest: std.fs.Dir, links: *Links) !usize {
+    const stream = file.seekableStream();
+    var iter = try std.zip.Iterator(@TypeOf(stream)).init(stream);
+
+    var filename_buf: [std.fs.max_path_bytes]u8 = undefined;
+    var count: usize = 0;
+    while (try iter.next()) |entry| {
+        // archives made on windows may use backslashes, they become slashes in filename_buf
+        const crc32 = try entry.extract(stream, .{ .allow_backslashes = true }, &filename_buf, dest);
+        if (crc32 != entry.crc32) return error.ZipCrcMismatch;
+        const name = filename_buf[0..entry.filename_len];
+        if (name[name.len - 1] == '/') continue;
+        count += 1;
+        if (std.fs.has_executable_bit) try restoreZipMode(stream, entry, dest, name, links);
+    }
+    return count;
+}
+
+// std.zip creates every file with the default mode. archives made on unix keep the
+// mode of each file in the upper half of its external attributes, from which the exec
+// bit, which the executable prompt goes by, and symlinks, stored as their target, are
+// restored. the file holding a symlink's target stays until links replaces it, so a
+// later member under the link's name fails instead of being written through it
+fn restoreZipMode(stream: anytype, entry: anytype, dest: std.fs.Dir, name: []const u8, links: *Links) !void {
+    try stream.seekTo(entry.header_zip_offset);
+    const header = try stream.context.reader().readStructEndian(std.zip.CentralDirectoryFileHeader, .little);
+    if (header.version_made_by >> 8 != zip_host_unix) return;
+    const mode = header.external_file_attributes >> 16;
+
+    if (std.posix.S.ISLNK(mode)) {
+        var target_buf: [std.fs.max_path_bytes]u8 = undefined;
+        const target = try dest.readFile(name, &target_buf);
+        try links.add(name, target, true);
+    } else if (mode & std.posix.S.IXUSR != 0) {
+        const file = try dest.openFile(name, .{});
+        defer file.close();
+        try file.chmod(0o755);
+    }
+}
+
+fn extractTar(dest: std.fs.Dir, reader: anytype, links: *Links) !usize {
+    var file_name_buf: [std.fs.max_path_bytes]u8 = undefined;
+    var link_name_buf: [std.fs.max_path_bytes]u8 = undefined;
+    var iter = std.tar.iterator(reader, .{
+        .file_name_buffer = &file_name_buf,
+        .link_name_buffer = &link_name_buf,
+    });
+
+    var count: usize = 0;
+    while (try iter.next()) |entry| {
+        // the root directory itself, as in tarballs made with tar -C dir .
+        if (entry.name.len == 0) continue;
+        if (!isSafePath(entry.name)) return error.TarBadFilename;
+        switch (entry.kind) {
+            .directory => try dest.makePath(entry.name),
+            .file => {
+                const out_file = try createFile(dest, entry.name, fileMode(entry.mode));
+                defer out_file.close();
+                var buffered = std.io.BufferedWriter(buffer_size, std.fs.File.Writer){ .unbuffered_writer = out_file.writer() };
+                try entry.writeAll(buffered.writer());
+                try buffered.flush();
+                count += 1;
+            },
+            .sym_link => {
+                try links.add(entry.name, entry.link_name, false);
+                count += 1;
+            },
+        }
+    }
+    return count;
+}
+
+// an executable keeps the permission bits it was archived with, as tar does, so the
+// executable prompt finds it. the umask still applies, as to every other file
+fn fileMode(tar_mode: u32) std.fs.File.Mode {
+    if (!std.fs.has_executable_bit or tar_mode & 0o100 == 0) return std.fs.File.default_mode;
+    return @intCast(tar_mode & 0o777);
+}
+
+fn createFile(dest: std.fs.Dir, name: []const u8, mode: std.fs.File.Mode) !std.fs.File {
+    return dest.createFile(name, .{ .exclusive = true, .mode = mode }) catch |err| switch (err) {
+        // tarballs do not have to list the directories of their files
+        error.FileNotFound => {
+            const dir_name = std.fs.path.dirname(name) orelse return err;
+            try dest.makePath(dir_name);
+            return dest.createFile(name, .{ .exclusive = true, .mode = mode });
+        },
+        else => return err,
+    };
+}
+
+// std.tar hands names over as they are in the archive, one that is absolute or climbs
+// out with .. would be written outside the destination
+fn isSafePath(name: []const u8) bool {
+    if (std.fs.path.isAbsolute(name)) return false;
+    var components = std.mem.tokenizeAny(u8, name, "/\\");
+    while (components.next()) |component| {
+        if (std.mem.eql(u8, component, "..")) return false;
+    }
+    return true;
+}
+
+// the symlinks of an archive, created by create once every other member was written
+//
+// a link created as soon as it is read would let a later member named through it, such
+// as esc/pwned after esc -> /, be written anywhere. created last, no member goes through
+// a link, and each link is checked to stay inside the destination: its target must pass
+// copy.isContainedLink, and none of the directories of its name may be another link of
+// the archive
+const Links = struct {
+    arena: std.heap.ArenaAllocator,
+    list: std.ArrayListUnmanaged(Link) = .empty,
+
+    const Link = struct {
+        name: []const u8,
+        target: []const u8,
+        // whether name holds a placeholder file to replace, as zip extraction leaves
+        replace: bool,
+    };
+
+    fn init(allocator: std.mem.Allocator) Links {
+        return .{ .arena = std.heap.ArenaAllocator.init(allocator) };
+    }
+
+    fn deinit(self: *Links) void {
+        self.arena.deinit();
+    }
+
+    fn add(self: *Links, name: []const u8, target: []const u8, replace: bool) !void {
+        if (!copy.isContainedLink(name, target)) return error.UnsafeSymlink;
+        const allocator = self.arena.allocator();
+        try self.list.append(allocator, .{
+            .name = try normalize(allocator, name),
+            .target = try allocator.dupe(u8, target),
+            .replace = replace,
+        });
+    }
+
+    fn create(self: *Links, dest: std.fs.Dir) !void {
+        var names = std.StringHashMap(void).init(self.arena.allocator());
+        for (self.list.items) |link| try names.put(link.name, {});
+
+        for (self.list.items) |link| {
+            var dir_name = std.fs.path.dirnamePosix(link.name);
+            while (dir_name) |parent| : (dir_name = std.fs.path.dirnamePosix(parent)) {
+                if (names.contains(parent)) return error.UnsafeSymlink;
+            }
+        }
+
+        for (self.list.items) |link| {
+            if (link.replace) {
+                try dest.deleteFile(link.name);
+            } else if (std.fs.path.dirnamePosix(link.name)) |parent| {
+                try dest.makePath(parent);
+            }
+            try dest.symLink(link.target, link.name, .{});
+        }
+    }
+
+    // name with its components joined by /, without . components
+    fn normalize(allocator: std.mem.Allocator, name: []const u8) ![]const u8 {
+        var normalized = std.ArrayList(u8).init(allocator);
+        var components = std.mem.tokenizeAny(u8, name, "/\\");
+        while (components.next()) |component| {
+            if (std.mem.eql(u8, component, ".")) continue;
+            if (normalized.items.len > 0) try normalized.append('/');
+            try normalized.appendSlice(component);
+        }
+        return normalized.toOwnedSlice();
+    }
+};
@@ -0,0 +1,286 @@
+const std = @import("std");
+
+// downloads, and where archives were installed from their extraction, are kept under
+// <root>/cache so installing the same artifact again skips the network fetch and, while
+// its earlier install is untouched, the extraction
+//
+//   cache/url/<sha256 of url>                 content hash of what the url served
+//   cache/<content hash>/file/                the downloaded file
+//   cache/<content hash>/installed/<name>.json
+//                                             manifest of lib/<name> as the extraction
+//                                             of the archive was placed there
+//   cache/<content hash>/entry.json           size and last use, read by evict
+//
+// an extracted archive is not kept here: the extraction is moved into lib/ with a rename,
+// so its data is written once, and the entry refers to the installed package instead.
+// the next install of the same archive copies from lib/<name> while that is still
+// exactly as it was placed, and extracts the archive again once it was changed,
+// upgraded or removed
+//
+// urls are treated as immutable release artifacts, a url whose content changes keeps
+// serving the cached copy until it is evicted or cache/ is deleted
+//
+// POPAMAN_CACHE_SIZE sets the size cap in bytes, 0 turns the cache off
+
+const Sha256 = std.crypto.hash.sha2.Sha256;
+
+pub const Hash = [Sha256.digest_length * 2]u8;
+
+pub const default_max_size: u64 = 1024 * 1024 * 1024;
+
+const url_dir = "url";
+const file_dir = "file";
+const installed_dir = "installed";
+const entry_name = "entry.json";
+
+const EntryInfo = struct {
+    size: u64,
+    last_used: i64,
+};
+
+pub const Cache = struct {
+    path: []const u8,
+    max_size: u64,
+
+    // returns null when the cache is turned off
+    pub fn open(allocator: std.mem.Allocator, exe_dir: []const u8) !?Cache {
+        var max_size = default_max_size;
+        if (std.process.getEnvVarOwned(allocator, "POPAMAN_CACHE_SIZE")) |value| {
+            defer allocator.free(value);
+            max_size = std.fmt.parseInt(u64, value, 10) catch {
+                std.debug.print("Warning: Ignoring invalid POPAMAN_CACHE_SIZE: {s}\n", .{value});
+                return try init(allocator, exe_dir, default_max_size);
+            };
+        } else |_| {}
+        if (max_size == 0) return null;
+        return try init(allocator, exe_dir, max_size);
+    }
+
+    fn init(allocator: std.mem.Allocator, exe_dir: []const u8, max_size: u64) !Cache {
+        return .{
+            .path = try std.fs.path.join(allocator, &[_][]const u8{ exe_dir, "..", "cache" }),
+            .max_size = max_size,
+        };
+    }
+
+    pub fn deinit(self: Cache, allocator: std.mem.Allocator) void {
+        allocator.free(self.path);
+    }
+
+    // content hash of what url served last time, null when it was never cached or was evicted
+    pub fn lookupUrl(self: Cache, allocator: std.mem.Allocator, url: []const u8) !?Hash {
+        const url_path = try self.urlPath(allocator, url);
+        defer allocator.free(url_path);
+
+        var hash: Hash = undefined;
+        const file = std.fs.cwd().openFile(url_path, .{}) catch |err| switch (err) {
+            error.FileNotFound => return null,
+            else => return err,
+        };
+        defer file.close();
+        if (try file.readAll(&hash) != hash.len) return null;
+
+        const file_path = try self.entryPath(allocator, hash, file_dir);
+        defer allocator.free(file_path);
+        std.fs.cwd().access(file_path, .{}) catch return null;
+        return hash;
+    }
+
+    // moves a finished download into the cache and records it under url
+    pub fn storeDownload(self: Cache, allocator: std.mem.Allocator, url: []const u8, download_path: []const u8) !Hash {
+        const hash = try hashFile(download_path);
+
+        const dest_dir = try self.entryPath(allocator, hash, file_dir);
+        defer allocator.free(dest_dir);
+        try std.fs.cwd().makePath(dest_dir);
+        const dest_path = try std.fs.path.join(allocator, &[_][]const u8{ dest_dir, std.fs.path.basename(download_path) });
+        defer allocator.free(dest_path);
+        // the same content may already be cached from another url, either copy is fine
+        try std.fs.cwd().rename(download_path, dest_path);
+
+        const urls_path = try std.fs.path.join(allocator, &[_][]const u8{ self.path, url_dir });
+        defer allocator.free(urls_path);
+        try std.fs.cwd().makePath(urls_path);
+        const url_path = try self.urlPath(allocator, url);
+        defer allocator.free(url_path);
+        var atomic_file = try std.fs.cwd().atomicFile(url_path, .{});
+        defer atomic_file.deinit();
+        try atomic_file.file.writeAll(&hash);
+        try atomic_file.finish();
+
+        try self.touch(allocator, hash, true);
+        return hash;
+    }
+
+    // path of the downloaded file cached under hash
+    pub fn downloadPath(self: Cache, allocator: std.mem.Allocator, hash: Hash) ![]const u8 {
+        const dir_path = try self.entryPath(allocator, hash, file_dir);
+        defer allocator.free(dir_path);
+
+        var dir = try std.fs.cwd().openDir(dir_path, .{ .iterate = true });
+        defer dir.close();
+        var iter = dir.iterate();
+        const entry = try iter.next() orelse return error.FileNotFound;
+        return std.fs.path.join(allocator, &[_][]const u8{ dir_path, entry.name });
+    }
+
+    // directory holding the files of the cached download, for downloads that are executables
+    pub fn downloadDir(self: Cache, allocator: std.mem.Allocator, hash: Hash) ![]const u8 {
+        return self.entryPath(allocator, hash, file_dir);
+    }
+
+    // records that the extraction of the archive with content hash was placed at lib/<name>,
+    // keeping the manifest at manifest_path that describes it as placed
+    pub fn storeInstalled(self: Cache, allocator: std.mem.Allocator, hash: Hash, name: []const u8, manifest_path: []const u8) !void {
+        const dir_path = try self.entryPath(allocator, hash, installed_dir);
+        defer allocator.free(dir_path);
+        try std.fs.cwd().makePath(dir_path);
+        var dir = try std.fs.cwd().openDir(dir_path, .{});
+        defer dir.close();
+
+        const file_name = try std.fmt.allocPrint(allocator, "{s}.json", .{name});
+        defer allocator.free(file_name);
+        try std.fs.cwd().copyFile(manifest_path, dir, file_name, .{});
+        try self.touch(allocator, hash, true);
+    }
+
+    // the recorded manifests of the packages the archive with content hash was placed in,
+    // named <package name>.json
+    pub fn installed(self: Cache, allocator: std.mem.Allocator, hash: Hash) ![]const []const u8 {
+        const dir_path = try self.entryPath(allocator, hash, installed_dir);
+        defer allocator.free(dir_path);
+
+        var paths = std.ArrayList([]const u8).init(allocator);
+        errdefer {
+            for (paths.items) |path| allocator.free(path);
+            paths.deinit();
+        }
+        var dir = std.fs.cwd().openDir(dir_path, .{ .iterate = true }) catch |err| switch (err) {
+            error.FileNotFound => return paths.toOwnedSlice(),
+            else => return err,
+        };
+        defer dir.close();
+        var iter = dir.iterate();
+        while (try iter.next()) |entry| {
+            if (entry.kind != .file or !std.mem.endsWith(u8, entry.name, ".json")) continue;
+            try paths.append(try std.fs.path.join(allocator, &[_][]const u8{ dir_path, entry.name }));
+        }
+        return paths.toOwnedSlice();
+    }
+
+    // marks an entry as just used, recounting its size when its content changed
+    pub fn touch(self: Cache, allocator: std.mem.Allocator, hash: Hash, recount: bool) !void {
+        const info_path = try self.entryPath(allocator, hash, entry_name);
+        defer allocator.free(info_path);
+
+        var info = EntryInfo{ .size = 0, .last_used = std.time.milliTimestamp() };
+        if (recount) {
+            const entry_dir = try self.entryPath(allocator, hash, "");
+            defer allocator.free(entry_dir);
+            info.size = try treeSize(allocator, entry_dir);
+        } else if (readInfo(allocator, info_path)) |old| {
+            info.size = old.size;
+        } else |_| {}
+
+        var atomic_file = try std.fs.cwd().atomicFile(info_path, .{});
+        defer atomic_file.deinit();
+        try std.json.stringify(info, .{}, atomic_file.file.writer());
+        try atomic_file.finish();
+    }
+
+    // deletes the least recently used entries until the cache fits its size cap
+    pub fn evict(self: Cache, allocator: std.mem.Allocator) !void {
+        var dir = std.fs.cwd().openDir(self.path, .{ .iterate = true }) catch |err| switch (err) {
+            error.FileNotFound => return,
+            else => return err,
+        };
+        defer dir.close();
+
+        const Candidate = struct {
+            name: []const u8,
+            info: EntryInfo,
+
+            fn olderThan(_: void, a: @This(), b: @This()) bool {
+                return a.info.last_used < b.info.last_used;
+            }
+        };
+
+        var arena = std.heap.ArenaAllocator.init(allocator);
+        defer arena.deinit();
+        const arena_allocator = arena.allocator();
+
+        var candidates = std.ArrayList(Candidate).init(arena_allocator);
+        var total: u64 = 0;
+        var iter = dir.iterate();
+        while (try iter.next()) |entry| {
+            if (entry.kind != .directory or std.mem.eql(u8, entry.name, url_dir)) continue;
+            const info_path = try std.fs.path.join(arena_allocator, &[_][]const u8{ self.path, entry.name, entry_name });
+            // entries without info are still being written by another install
+            const info = readInfo(arena_allocator, info_path) catch continue;
+            try candidates.append(.{ .name = try arena_allocator.dupe(u8, entry.name), .info = info });
+            total += info.size;
+        }
+        if (total <= self.max_size) return;
+
+        std.mem.sort(Candidate, candidates.items, {}, Candidate.olderThan);
+        for (candidates.items) |candidate| {
+            if (total <= self.max_size) break;
+            dir.deleteTree(candidate.name) catch |err| {
+                std.debug.print("Warning: Could not evict cache entry {s}: {any}\n", .{ candidate.name, err });
+                continue;
+            };
+            total -= candidate.info.size;
+        }
+    }
+
+    fn urlPath(self: Cache, allocator: std.mem.Allocator, url: []const u8) ![]const u8 {
+        var digest: [Sha256.digest_length]u8 = undefined;
+        Sha256.hash(url, &digest, .{});
+        const name = std.fmt.bytesToHex(digest, .lower);
+        return std.fs.path.join(allocator, &[_][]const u8{ self.path, url_dir, &name });
+    }
+
+    fn entryPath(self: Cache, allocator: std.mem.Allocator, hash: Hash, sub_path: []const u8) ![]const u8 {
+        return std.fs.path.join(allocator, &[_][]const u8{ self.path, &hash, sub_path });
+    }
+};
+
+// sha256 of a file's content as lowercase hex
+pub fn hashFile(path: []const u8) !Hash {
+    return hashFileAt(std.fs.cwd(), path);
+}
+
+pub fn hashFileAt(dir: std.fs.Dir, sub_path: []const u8) !Hash {
+    const file = try dir.openFile(sub_path, .{});
+    defer file.close();
+
+    var hasher = Sha256.init(.{});
+    var buffer: [64 * 1024]u8 = undefined;
+    while (true) {
+        const amt = try file.read(&buffer);
+        if (amt == 0) break;
+        hasher.update(buffer[0..amt]);
+    }
+    return std.fmt.bytesToHex(hasher.finalResult(), .lower);
+}
+
+fn readInfo(allocator: std.mem.Allocator, info_path: []const u8) !EntryInfo {
+    const content = try std.fs.cwd().readFileAlloc(allocator, info_path, 4096);
+    defer allocator.free(content);
+    return std.json.parseFromSliceLeaky(EntryInfo, allocator, content, .{});
+}
+
+fn treeSize(allocator: std.mem.Allocator, path: []const u8) !u64 {
+    var dir = try std.fs.cwd().openDir(path, .{ .iterate = true });
+    defer dir.close();
+    var walker = try dir.walk(allocator);
+    defer walker.deinit();
+
+    var total: u64 = 0;
+    while (try walker.next()) |entry| {
+        if (entry.kind != .file) continue;
+        const stat = try entry.dir.statFile(entry.basename);
+        total += stat.size;
+    }
+    return total;
+}
@@ -9,6 +9,12 @@ pub fn isInstallCommand(cmd: []const u8) bool {
            std.mem.eql(u8, cmd, "--install");
 }
 
+pub fn isApplyCommand(cmd: []const u8) bool {
+    return std.mem.eql(u8, cmd, "apply") or
+           std.mem.eql(u8, cmd, "-apply") or
+           std.mem.eql(u8, cmd, "--apply");
+}
+
 pub fn isRemoveCommand(cmd: []const u8) bool {
     return std.mem.eql(u8, cmd, "r") or 
            std.mem.eql(u8, cmd, "rm") or
@@ -78,4 +84,28 @@ pub fn isVerboseFlag(flag: []const u8) bool {
            std.mem.eql(u8, flag, "-verbose") or
            std.mem.eql(u8, flag, "--v") or
            std.mem.eql(u8, flag, "--verbose");
-}
\ No newline at end of file
+}
+
+// only the dashed forms, a bare "trace" could be a package keyword
+pub fn isTraceFlag(flag: []const u8) bool {
+    return std.mem.eql(u8, flag, "-trace") or
+           std.mem.eql(u8, flag, "--trace");
+}
+
+pub fn isVerifyCommand(cmd: []const u8) bool {
+    return std.mem.eql(u8, cmd, "verify") or
+           std.mem.eql(u8, cmd, "-verify") or
+           std.mem.eql(u8, cmd, "--verify");
+}
+
+// only the dashed forms, a bare "all" could be a package keyword
+pub fn isAllFlag(flag: []const u8) bool {
+    return std.mem.eql(u8, flag, "-all") or
+           std.mem.eql(u8, flag, "--all");
+}
+
+pub fn isUpgradeCommand(cmd: []const u8) bool {
+    return std.mem.eql(u8, cmd, "upgrade") or
+           std.mem.eql(u8, cmd, "-upgrade") or
+           std.mem.eql(u8, cmd, "--upgrade");
+}
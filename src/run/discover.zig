@@ -0,0 +1,214 @@
+const std = @import("std");
+const builtin = @import("builtin");
+const trace = @import("../utils/trace.zig");
+
+// finds the files of a package that can be run, for the executable prompt
+//
+// directories are listed by a small pool of threads sharing a queue, and subtrees that
+// never hold a package's entry point (vcs metadata, node_modules, headers, docs) are not
+// entered at all. files are judged by their exec bit and their first bytes rather than
+// their names, and the result is ranked so the likeliest choice comes first
+
+const max_threads = 8;
+
+// directory names that are skipped wherever they appear
+const pruned_dirs = [_][]const u8{
+    ".git",    ".hg",           ".svn", "node_modules", "__pycache__", ".zig-cache",
+    "include", "site-packages", "doc",  "docs",         "man",         "locale",
+    "locales",
+};
+
+// libraries and objects can carry an exec bit and a binary header but cannot be run
+const library_exts = [_][]const u8{ ".so", ".dll", ".dylib", ".a", ".o", ".lib", ".obj" };
+const script_exts = [_][]const u8{ ".sh", ".bat", ".cmd", ".ps1" };
+
+const Candidate = struct {
+    path: []const u8,
+    score: u8,
+    depth: usize,
+
+    // best score first, then closest to the package root, then by name
+    fn before(_: void, a: Candidate, b: Candidate) bool {
+        if (a.score != b.score) return a.score > b.score;
+        if (a.depth != b.depth) return a.depth < b.depth;
+        return std.mem.lessThan(u8, a.path, b.path);
+    }
+};
+
+const Walk = struct {
+    root: std.fs.Dir,
+    // shared by every thread, so it must be thread safe
+    allocator: std.mem.Allocator,
+    mutex: std.Thread.Mutex = .{},
+    cond: std.Thread.Condition = .{},
+    // directories waiting to be listed, relative to root
+    queue: std.ArrayListUnmanaged([]const u8) = .empty,
+    // directories being listed right now, the walk is over when this and the queue are empty
+    active: usize = 0,
+    found: std.ArrayListUnmanaged(Candidate) = .empty,
+    err: ?anyerror = null,
+
+    fn worker(walk: *Walk) void {
+        while (true) {
+            walk.mutex.lock();
+            while (walk.queue.items.len == 0 and walk.active > 0) walk.cond.wait(&walk.mutex);
+            const sub_path = walk.queue.pop() orelse {
+                walk.mutex.unlock();
+                walk.cond.broadcast();
+                return;
+            };
+            walk.active += 1;
+            walk.mutex.unlock();
+
+            walk.listDir(sub_path) catch |err| {
+                walk.mutex.lock();
+                if (walk.err == null) walk.err = err;
+                walk.mutex.unlock();
+            };
+
+            walk.mutex.lock();
+            walk.active -= 1;
+            walk.mutex.unlock();
+            walk.cond.broadcast();
+        }
+    }
+
+    fn listDir(walk: *Walk, sub_path: []const u8) !void {
+        var dir = try walk.root.openDir(if (sub_path.len == 0) "." else sub_path, .{ .iterate = true });
+        defer dir.close();
+
+        var subdirs = std.ArrayListUnmanaged([]const u8).empty;
+        defer subdirs.deinit(walk.allocator);
+        var found = std.ArrayListUnmanaged(Candidate).empty;
+        defer found.deinit(walk.allocator);
+
+        const depth = if (sub_path.len == 0) 0 else std.mem.count(u8, sub_path, std.fs.path.sep_str) + 1;
+        var iter = dir.iterate();
+        while (try iter.next()) |entry| {
+            switch (entry.kind) {
+                .directory => {
+                    if (isPruned(entry.name)) continue;
+                    try subdirs.append(walk.allocator, try joinPath(walk.allocator, sub_path, entry.name));
+                },
+                .file => {
+                    const score = classify(dir, entry.name) orelse continue;
+                    try found.append(walk.allocator, .{
+                        .path = try joinPath(walk.allocator, sub_path, entry.name),
+                        .score = score,
+                        .depth = depth,
+                    });
+                },
+                else => {},
+            }
+        }
+
+        // one lock per directory rather than per entry
+        walk.mutex.lock();
+        defer walk.mutex.unlock();
+        try walk.queue.appendSlice(walk.allocator, subdirs.items);
+        try walk.found.appendSlice(walk.allocator, found.items);
+        if (subdirs.items.len > 0) walk.cond.broadcast();
+    }
+};
+
+// the runnable files under dir as paths relative to it, ranked best first
+// the caller owns the list and every path in it
+pub fn findExecutables(allocator: std.mem.Allocator, dir: std.fs.Dir) !std.ArrayList([]const u8) {
+    var arena = std.heap.ArenaAllocator.init(std.heap.page_allocator);
+    defer arena.deinit();
+    var thread_safe = std.heap.ThreadSafeAllocator{ .child_allocator = arena.allocator() };
+
+    var span = trace.begin("walk", "discover");
+    defer span.end();
+
+    var walk = Walk{ .root = dir, .allocator = thread_safe.allocator() };
+    try walk.queue.append(walk.allocator, "");
+
+    const cpu_count = std.Thread.getCpuCount() catch 1;
+    const thread_count = std.math.clamp(cpu_count, 1, max_threads);
+    var threads = [_]?std.Thread{null} ** max_threads;
+    for (threads[1..thread_count]) |*thread| {
+        thread.* = std.Thread.spawn(.{}, Walk.worker, .{&walk}) catch null;
+    }
+    walk.worker();
+    for (threads[1..thread_count]) |thread| {
+        if (thread) |t| t.join();
+    }
+    if (walk.err) |err| return err;
+
+    std.mem.sort(Candidate, walk.found.items, {}, Candidate.before);
+    span.count = walk.found.items.len;
+
+    var exe_paths = std.ArrayList([]const u8).init(allocator);
+    errdefer {
+        for (exe_paths.items) |path| {
+            allocator.free(path);
+        }
+        exe_paths.deinit();
+    }
+    try exe_paths.ensureTotalCapacity(walk.found.items.len);
+    for (walk.found.items) |candidate| {
+        exe_paths.appendAssumeCapacity(try allocator.dupe(u8, candidate.path));
+    }
+    return exe_paths;
+}
+
+fn isPruned(name: []const u8) bool {
+    for (pruned_dirs) |pruned| {
+        if (std.ascii.eqlIgnoreCase(name, pruned)) return true;
+    }
+    return false;
+}
+
+fn hasExt(name: []const u8, exts: []const []const u8) bool {
+    const ext = std.fs.path.extension(name);
+    for (exts) |candidate| {
+        if (std.ascii.eqlIgnoreCase(ext, candidate)) return true;
+    }
+    return false;
+}
+
+// how likely a file is to be the program to run, null when it cannot be run at all
+//   3  a native binary (ELF, PE, Mach-O) that is marked executable
+//   2  a script with a shebang that is marked executable
+//   1  anything else marked executable, or a file with a script extension
+fn classify(dir: std.fs.Dir, name: []const u8) ?u8 {
+    // versioned shared objects look like libfoo.so.1.2
+    if (hasExt(name, &library_exts) or std.mem.indexOf(u8, name, ".so.") != null) return null;
+
+    const is_exe = std.ascii.endsWithIgnoreCase(name, ".exe") or std.ascii.endsWithIgnoreCase(name, ".com");
+    const is_script = hasExt(name, &script_exts);
+
+    // windows has no exec bit, there the name is all there is to go on
+    const executable = if (builtin.os.tag == .windows)
+        is_exe
+    else blk: {
+        const stat = dir.statFile(name) catch return null;
+        break :blk stat.mode & 0o111 != 0;
+    };
+    if (!executable) return if (is_script or is_exe) 1 else null;
+
+    var magic: [4]u8 = undefined;
+    const amt = blk: {
+        const file = dir.openFile(name, .{}) catch break :blk 0;
+        defer file.close();
+        break :blk file.readAll(&magic) catch 0;
+    };
+    const head = magic[0..amt];
+
+    if (std.mem.startsWith(u8, head, "\x7fELF") or
+        std.mem.startsWith(u8, head, "MZ") or
+        std.mem.eql(u8, head, "\xcf\xfa\xed\xfe") or
+        std.mem.eql(u8, head, "\xce\xfa\xed\xfe") or
+        std.mem.eql(u8, head, "\xca\xfe\xba\xbe"))
+    {
+        return 3;
+    }
+    if (std.mem.startsWith(u8, head, "#!")) return 2;
+    return 1;
+}
+
+fn joinPath(allocator: std.mem.Allocator, sub_path: []const u8, name: []const u8) ![]const u8 {
+    if (sub_path.len == 0) return allocator.dupe(u8, name);
+    return std.fs.path.join(allocator, &[_][]const u8{ sub_path, name });
+}
@@ -0,0 +1,261 @@
+const std = @import("std");
+
+// url downloads through curl, split into byte ranges that are fetched in parallel when
+// the server supports range requests
+//
+// ranges are written to temp/partial-<url hash>/part-<n> and outlive an interrupted
+// install, so the next install of the same url only fetches the bytes still missing
+// a range whose transfer breaks off is retried from where it stopped
+//
+// downloads of the same url, from one batch or from several processes, take turns
+// through an exclusive lock on temp/partial-<url hash>.lock, so two of them never write
+// the same part files. the lock file stays behind, empty, like lib/packages.lock
+
+const min_chunk_size: u64 = 4 * 1024 * 1024;
+const max_chunks = 4;
+const max_attempts = 3;
+
+const info_name = "info";
+
+const Probe = struct {
+    size: ?u64,
+    ranges: bool,
+    // etag or last-modified, ties the partial ranges to the file they came from
+    validator: []const u8,
+};
+
+const Chunk = struct {
+    url: []const u8,
+    path: []const u8,
+    start: u64,
+    len: u64,
+    err: ?anyerror = null,
+
+    fn fetch(chunk: *Chunk) void {
+        fetchRange(chunk.*) catch |err| {
+            chunk.err = err;
+        };
+    }
+};
+
+// downloads url to output_path, resuming earlier partial downloads kept in temp_dir
+pub fn download(allocator: std.mem.Allocator, temp_dir: []const u8, url: []const u8, output_path: []const u8) !void {
+    const probe = probeUrl(allocator, url) catch |err| {
+        std.debug.print("Could not probe {s}, downloading it whole: {any}\n", .{ url, err });
+        return downloadWhole(allocator, url, output_path);
+    };
+    defer allocator.free(probe.validator);
+
+    const size = probe.size orelse return downloadWhole(allocator, url, output_path);
+    if (!probe.ranges or size == 0) return downloadWhole(allocator, url, output_path);
+
+    var url_digest: [std.crypto.hash.sha2.Sha256.digest_length]u8 = undefined;
+    std.crypto.hash.sha2.Sha256.hash(url, &url_digest, .{});
+    const partial_name = try std.fmt.allocPrint(allocator, "partial-{s}", .{std.fmt.fmtSliceHexLower(url_digest[0..8])});
+    defer allocator.free(partial_name);
+    const partial_dir = try std.fs.path.join(allocator, &[_][]const u8{ temp_dir, partial_name });
+    defer allocator.free(partial_dir);
+
+    // held until the ranges are joined and the partial directory is gone
+    const lock_path = try std.fmt.allocPrint(allocator, "{s}.lock", .{partial_dir});
+    defer allocator.free(lock_path);
+    try std.fs.cwd().makePath(temp_dir);
+    const lock = try std.fs.cwd().createFile(lock_path, .{ .lock = .exclusive, .truncate = false });
+    defer lock.close();
+
+    try preparePartialDir(allocator, partial_dir, size, probe.validator);
+
+    const chunk_count: usize = @intCast(std.math.clamp(size / min_chunk_size, 1, max_chunks));
+    std.debug.print("Downloading {s} ({d} bytes) in {d} parts\n", .{ url, size, chunk_count });
+
+    var chunks: [max_chunks]Chunk = undefined;
+    var paths: [max_chunks][]const u8 = undefined;
+    for (0..chunk_count) |i| {
+        paths[i] = try std.fmt.allocPrint(allocator, "{s}{c}part-{d}", .{ partial_dir, std.fs.path.sep, i });
+        const start = size * i / chunk_count;
+        chunks[i] = .{
+            .url = url,
+            .path = paths[i],
+            .start = start,
+            .len = size * (i + 1) / chunk_count - start,
+        };
+    }
+    defer for (paths[0..chunk_count]) |path| allocator.free(path);
+
+    // the first range runs on this thread, the others on their own
+    var threads = [_]?std.Thread{null} ** max_chunks;
+    for (chunks[1..chunk_count], threads[1..chunk_count]) |*chunk, *thread| {
+        thread.* = std.Thread.spawn(.{}, Chunk.fetch, .{chunk}) catch null;
+        // without a thread the range is fetched after the first one
+        if (thread.* == null) chunk.fetch();
+    }
+    chunks[0].fetch();
+    for (threads[1..chunk_count]) |thread| {
+        if (thread) |t| t.join();
+    }
+
+    for (chunks[0..chunk_count]) |chunk| {
+        const err = chunk.err orelse continue;
+        if (err == error.RangeIgnored) {
+            std.debug.print("Server ignored the range request, downloading {s} whole\n", .{url});
+            std.fs.cwd().deleteTree(partial_dir) catch {};
+            return downloadWhole(allocator, url, output_path);
+        }
+        std.debug.print("Failed to download package: {s}, run the install again to resume\n", .{url});
+        return error.DownloadFailed;
+    }
+
+    // the other ranges are appended to the first, which then becomes the download
+    {
+        const out = try std.fs.cwd().openFile(chunks[0].path, .{ .mode = .read_write });
+        defer out.close();
+        for (chunks[1..chunk_count]) |chunk| {
+            const part = try std.fs.cwd().openFile(chunk.path, .{});
+            defer part.close();
+            if (try part.copyRangeAll(0, out, chunk.start, chunk.len) != chunk.len) return error.DownloadFailed;
+        }
+    }
+    try std.fs.cwd().rename(chunks[0].path, output_path);
+    std.fs.cwd().deleteTree(partial_dir) catch {};
+}
+
+// keeps the ranges of an earlier attempt only when they belong to the same file
+fn preparePartialDir(allocator: std.mem.Allocator, partial_dir: []const u8, size: u64, validator: []const u8) !void {
+    const info = try std.fmt.allocPrint(allocator, "{d}\n{s}\n", .{ size, validator });
+    defer allocator.free(info);
+    const info_path = try std.fs.path.join(allocator, &[_][]const u8{ partial_dir, info_name });
+    defer allocator.free(info_path);
+
+    if (std.fs.cwd().readFileAlloc(allocator, info_path, 4096)) |old_info| {
+        defer allocator.free(old_info);
+        if (std.mem.eql(u8, old_info, info)) {
+            std.debug.print("Resuming partial download in {s}\n", .{partial_dir});
+            return;
+        }
+    } else |_| {}
+
+    std.fs.cwd().deleteTree(partial_dir) catch {};
+    try std.fs.cwd().makePath(partial_dir);
+    try std.fs.cwd().writeFile(.{ .sub_path = info_path, .data = info });
+}
+
+// fetches the bytes of a range that are not on disk yet, retrying broken transfers
+fn fetchRange(chunk: Chunk) !void {
+    const file = try std.fs.cwd().createFile(chunk.path, .{ .truncate = false });
+    defer file.close();
+
+    var attempt: usize = 0;
+    while (true) : (attempt += 1) {
+        var have = try file.getEndPos();
+        if (have > chunk.len) {
+            try file.setEndPos(0);
+            have = 0;
+        }
+        if (have == chunk.len) return;
+        if (attempt == max_attempts) return error.DownloadFailed;
+        if (attempt > 0) {
+            std.debug.print("Retrying bytes {d}-{d} of {s}\n", .{ chunk.start + have, chunk.start + chunk.len - 1, chunk.url });
+        }
+
+        try file.seekTo(have);
+        fetchInto(file, chunk.url, chunk.start + have, chunk.len - have) catch |err| switch (err) {
+            error.RangeIgnored => return err,
+            else => std.debug.print("Warning: Transfer of {s} broke off: {any}\n", .{ chunk.url, err }),
+        };
+    }
+}
+
+// streams bytes first..first+len-1 of url into file at its current position
+fn fetchInto(file: std.fs.File, url: []const u8, first: u64, len: u64) !void {
+    var range_buf: [64]u8 = undefined;
+    const range = try std.fmt.bufPrint(&range_buf, "{d}-{d}", .{ first, first + len - 1 });
+    const args = [_][]const u8{ "curl", "-sS", "-L", "--fail", "-r", range, url };
+
+    // each range runs on its own thread, so the child gets the thread-safe page allocator
+    var child = std.process.Child.init(&args, std.heap.page_allocator);
+    child.stdout_behavior = .Pipe;
+    try child.spawn();
+    errdefer _ = child.kill() catch {};
+
+    var received: u64 = 0;
+    var buffer: [64 * 1024]u8 = undefined;
+    while (true) {
+        const amt = try child.stdout.?.read(&buffer);
+        if (amt == 0) break;
+        received += amt;
+        // a server that answers a range request with the whole file does not support ranges
+        if (received > len) return error.RangeIgnored;
+        try file.writeAll(buffer[0..amt]);
+    }
+
+    const term = try child.wait();
+    if (term != .Exited or term.Exited != 0) return error.DownloadFailed;
+}
+
+// asks the server for the size of url and whether it accepts range requests
+fn probeUrl(allocator: std.mem.Allocator, url: []const u8) !Probe {
+    const result = try std.process.Child.run(.{
+        .allocator = allocator,
+        .argv = &[_][]const u8{ "curl", "-sS", "-I", "-L", "--fail", url },
+    });
+    defer allocator.free(result.stdout);
+    defer allocator.free(result.stderr);
+    if (result.term != .Exited or result.term.Exited != 0) return error.ProbeFailed;
+
+    var size: ?u64 = null;
+    var ranges = false;
+    var etag: ?[]const u8 = null;
+    var last_modified: ?[]const u8 = null;
+    var lines = std.mem.splitScalar(u8, result.stdout, '\n');
+    while (lines.next()) |raw_line| {
+        const line = std.mem.trimRight(u8, raw_line, "\r");
+        // every redirect starts a new response, only the last one describes the file
+        if (std.mem.startsWith(u8, line, "HTTP/")) {
+            size = null;
+            ranges = false;
+            etag = null;
+            last_modified = null;
+            continue;
+        }
+        const colon = std.mem.indexOfScalar(u8, line, ':') orelse continue;
+        const name = line[0..colon];
+        const value = std.mem.trim(u8, line[colon + 1 ..], " \t");
+        if (std.ascii.eqlIgnoreCase(name, "content-length")) {
+            size = std.fmt.parseInt(u64, value, 10) catch null;
+        } else if (std.ascii.eqlIgnoreCase(name, "accept-ranges")) {
+            ranges = std.ascii.eqlIgnoreCase(value, "bytes");
+        } else if (std.ascii.eqlIgnoreCase(name, "etag")) {
+            etag = value;
+        } else if (std.ascii.eqlIgnoreCase(name, "last-modified")) {
+            last_modified = value;
+        }
+    }
+
+    return .{
+        .size = size,
+        .ranges = ranges,
+        .validator = try allocator.dupe(u8, etag orelse last_modified orelse ""),
+    };
+}
+
+// plain single transfer for servers without range support
+fn downloadWhole(allocator: std.mem.Allocator, url: []const u8, output_path: []const u8) !void {
+    // Prepare curl command
+    const args = [_][]const u8{
+        "curl",
+        "-L", // Follow redirects
+        "--fail",
+        "-o",
+        output_path,
+        url,
+    };
+
+    // Execute curl
+    var child = std.process.Child.init(&args, allocator);
+    const term = try child.spawnAndWait();
+
+    if (term != .Exited or term.Exited != 0) {
+        std.debug.print("Failed to download package: {s}\n", .{url});
+        return error.DownloadFailed;
+    }
+}
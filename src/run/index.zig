@@ -0,0 +1,188 @@
+const std = @import("std");
+
+// packages.idx is a keyword lookup table kept next to packages.json so dispatch
+// can find one package without reading and parsing the whole registry
+//
+// layout, all integers little endian:
+//   magic[8] | json size u64 | json mtime i128 | count u32 | offsets[count] u32 | records
+//   record: keyword len u16 | name len u16 | path len u16 | global u8 | keyword | name | path
+// records are stored in packages.json order, the offsets table is sorted by keyword
+// so a lookup is a binary search that only reads the records it probes
+
+pub const index_name = "packages.idx";
+
+const magic = "PPMIDX01";
+const header_len = magic.len + 8 + 16 + 4;
+const record_header_len = 2 + 2 + 2 + 1;
+
+pub const Entry = struct {
+    name: []const u8,
+    path: []const u8,
+    keyword: []const u8,
+    global: bool,
+
+    pub fn deinit(self: *const Entry, allocator: std.mem.Allocator) void {
+        allocator.free(self.name);
+        allocator.free(self.path);
+        allocator.free(self.keyword);
+    }
+};
+
+// collects the packages of a registry as it is written, one at a time, and writes the
+// index for them once packages.json is complete. only keyword, name and path are kept
+pub const Builder = struct {
+    allocator: std.mem.Allocator,
+    records: std.ArrayListUnmanaged(u8) = .empty,
+    record_offsets: std.ArrayListUnmanaged(u32) = .empty,
+
+    pub fn init(allocator: std.mem.Allocator) Builder {
+        return .{ .allocator = allocator };
+    }
+
+    pub fn deinit(self: *Builder) void {
+        self.records.deinit(self.allocator);
+        self.record_offsets.deinit(self.allocator);
+    }
+
+    pub fn add(self: *Builder, pkg: anytype) !void {
+        const offset = std.math.cast(u32, self.records.items.len) orelse return error.IndexTooLarge;
+        const writer = self.records.writer(self.allocator);
+        try writer.writeInt(u16, std.math.cast(u16, pkg.keyword.len) orelse return error.NameTooLong, .little);
+        try writer.writeInt(u16, std.math.cast(u16, pkg.name.len) orelse return error.NameTooLong, .little);
+        try writer.writeInt(u16, std.math.cast(u16, pkg.path.len) orelse return error.NameTooLong, .little);
+        try writer.writeByte(@intFromBool(pkg.global));
+        try writer.writeAll(pkg.keyword);
+        try writer.writeAll(pkg.name);
+        try writer.writeAll(pkg.path);
+        try self.record_offsets.append(self.allocator, offset);
+    }
+
+    // writes packages.idx for the packages added so far
+    // json_stat must describe packages.json after the write so lookups can detect later edits
+    pub fn write(self: *Builder, lib_path: []const u8, json_stat: std.fs.File.Stat) !void {
+        const count = std.math.cast(u32, self.record_offsets.items.len) orelse return error.TooManyPackages;
+
+        // a stable sort keeps the first of any duplicate keywords first, matching the linear scan
+        const order = try self.allocator.dupe(u32, self.record_offsets.items);
+        defer self.allocator.free(order);
+        std.mem.sort(u32, order, self.records.items, keywordLessThan);
+
+        const index_path = try std.fs.path.join(self.allocator, &[_][]const u8{ lib_path, index_name });
+        defer self.allocator.free(index_path);
+
+        var atomic_file = try std.fs.cwd().atomicFile(index_path, .{});
+        defer atomic_file.deinit();
+        var buffered = std.io.bufferedWriter(atomic_file.file.writer());
+        const writer = buffered.writer();
+        try writer.writeAll(magic);
+        try writer.writeInt(u64, json_stat.size, .little);
+        try writer.writeInt(i128, json_stat.mtime, .little);
+        try writer.writeInt(u32, count, .little);
+        for (order) |offset| try writer.writeInt(u32, offset, .little);
+        try writer.writeAll(self.records.items);
+        try buffered.flush();
+        try atomic_file.finish();
+    }
+
+    fn keywordLessThan(records: []const u8, a: u32, b: u32) bool {
+        return std.mem.lessThan(u8, recordKeyword(records, a), recordKeyword(records, b));
+    }
+
+    fn recordKeyword(records: []const u8, offset: u32) []const u8 {
+        const keyword_len = std.mem.readInt(u16, records[offset..][0..2], .little);
+        return records[offset + record_header_len ..][0..keyword_len];
+    }
+};
+
+// finds a keyword in the index, null when it is not registered
+// json_stat describes the packages.json the caller reads, the index must have been built from it
+// returns error.IndexStale when the index is missing, damaged or older than packages.json
+pub fn lookup(allocator: std.mem.Allocator, lib_path: []const u8, json_stat: std.fs.File.Stat, keyword: []const u8) !?Entry {
+    const index_path = try std.fs.path.join(allocator, &[_][]const u8{ lib_path, index_name });
+    defer allocator.free(index_path);
+
+    const file = std.fs.cwd().openFile(index_path, .{}) catch |err| switch (err) {
+        error.FileNotFound => return error.IndexStale,
+        else => return err,
+    };
+    defer file.close();
+
+    var header: [header_len]u8 = undefined;
+    try readExact(file, &header, 0);
+    if (!std.mem.eql(u8, header[0..magic.len], magic)) return error.IndexStale;
+    const json_size = std.mem.readInt(u64, header[8..16], .little);
+    const json_mtime = std.mem.readInt(i128, header[16..32], .little);
+    if (json_size != json_stat.size or json_mtime != json_stat.mtime) return error.IndexStale;
+
+    const count = std.mem.readInt(u32, header[32..36], .little);
+    const records_start = header_len + @as(u64, count) * 4;
+
+    // lower bound binary search over the sorted offsets table
+    var low: u32 = 0;
+    var high: u32 = count;
+    var key_buf = std.ArrayList(u8).init(allocator);
+    defer key_buf.deinit();
+    while (low < high) {
+        const mid = low + (high - low) / 2;
+        const record = try readRecordHeader(file, records_start, mid);
+        try key_buf.resize(record.keyword_len);
+        try readExact(file, key_buf.items, record.offset + record_header_len);
+        if (std.mem.lessThan(u8, key_buf.items, keyword)) {
+            low = mid + 1;
+        } else {
+            high = mid;
+        }
+    }
+    if (low == count) return null;
+
+    const record = try readRecordHeader(file, records_start, low);
+    const body = try allocator.alloc(u8, @as(usize, record.keyword_len) + record.name_len + record.path_len);
+    defer allocator.free(body);
+    try readExact(file, body, record.offset + record_header_len);
+
+    const found_keyword = body[0..record.keyword_len];
+    if (!std.mem.eql(u8, found_keyword, keyword)) return null;
+    const name = body[record.keyword_len..][0..record.name_len];
+    const path = body[record.keyword_len + record.name_len ..][0..record.path_len];
+
+    const entry_keyword = try allocator.dupe(u8, found_keyword);
+    errdefer allocator.free(entry_keyword);
+    const entry_name = try allocator.dupe(u8, name);
+    errdefer allocator.free(entry_name);
+    return Entry{
+        .name = entry_name,
+        .path = try allocator.dupe(u8, path),
+        .keyword = entry_keyword,
+        .global = record.global,
+    };
+}
+
+const RecordHeader = struct {
+    offset: u64,
+    keyword_len: u16,
+    name_len: u16,
+    path_len: u16,
+    global: bool,
+};
+
+fn readRecordHeader(file: std.fs.File, records_start: u64, slot: u32) !RecordHeader {
+    var offset_bytes: [4]u8 = undefined;
+    try readExact(file, &offset_bytes, header_len + @as(u64, slot) * 4);
+    const offset = records_start + std.mem.readInt(u32, &offset_bytes, .little);
+
+    var bytes: [record_header_len]u8 = undefined;
+    try readExact(file, &bytes, offset);
+    return .{
+        .offset = offset,
+        .keyword_len = std.mem.readInt(u16, bytes[0..2], .little),
+        .name_len = std.mem.readInt(u16, bytes[2..4], .little),
+        .path_len = std.mem.readInt(u16, bytes[4..6], .little),
+        .global = bytes[6] != 0,
+    };
+}
+
+// a short read means the index was truncated, so it is treated as stale
+fn readExact(file: std.fs.File, buffer: []u8, offset: u64) !void {
+    const amt = try file.preadAll(buffer, offset);
+    if (amt != buffer.len) return error.IndexStale;
+}
@@ -0,0 +1,189 @@
+const std = @import("std");
+const index = @import("index.zig");
+const trace = @import("../utils/trace.zig");
+const Context = @import("../utils/context.zig").Context;
+
+// packages.json, read and written one package at a time
+//
+// the registry is {"package": [...]}. Reader walks the array with a json scanner fed by
+// positional reads of the context's shared handle, 64 KiB at a time, and hands
+// out one package at a time. a lookup stops at its keyword and no command holds more
+// than one entry of the registry, however large it grows. Writer streams a new registry
+// into a temporary file that replaces packages.json when it is finished, building the
+// keyword index on the way
+
+// the package struct has functions to handle memory allocation and deallocation
+pub const Package = struct {
+    name: []const u8,
+    path: []const u8,
+    keyword: []const u8,
+    description: []const u8,
+    global: bool,
+
+    pub fn init(allocator: std.mem.Allocator, name: []const u8, path: []const u8, keyword: []const u8, description: []const u8, global: bool) !Package {
+        return Package{
+            .name = try allocator.dupe(u8, name),
+            .path = try allocator.dupe(u8, path),
+            .keyword = try allocator.dupe(u8, keyword),
+            .description = try allocator.dupe(u8, description),
+            .global = global,
+        };
+    }
+
+    pub fn deinit(self: *const Package, allocator: std.mem.Allocator) void {
+        allocator.free(self.name);
+        allocator.free(self.path);
+        allocator.free(self.keyword);
+        allocator.free(self.description);
+    }
+};
+
+// packages.json from the start, read with pread so the shared handle's offset is never used
+const Source = struct {
+    file: std.fs.File,
+    offset: u64 = 0,
+
+    fn read(source: *Source, buffer: []u8) std.fs.File.PReadError!usize {
+        const amt = try source.file.pread(buffer, source.offset);
+        source.offset += amt;
+        return amt;
+    }
+};
+
+// how much of packages.json the scanner holds at once
+const read_buffer_size = 64 * 1024;
+
+const SourceReader = std.io.GenericReader(*Source, std.fs.File.PReadError, Source.read);
+const JsonReader = std.json.Reader(read_buffer_size, SourceReader);
+
+pub const Reader = struct {
+    allocator: std.mem.Allocator,
+    source: *Source,
+    json: JsonReader,
+    // holds the strings of the current package, reset for each one
+    entry_arena: std.heap.ArenaAllocator,
+    state: enum { start, entries, done } = .start,
+    span: trace.Span,
+    count: usize = 0,
+
+    // file is the context's registry handle, it is not closed by deinit
+    pub fn init(allocator: std.mem.Allocator, file: std.fs.File) !Reader {
+        const source = try allocator.create(Source);
+        source.* = .{ .file = file };
+        return .{
+            .allocator = allocator,
+            .source = source,
+            .json = JsonReader.init(allocator, .{ .context = source }),
+            .entry_arena = std.heap.ArenaAllocator.init(allocator),
+            .span = trace.begin("registry.read", "packages.json"),
+        };
+    }
+
+    pub fn deinit(self: *Reader) void {
+        self.span.bytes = self.source.offset;
+        self.span.count = self.count;
+        self.span.end();
+        self.entry_arena.deinit();
+        self.json.deinit();
+        self.allocator.destroy(self.source);
+    }
+
+    // the next package in registry order, null after the last one
+    // the package is only valid until the next call, copy what has to outlive it
+    pub fn next(self: *Reader) !?Package {
+        switch (self.state) {
+            .start => {
+                try self.findPackages();
+                self.state = .entries;
+            },
+            .entries => {},
+            .done => return null,
+        }
+
+        if (try self.json.peekNextTokenType() == .array_end) {
+            // whatever follows the package array is of no interest
+            self.state = .done;
+            return null;
+        }
+        _ = self.entry_arena.reset(.retain_capacity);
+        const pkg = try std.json.innerParse(Package, self.entry_arena.allocator(), &self.json, .{
+            .allocate = .alloc_always,
+            .max_value_len = std.json.default_max_value_len,
+        });
+        self.count += 1;
+        return pkg;
+    }
+
+    // moves the scanner to the first entry of the package array
+    fn findPackages(self: *Reader) !void {
+        if (try self.json.next() != .object_begin) return error.UnexpectedToken;
+        while (true) {
+            const field = try self.json.nextAlloc(self.entry_arena.allocator(), .alloc_if_needed);
+            switch (field) {
+                .string, .allocated_string => |name| {
+                    if (std.mem.eql(u8, name, "package")) {
+                        if (try self.json.next() != .array_begin) return error.UnexpectedToken;
+                        return;
+                    }
+                    try self.json.skipValue();
+                },
+                .object_end => return error.MissingField,
+                else => return error.UnexpectedToken,
+            }
+        }
+    }
+};
+
+const write_buffer_size = 64 * 1024;
+
+pub const Writer = struct {
+    ctx: *Context,
+    atomic_file: std.fs.AtomicFile,
+    buffered: std.io.BufferedWriter(write_buffer_size, std.fs.File.Writer),
+    index: index.Builder,
+    count: usize = 0,
+
+    // the caller holds the registry lock, see lock_registry
+    pub fn init(allocator: std.mem.Allocator, ctx: *Context) !Writer {
+        var atomic_file = try std.fs.cwd().atomicFile(try ctx.registryPath(), .{});
+        errdefer atomic_file.deinit();
+        try atomic_file.file.writeAll("{\"package\":[");
+        return .{
+            .ctx = ctx,
+            .atomic_file = atomic_file,
+            .buffered = .{ .unbuffered_writer = atomic_file.file.writer() },
+            .index = index.Builder.init(allocator),
+        };
+    }
+
+    // a writer that was not finished leaves packages.json as it was
+    pub fn deinit(self: *Writer) void {
+        self.index.deinit();
+        self.atomic_file.deinit();
+    }
+
+    pub fn add(self: *Writer, pkg: Package) !void {
+        const writer = self.buffered.writer();
+        if (self.count > 0) try writer.writeByte(',');
+        try std.json.stringify(pkg, .{}, writer);
+        try self.index.add(pkg);
+        self.count += 1;
+    }
+
+    // replaces packages.json with what was added and rebuilds the keyword index to match
+    // renaming keeps a crash mid-write from leaving a half written registry behind
+    pub fn finish(self: *Writer) !void {
+        var span = trace.begin("registry.write", "packages.json");
+        defer span.end();
+        try self.buffered.writer().writeAll("]}");
+        try self.buffered.flush();
+        // renaming keeps size and mtime, so the stat of the temporary file describes packages.json
+        const json_stat = try self.atomic_file.file.stat();
+        try self.atomic_file.finish();
+        self.ctx.dropRegistry();
+        span.bytes = json_stat.size;
+        span.count = self.count;
+
+        try self.index.write(try self.ctx.libPath(), json_stat);
+    }
+};
@@ -1,13 +1,22 @@
 const std = @import("std");
+const builtin = @import("builtin");
 const cmd_helper = @import("cmd_helper.zig");
+const index = @import("index.zig");
+const cache_mod = @import("cache.zig");
+const download = @import("download.zig");
+const discover = @import("discover.zig");
+const verify = @import("verify.zig");
+const upgrade = @import("upgrade.zig");
+const archive = @import("archive.zig");
+const registry = @import("registry.zig");
+const copy = @import("../utils/copy.zig");
+const trace = @import("../utils/trace.zig");
+const Cache = cache_mod.Cache;
+const Package = registry.Package;
+const Context = @import("../utils/context.zig").Context;
 const Reporting = @import("../utils/reporting.zig");
 const Err = @import("../utils/error.zig").ErrorType;
 
-// Define the root structure
-const PackageFile = struct {
-    package: []Package,
-};
-
 const PackageSource = enum {
     Exe,
     Dir,
@@ -16,32 +25,6 @@ const PackageSource = enum {
     Unknown,
 };
 
-// the package struct has functions to handle memory allocation and deallocation
-const Package = struct {
-    name: []const u8,
-    path: []const u8,
-    keyword: []const u8,
-    description: []const u8,
-    global: bool,
-
-    pub fn init(allocator: std.mem.Allocator, name: []const u8, path: []const u8, keyword: []const u8, description: []const u8, global: bool) !Package {
-        return Package{
-            .name = try allocator.dupe(u8, name),
-            .path = try allocator.dupe(u8, path),
-            .keyword = try allocator.dupe(u8, keyword),
-            .description = try allocator.dupe(u8, description),
-            .global = global,
-        };
-    }
-
-    pub fn deinit(self: *const Package, allocator: std.mem.Allocator) void {  
-        allocator.free(self.name);
-        allocator.free(self.path);
-        allocator.free(self.keyword);
-        allocator.free(self.description);
-    }
-};
-
 fn getline() ![]const u8 {
     var buffer: [240]u8 = undefined;
     const stdin = std.io.getStdIn();
@@ -58,185 +41,149 @@ fn getline() ![]const u8 {
     return error.EndOfStream;
 }
 
-fn parse_package_info(allocator: std.mem.Allocator, keyword: []const u8) !?Package {
-    // Create buffer for executable path
-    var exe_dir_buf: [std.fs.max_path_bytes]u8 = undefined;
-    const exe_dir = try std.fs.selfExeDirPath(&exe_dir_buf);
-    
-    const packages_path = try std.fs.path.join(allocator, &[_][]const u8{exe_dir, "..", "lib", "packages.json"});
-    defer allocator.free(packages_path);
-    
-    const file = try std.fs.cwd().openFile(packages_path, .{});
-    defer file.close();
-    
-    const content = try file.readToEndAlloc(allocator, std.math.maxInt(usize));
-    defer allocator.free(content);
-
-    // Parse the JSON content
-    const parsed = try std.json.parseFromSlice(
-        PackageFile,
-        allocator,
-        content,
-        .{},
-    );
-    defer parsed.deinit();
-
-    // Search through packages for matching keyword
-    for (parsed.value.package) |pkg| {
+// finds a package by keyword, reading packages.json only up to its entry
+fn parse_package_info(allocator: std.mem.Allocator, ctx: *Context, keyword: []const u8) !?Package {
+    var reader = try registry.Reader.init(allocator, try ctx.registryFile());
+    defer reader.deinit();
+
+    while (try reader.next()) |pkg| {
         if (std.mem.eql(u8, pkg.keyword, keyword)) {
-            const new_package = try Package.init(
-                allocator,
-                pkg.name,
-                pkg.path, 
-                pkg.keyword,
-                pkg.description,
-                pkg.global
-            );
-            return new_package;
+            return try Package.init(allocator, pkg.name, pkg.path, pkg.keyword, pkg.description, pkg.global);
         }
     }
-
-    
     return null;
 }
 
-fn add_package_info(allocator: std.mem.Allocator, package: Package) !void {
-    // Get executable directory path
-    var exe_dir_buf: [std.fs.max_path_bytes]u8 = undefined;
-    const exe_dir = try std.fs.selfExeDirPath(&exe_dir_buf);
-    
-    // Construct path to packages.json
-    const packages_path = try std.fs.path.join(allocator, &[_][]const u8{exe_dir, "..", "lib", "packages.json"});
-    defer allocator.free(packages_path);
-    
-    // Read existing file
-    const file = try std.fs.cwd().openFile(packages_path, .{ .mode = .read_write });
-    defer file.close();
-    
-    const content = try file.readToEndAlloc(allocator, std.math.maxInt(usize));
-    defer allocator.free(content);
-
-    // Parse existing JSON
-    const parsed = try std.json.parseFromSlice(
-        PackageFile,
-        allocator,
-        content,
-        .{},
-    );
-    defer parsed.deinit();
-
-    // Create new packages array with one more slot
-    var new_packages = try allocator.alloc(Package, parsed.value.package.len + 1);
-    defer {
-        // Deinitialize and free new_packages
-        for (new_packages) |*pkg| {
-            pkg.deinit(allocator);
-        }
-        allocator.free(new_packages);
-    }
+fn add_package_info(allocator: std.mem.Allocator, ctx: *Context, package: Package) !void {
+    try add_packages_info(allocator, ctx, &[_]Package{package});
+}
+
+// registers several packages with a single write of packages.json
+fn add_packages_info(allocator: std.mem.Allocator, ctx: *Context, packages: []const Package) !void {
+    const registry_lock = try lock_registry(allocator, ctx);
+    defer registry_lock.close();
+
+    var reader = try registry.Reader.init(allocator, try ctx.registryFile());
+    defer reader.deinit();
+    var writer = try registry.Writer.init(allocator, ctx);
+    defer writer.deinit();
 
-    // Copy existing packages using deep copy
-    for (parsed.value.package, 0..) |existing_pkg, i| {
-        new_packages[i] = try Package.init(
-            allocator,
-            existing_pkg.name,
-            existing_pkg.path,
-            existing_pkg.keyword,
-            existing_pkg.description,
-            existing_pkg.global
-        );
+    // the existing packages are copied through one at a time, then the new ones follow
+    while (try reader.next()) |pkg| try writer.add(pkg);
+    for (packages) |pkg| try writer.add(pkg);
+    try writer.finish();
+}
+
+// takes lib/packages.lock for a read-modify-write of packages.json, blocking while another
+// popaman process holds it, so concurrent changes are applied one after another instead of
+// the last writer dropping the others. closing the returned file releases the lock
+// readers do not lock: registry.Writer replaces packages.json with a rename, so they
+// always see a whole registry
+fn lock_registry(allocator: std.mem.Allocator, ctx: *Context) !std.fs.File {
+    const lock_path = try std.fs.path.join(allocator, &[_][]const u8{ try ctx.libPath(), "packages.lock" });
+    defer allocator.free(lock_path);
+    const lock = try std.fs.cwd().createFile(lock_path, .{ .lock = .exclusive, .truncate = false });
+    // the packages.json opened at startup may have been replaced while waiting for the lock
+    ctx.dropRegistry();
+    return lock;
+}
+
+// rebuilds packages.idx from packages.json, used when the index is missing or was
+// left behind by a manual edit of packages.json
+fn refresh_index(allocator: std.mem.Allocator, ctx: *Context) !void {
+    const file = try ctx.registryFile();
+    var reader = try registry.Reader.init(allocator, file);
+    defer reader.deinit();
+    var builder = index.Builder.init(allocator);
+    defer builder.deinit();
+
+    while (try reader.next()) |pkg| try builder.add(pkg);
+    try builder.write(try ctx.libPath(), try file.stat());
+}
+
+// finds a package for dispatch through the keyword index, the returned package has no description
+fn find_package(allocator: std.mem.Allocator, ctx: *Context, keyword: []const u8) !?Package {
+    // the index is checked against the packages.json the context already has open
+    const json_stat = try (try ctx.registryFile()).stat();
+
+    var span = trace.begin("registry.index", keyword);
+    const lookup = index.lookup(allocator, try ctx.libPath(), json_stat, keyword);
+    span.end();
+    if (lookup) |found| {
+        const entry = found orelse return null;
+        defer entry.deinit(allocator);
+        return try Package.init(allocator, entry.name, entry.path, entry.keyword, "", entry.global);
+    } else |err| switch (err) {
+        error.IndexStale => {},
+        else => return err,
     }
 
-    // Add new package (assuming package is already properly allocated)
-    new_packages[new_packages.len - 1] = package;
+    // a read-only install can still dispatch, it just keeps scanning packages.json
+    refresh_index(allocator, ctx) catch {};
+    return parse_package_info(allocator, ctx, keyword);
+}
 
-    // Create new PackageFile with updated packages
-    const new_package_file = PackageFile{ .package = new_packages };
+// flips the global flag of a registered package
+fn set_package_global(allocator: std.mem.Allocator, ctx: *Context, keyword: []const u8, global: bool) !void {
+    const registry_lock = try lock_registry(allocator, ctx);
+    defer registry_lock.close();
 
-    // Convert to JSON string
-    var string = std.ArrayList(u8).init(allocator);
-    defer string.deinit();
-    try std.json.stringify(new_package_file, .{}, string.writer());
+    var reader = try registry.Reader.init(allocator, try ctx.registryFile());
+    defer reader.deinit();
+    var writer = try registry.Writer.init(allocator, ctx);
+    defer writer.deinit();
 
-    // Write back to file
-    try file.seekTo(0);
-    try file.writeAll(string.items);
-    try file.setEndPos(string.items.len);
+    while (try reader.next()) |pkg| {
+        var entry = pkg;
+        if (std.mem.eql(u8, entry.keyword, keyword)) {
+            entry.global = global;
+        }
+        try writer.add(entry);
+    }
+    try writer.finish();
 }
 
-fn remove_package_info(allocator: std.mem.Allocator, package: Package) !void {
-    // Get executable directory path
-    var exe_dir_buf: [std.fs.max_path_bytes]u8 = undefined;
-    const exe_dir = try std.fs.selfExeDirPath(&exe_dir_buf);
-    
+fn remove_package_info(allocator: std.mem.Allocator, ctx: *Context, package: Package) !void {
     // Update packages.json
-    try removeFromPackagesJson(allocator, exe_dir, package);
+    try removeFromPackagesJson(allocator, ctx, package);
     
     // Remove associated files
-    try removePackageFiles(allocator, exe_dir, package);
+    try removePackageFiles(allocator, try ctx.exeDir(), package);
 }
 
-fn removeFromPackagesJson(allocator: std.mem.Allocator, exe_dir: []const u8, package: Package) !void {
-    const packages_path = try std.fs.path.join(allocator, &[_][]const u8{exe_dir, "..", "lib", "packages.json"});
-    defer allocator.free(packages_path);
-    
-    // Read and parse existing file
-    const file = try std.fs.cwd().openFile(packages_path, .{ .mode = .read_write });
-    defer file.close();
-    
-    const content = try file.readToEndAlloc(allocator, std.math.maxInt(usize));
-    defer allocator.free(content);
-
-    const parsed = try std.json.parseFromSlice(PackageFile, allocator, content, .{});
-    defer parsed.deinit();
+fn removeFromPackagesJson(allocator: std.mem.Allocator, ctx: *Context, package: Package) !void {
+    const registry_lock = try lock_registry(allocator, ctx);
+    defer registry_lock.close();
 
-    // Create filtered package list
-    var new_packages = try allocator.alloc(Package, parsed.value.package.len - 1);
-    defer {
-        for (new_packages) |*pkg| pkg.deinit(allocator);
-        allocator.free(new_packages);
-    }
+    var reader = try registry.Reader.init(allocator, try ctx.registryFile());
+    defer reader.deinit();
+    var writer = try registry.Writer.init(allocator, ctx);
+    defer writer.deinit();
 
     // Copy all packages except the one being removed
-    var new_index: usize = 0;
-    for (parsed.value.package) |existing_package| {
-        if (!std.mem.eql(u8, existing_package.keyword, package.keyword)) {
-            new_packages[new_index] = try Package.init(
-                allocator,
-                existing_package.name,
-                existing_package.path,
-                existing_package.keyword,
-                existing_package.description,
-                existing_package.global
-            );
-            new_index += 1;
+    var removed: usize = 0;
+    while (try reader.next()) |pkg| {
+        if (std.mem.eql(u8, pkg.keyword, package.keyword)) {
+            removed += 1;
+            continue;
         }
+        try writer.add(pkg);
+    }
+
+    // another process removed it between our lookup and taking the lock
+    if (removed == 0) {
+        return error.PackageNotFound;
     }
 
     // Write updated package list back to file
-    const new_package_file = PackageFile{ .package = new_packages };
-    var string = std.ArrayList(u8).init(allocator);
-    defer string.deinit();
-    
-    try std.json.stringify(new_package_file, .{}, string.writer());
-    try file.seekTo(0);
-    try file.writeAll(string.items);
-    try file.setEndPos(string.items.len);
+    try writer.finish();
 }
 
 fn removePackageFiles(allocator: std.mem.Allocator, exe_dir: []const u8, package: Package) !void {
-    // Remove global batch file if needed
+    // Remove the global shim if needed
     if (package.global) {
-        const batch_path = try std.fs.path.join(allocator, &[_][]const u8{
-            exe_dir, 
-            "..", 
-            "bin", 
-            try std.fmt.allocPrint(allocator, "{s}.cmd", .{package.keyword})
-        });
-        defer allocator.free(batch_path);
-        
-        std.fs.deleteFileAbsolute(batch_path) catch |err| {
-            std.debug.print("Warning: Could not delete batch file: {any}\n", .{err});
+        removeGlobalScript(allocator, exe_dir, package.keyword) catch |err| {
+            std.debug.print("Warning: Could not delete global script: {any}\n", .{err});
         };
     }
 
@@ -252,127 +199,47 @@ fn removePackageFiles(allocator: std.mem.Allocator, exe_dir: []const u8, package
     std.fs.deleteTreeAbsolute(lib_path) catch |err| {
         std.debug.print("Warning: Could not delete package directory: {any}\n", .{err});
     };
+
+    const manifest_path = try package_manifest_path(allocator, exe_dir, package.name);
+    defer allocator.free(manifest_path);
+    std.fs.cwd().deleteFile(manifest_path) catch |err| switch (err) {
+        error.FileNotFound => {},
+        else => std.debug.print("Warning: Could not delete package manifest: {any}\n", .{err}),
+    };
 }
 
-fn get_packages(allocator: std.mem.Allocator) ![][]const u8 {
+// prints every registered package in a single pass over packages.json
+fn list_packages(allocator: std.mem.Allocator, ctx: *Context, verbose: bool) !void {
     std.debug.print("Getting packages...\n", .{});
-    
-    // Create buffer for executable path
-    var exe_dir_buf: [std.fs.max_path_bytes]u8 = undefined;
-    const exe_dir = try std.fs.selfExeDirPath(&exe_dir_buf);
-    
-    const packages_path = try std.fs.path.join(allocator, &[_][]const u8{exe_dir, "..", "lib", "packages.json"});
-    defer allocator.free(packages_path);
-    
-    const file = try std.fs.cwd().openFile(packages_path, .{});
-    defer file.close();
-    
-    const content = try file.readToEndAlloc(allocator, std.math.maxInt(usize));
-    defer allocator.free(content);
-
-    // Parse the JSON content
-    const parsed = try std.json.parseFromSlice(
-        PackageFile,
-        allocator,
-        content,
-        .{},
-    );
-    defer parsed.deinit();
-    
-    // Access the parsed data through the package field
-    const packages = parsed.value.package;
-    var keywords = try allocator.alloc([]const u8, packages.len);
-    errdefer {
-        for (keywords) |keyword| {
-            allocator.free(keyword);
-        }
-        allocator.free(keywords);
-    }
 
-    // Get keywords from Package objects using parse_package_info
-    for (packages, 0..) |package, i| {
-        if (try parse_package_info(allocator, package.keyword)) |pkg| {
-            defer pkg.deinit(allocator);
-            keywords[i] = try allocator.dupe(u8, pkg.keyword);
+    var reader = try registry.Reader.init(allocator, try ctx.registryFile());
+    defer reader.deinit();
+
+    // one buffered write instead of a locked, unbuffered print per package
+    var bw = std.io.bufferedWriter(std.io.getStdErr().writer());
+    const writer = bw.writer();
+
+    if (verbose) {
+        try writer.print("Available packages with descriptions:\n", .{});
+        while (try reader.next()) |pkg| {
+            try writer.print("\n({s}\\{s}) {s} \nGlobal: {}\nDescription: {s}\n", .{
+                pkg.name, 
+                pkg.path,
+                pkg.keyword, 
+                pkg.global,
+                pkg.description
+            });
         }
-    }
-    
-    return keywords;
-}
-
-fn copyPackageFiles(allocator: std.mem.Allocator, source_path: []const u8, dest_dir: []const u8) !void {
-    // Create the destination directory if it doesn't exist
-    try std.fs.cwd().makePath(dest_dir);
-
-    var source_dir = try std.fs.cwd().openDir(source_path, .{ .iterate = true });
-    defer source_dir.close();
-
-    var walker = try source_dir.walk(allocator);
-    defer walker.deinit();
-
-    while (try walker.next()) |entry| {
-        const source_file_path = try std.fs.path.join(allocator, &[_][]const u8{ source_path, entry.path });
-        defer allocator.free(source_file_path);
-        
-        const dest_file_path = try std.fs.path.join(allocator, &[_][]const u8{ dest_dir, entry.path });
-        defer allocator.free(dest_file_path);
-
-        switch (entry.kind) {
-            .file => {
-                // Create parent directory if needed
-                if (std.fs.path.dirname(dest_file_path)) |parent| {
-                    std.fs.cwd().makePath(parent) catch |err| {
-                        std.debug.print("Warning: Could not create parent directory {s}: {any}\n", .{ parent, err });
-                        continue;
-                    };
-                }
-
-                // Copy the file
-                std.fs.copyFileAbsolute(source_file_path, dest_file_path, .{}) catch |err| {
-                    std.debug.print("Warning: Could not copy file {s}: {any}\n", .{ entry.path, err });
-                    continue;
-                };
-            },
-            .directory => {
-                std.fs.cwd().makePath(dest_file_path) catch |err| {
-                    std.debug.print("Warning: Could not create directory {s}: {any}\n", .{ dest_file_path, err });
-                    continue;
-                };
-            },
-            else => {
-                std.debug.print("Warning: Skipping unsupported file type for {s}\n", .{entry.path});
-                continue;
-            },
+    } else {
+        while (try reader.next()) |pkg| {
+            try writer.print("Available package: {s}\n", .{pkg.keyword});
         }
     }
+    try bw.flush();
 }
 
-fn findExecutables(allocator: std.mem.Allocator, dir: std.fs.Dir, package_path: []const u8) !std.ArrayList([]const u8) {
-    var exe_paths = std.ArrayList([]const u8).init(allocator);
-    errdefer {
-        for (exe_paths.items) |path| {
-            allocator.free(path);
-        }
-        exe_paths.deinit();
-    }
-
-    var walker = try dir.walk(allocator);
-    defer walker.deinit();
-
-    while (try walker.next()) |entry| {
-        if (entry.kind == .file) {
-            const full_path = try std.fs.path.join(allocator, &[_][]const u8{ package_path, entry.path });
-            defer allocator.free(full_path);
-            
-            if (std.mem.endsWith(u8, entry.path, ".exe") or 
-                std.mem.endsWith(u8, entry.path, ".sh") or 
-                !std.mem.containsAtLeast(u8, entry.path, 1, ".")) {
-                try exe_paths.append(try allocator.dupe(u8, entry.path));
-            }
-        }
-    }
-
-    return exe_paths;
+fn copyPackageFiles(allocator: std.mem.Allocator, source_path: []const u8, dest_dir: []const u8) !void {
+    try copy.copyTree(allocator, source_path, dest_dir, .{ .skip_errors = true });
 }
 
 fn selectExecutable(exe_paths: std.ArrayList([]const u8)) ![]const u8 {
@@ -407,32 +274,113 @@ fn selectExecutable(exe_paths: std.ArrayList([]const u8)) ![]const u8 {
     }
 }
 
-fn createGlobalScript(allocator: std.mem.Allocator, exe_dir: []const u8, keyword: []const u8, package_name: []const u8, exe_path: []const u8) !void {
-    const script_path = try std.fs.path.join(allocator, &[_][]const u8{
-        exe_dir, "..", "bin", 
+// global packages get a shim in bin/, which is on the PATH, that starts the executable
+// directly without going through popaman
+//
+// on windows the shim is bin/<keyword>.cmd. elsewhere it is bin/<keyword>, either a
+// symlink to the executable or, with POPAMAN_SHIM=script, a shell script that execs it
+const ShimMode = enum { symlink, script };
+
+fn shimModeFromEnv() ShimMode {
+    var buf: [64]u8 = undefined;
+    var fba = std.heap.FixedBufferAllocator.init(&buf);
+    const value = std.process.getEnvVarOwned(fba.allocator(), "POPAMAN_SHIM") catch return .symlink;
+    return std.meta.stringToEnum(ShimMode, value) orelse .symlink;
+}
+
+fn globalScriptPath(allocator: std.mem.Allocator, exe_dir: []const u8, keyword: []const u8) ![]const u8 {
+    const file_name = if (builtin.os.tag == .windows)
         try std.fmt.allocPrint(allocator, "{s}.cmd", .{keyword})
-    });
+    else
+        try allocator.dupe(u8, keyword);
+    defer allocator.free(file_name);
+    return std.fs.path.join(allocator, &[_][]const u8{ exe_dir, "..", "bin", file_name });
+}
+
+fn createGlobalScript(allocator: std.mem.Allocator, exe_dir: []const u8, keyword: []const u8, package_name: []const u8, exe_path: []const u8) !void {
+    const script_path = try globalScriptPath(allocator, exe_dir, keyword);
     defer allocator.free(script_path);
 
     // For linked packages, use the path directly from package.json
-    const script_content = if (std.mem.startsWith(u8, package_name, "link@")) 
-        try std.fmt.allocPrint(allocator,
-            \\@echo off
-            \\set "EXE_PATH={s}"
-            \\"%EXE_PATH%" %*
-            \\
-        , .{exe_path})  // Use the full path from package.json
-        else try std.fmt.allocPrint(allocator,
-            \\@echo off
-            \\set "EXE_PATH=%~dp0..\lib\{s}\{s}"
-            \\"%EXE_PATH%" %*
-            \\
-        , .{ package_name, exe_path });
-    defer allocator.free(script_content);
-
-    const script_file = try std.fs.cwd().createFile(script_path, .{});
-    defer script_file.close();
-    try script_file.writeAll(script_content);
+    const is_link = std.mem.startsWith(u8, package_name, "link@");
+
+    if (builtin.os.tag == .windows) {
+        const script_content = if (is_link)
+            try std.fmt.allocPrint(allocator,
+                \\@echo off
+                \\set "EXE_PATH={s}"
+                \\"%EXE_PATH%" %*
+                \\
+            , .{exe_path})  // Use the full path from package.json
+            else try std.fmt.allocPrint(allocator,
+                \\@echo off
+                \\set "EXE_PATH=%~dp0..\lib\{s}\{s}"
+                \\"%EXE_PATH%" %*
+                \\
+            , .{ package_name, exe_path });
+        defer allocator.free(script_content);
+
+        const script_file = try std.fs.cwd().createFile(script_path, .{});
+        defer script_file.close();
+        try script_file.writeAll(script_content);
+        return;
+    }
+
+    // bin/popaman is popaman itself
+    if (std.mem.eql(u8, keyword, "popaman")) {
+        std.debug.print("The keyword popaman cannot be made global\n", .{});
+        return error.ReservedKeyword;
+    }
+
+    // relative for installed packages so the root can be moved as a whole
+    const target = if (is_link)
+        try allocator.dupe(u8, exe_path)
+    else
+        try std.fs.path.join(allocator, &[_][]const u8{ "..", "lib", package_name, exe_path });
+    defer allocator.free(target);
+
+    // a shim left over from an earlier globalize of the same keyword is replaced
+    std.fs.cwd().deleteFile(script_path) catch |err| switch (err) {
+        error.FileNotFound => {},
+        else => return err,
+    };
+
+    switch (shimModeFromEnv()) {
+        .symlink => try std.fs.cwd().symLink(target, script_path, .{}),
+        .script => {
+            const bin_dir = std.fs.path.dirname(script_path).?;
+            const absolute = try std.fs.path.resolve(allocator, &[_][]const u8{ bin_dir, target });
+            defer allocator.free(absolute);
+
+            // single quotes keep the shell from expanding anything in the path
+            var content = std.ArrayList(u8).init(allocator);
+            defer content.deinit();
+            try content.appendSlice("#!/bin/sh\nexec '");
+            for (absolute) |c| {
+                if (c == '\'') try content.appendSlice("'\\''") else try content.append(c);
+            }
+            try content.appendSlice("' \"$@\"\n");
+
+            const script_file = try std.fs.cwd().createFile(script_path, .{ .mode = 0o755 });
+            defer script_file.close();
+            try script_file.writeAll(content.items);
+        },
+    }
+}
+
+// deletes the shim of a global package, along with a .cmd shim from older versions
+fn removeGlobalScript(allocator: std.mem.Allocator, exe_dir: []const u8, keyword: []const u8) !void {
+    if (builtin.os.tag != .windows) {
+        const legacy_name = try std.fmt.allocPrint(allocator, "{s}.cmd", .{keyword});
+        defer allocator.free(legacy_name);
+        const legacy_path = try std.fs.path.join(allocator, &[_][]const u8{ exe_dir, "..", "bin", legacy_name });
+        defer allocator.free(legacy_path);
+        std.fs.cwd().deleteFile(legacy_path) catch {};
+    }
+
+    const script_path = try globalScriptPath(allocator, exe_dir, keyword);
+    defer allocator.free(script_path);
+    try std.fs.cwd().deleteFile(script_path);
 }
 
 fn determine_if_local_dir(package_path: []const u8) !PackageSource {
@@ -452,13 +400,11 @@ fn determine_source_type(package_path: []const u8) !PackageSource {
         std.debug.print("Package is a url\n", .{});
         return PackageSource.URL;
     }
-    else if (std.mem.endsWith(u8, package_path, ".7z") or 
-             std.mem.endsWith(u8, package_path, ".zip")) {
+    else if (archive.formatOf(package_path) != null) {
         return PackageSource.Compressed;
     }
     //to be added later
-    else if (std.mem.endsWith(u8, package_path, ".tar") or 
-             std.mem.endsWith(u8, package_path, ".gz") or 
+    else if (std.mem.endsWith(u8, package_path, ".gz") or 
              std.mem.endsWith(u8, package_path, ".rar")) {
         return PackageSource.Unknown;
     }
@@ -488,20 +434,18 @@ fn determine_source_type(package_path: []const u8) !PackageSource {
     }
 }
 
-fn install_local_dir(allocator: std.mem.Allocator, package_path: []const u8, is_global: bool) !void {
-    // Open and verify package directory
-    var dir = std.fs.cwd().openDir(package_path, .{ .iterate = true }) catch |err| {
-        if (err == error.NotDir or err == error.FileNotFound) {
-            std.debug.print("Package directory does not exist: {s}\n", .{package_path});
-            return;
-        }
-        std.debug.print("Error opening directory: {any}\n", .{err});
-        return err;
-    };
-    defer dir.close();
+// what the user picked for a package: the executable to run and how to register it
+const PackageChoice = struct {
+    exe: []const u8,
+    keyword: []const u8,
+    description: []const u8,
+};
 
+// asks for the executable, keyword and description of the package in dir
+// returns null when the package has no executables to choose from
+fn prompt_package(allocator: std.mem.Allocator, dir: std.fs.Dir, package_path: []const u8) !?PackageChoice {
     // Find executables
-    var exe_paths = try findExecutables(allocator, dir, package_path);
+    var exe_paths = try discover.findExecutables(allocator, dir);
     defer {
         for (exe_paths.items) |path| {
             allocator.free(path);
@@ -513,12 +457,14 @@ fn install_local_dir(allocator: std.mem.Allocator, package_path: []const u8, is_
     const selected_exe = selectExecutable(exe_paths) catch |err| {
         switch (err) {
             error.NoExecutablesFound => {
-                std.debug.print("No executable files found in the package\n", .{});
-                return;
+                std.debug.print("No executable files found in {s}\n", .{package_path});
+                return null;
             },
             else => return err,
         }
     };
+    const exe_copy = try allocator.dupe(u8, selected_exe);
+    errdefer allocator.free(exe_copy);
 
     // Get package metadata
     var keyword_copy: []u8 = undefined;
@@ -532,134 +478,386 @@ fn install_local_dir(allocator: std.mem.Allocator, package_path: []const u8, is_
         keyword_copy = try allocator.dupe(u8, keyword);
         break;
     }
-    defer allocator.free(keyword_copy);
+    errdefer allocator.free(keyword_copy);
 
     std.debug.print("Enter the description for the package: ", .{});
     const description = try getline();
     const desc_copy = try allocator.dupe(u8, description);
-    defer allocator.free(desc_copy);
 
-    var exe_dir_buf: [std.fs.max_path_bytes]u8 = undefined;
-    const exe_dir = try std.fs.selfExeDirPath(&exe_dir_buf);
+    return PackageChoice{
+        .exe = exe_copy,
+        .keyword = keyword_copy,
+        .description = desc_copy,
+    };
+}
+
+fn install_local_dir(allocator: std.mem.Allocator, ctx: *Context, staged: StagedPackage, is_global: bool) !void {
+    const package_path = staged.dir;
+    // Open and verify package directory
+    var dir = std.fs.cwd().openDir(package_path, .{ .iterate = true }) catch |err| {
+        if (err == error.NotDir or err == error.FileNotFound) {
+            std.debug.print("Package directory does not exist: {s}\n", .{package_path});
+            return;
+        }
+        std.debug.print("Error opening directory: {any}\n", .{err});
+        return err;
+    };
+    defer dir.close();
+
+    const choice = try prompt_package(allocator, dir, package_path) orelse return;
+
+    // a keyword names one directory in lib/, see reject_duplicate_keywords
+    if (try parse_package_info(allocator, ctx, choice.keyword) != null) {
+        std.debug.print("Keyword {s} is already registered, remove it first\n", .{choice.keyword});
+        return error.KeywordTaken;
+    }
+
+    const exe_dir = try ctx.exeDir();
     
     // Create the destination path in the lib directory using the keyword
-    const lib_path = try std.fs.path.join(allocator, &[_][]const u8{ exe_dir, "..", "lib", keyword_copy });
+    const lib_path = try std.fs.path.join(allocator, &[_][]const u8{ exe_dir, "..", "lib", choice.keyword });
     defer allocator.free(lib_path);
 
-    // Copy all package files to the lib directory
+    const restaged = try restage_over(allocator, ctx, staged, lib_path);
+    defer if (restaged) |fresh| fresh.cleanup();
+
+    // Move or copy all package files to the lib directory
     std.debug.print("Copying package files to {s}...\n", .{lib_path});
-    try copyPackageFiles(allocator, package_path, lib_path);
+    try place_package(allocator, exe_dir, restaged orelse staged, lib_path);
     
     if (is_global) {
         // Create the command script only if global
-        try createGlobalScript(allocator, exe_dir, keyword_copy, keyword_copy, selected_exe);
+        try createGlobalScript(allocator, exe_dir, choice.keyword, choice.keyword, choice.exe);
     }
 
     // Create and save package metadata
     const new_package = Package{
-        .name = try allocator.dupe(u8, keyword_copy),
-        .path = try allocator.dupe(u8, selected_exe),
-        .keyword = keyword_copy,
-        .description = desc_copy,
+        .name = choice.keyword,
+        .path = choice.exe,
+        .keyword = choice.keyword,
+        .description = choice.description,
         .global = is_global,
     };
-    try add_package_info(allocator, new_package);
+    try add_package_info(allocator, ctx, new_package);
 }
 
-fn download_package(allocator: std.mem.Allocator, package_path: []const u8) !void {
-    // Create a temporary directory for downloads if it doesn't exist
-    var exe_dir_buf: [std.fs.max_path_bytes]u8 = undefined;
-    const exe_dir = try std.fs.selfExeDirPath(&exe_dir_buf);
-    
-    const temp_dir = try std.fs.path.join(allocator, &[_][]const u8{ exe_dir, "..", "temp" });
-    defer allocator.free(temp_dir);
-    
-    try std.fs.cwd().makePath(temp_dir);
+// a package source laid out as a plain directory that install_local_dir can read
+const StagedPackage = struct {
+    // directory holding the package files
+    dir: []const u8,
+    // temporary directory to delete after installing, null when dir is not ours to move or
+    // delete: the source itself, the download cache or an installed package
+    stage_dir: ?[]const u8,
+    // content hash of the archive that was extracted into dir, set when the cache should
+    // learn where the extraction ends up, see place_package
+    cache_hash: ?cache_mod.Hash = null,
+    // the archive dir was installed from, set when dir is that installed package standing
+    // in for the extraction, see restage_over
+    archive: ?Archive = null,
+
+    const Archive = struct {
+        hash: cache_mod.Hash,
+        path: []const u8,
+    };
 
-    // Extract filename from URL
-    const url_basename = std.fs.path.basename(package_path);
-    const output_path = try std.fs.path.join(allocator, &[_][]const u8{ temp_dir, url_basename });
-    defer allocator.free(output_path);
+    fn cleanup(self: StagedPackage) void {
+        if (self.stage_dir) |stage_dir| {
+            std.fs.deleteTreeAbsolute(stage_dir) catch |err| {
+                std.debug.print("Warning: Could not delete temporary directory: {any}\n", .{err});
+            };
+        }
+    }
+};
 
-    // Prepare curl command
-    const args = [_][]const u8{
-        "curl",
-        "-L", // Follow redirects
-        "-o",
-        output_path,
-        package_path,
+// puts the staged files at lib_path, moving a private staging directory there with one
+// rename so extracted and downloaded files are written only once
+// sources that must stay in place (a local directory, the download cache, an installed
+// package) are copied, as is anything rename refuses, such as an existing lib_path or
+// another filesystem
+// the placed files are then recorded in manifest/<name>.json for verify, and an archive
+// extracted on a cache miss is remembered in the cache as installed at lib_path
+fn place_package(allocator: std.mem.Allocator, exe_dir: []const u8, staged: StagedPackage, lib_path: []const u8) !void {
+    placed: {
+        if (staged.stage_dir != null) {
+            if (std.fs.cwd().rename(staged.dir, lib_path)) {
+                break :placed;
+            } else |_| {}
+        }
+        try copyPackageFiles(allocator, staged.dir, lib_path);
+    }
+
+    const name = std.fs.path.basename(lib_path);
+    const manifest_path = try package_manifest_path(allocator, exe_dir, name);
+    defer allocator.free(manifest_path);
+    verify.record(allocator, .{ .name = name, .lib_path = lib_path, .manifest_path = manifest_path }) catch |err| {
+        std.debug.print("Warning: Could not record manifest of {s}: {any}\n", .{ name, err });
+        return;
     };
+    if (staged.cache_hash) |hash| remember_extraction(allocator, exe_dir, hash, name, manifest_path);
+}
 
-    // Execute curl
-    var child = std.process.Child.init(&args, allocator);
-    const term = try child.spawnAndWait();
-    
-    if (term != .Exited or term.Exited != 0) {
-        std.debug.print("Failed to download package: {s}\n", .{package_path});
-        return error.DownloadFailed;
+// lets the next install of the same archive copy lib/<name> instead of extracting it again
+fn remember_extraction(allocator: std.mem.Allocator, exe_dir: []const u8, hash: cache_mod.Hash, name: []const u8, manifest_path: []const u8) void {
+    const cache = Cache.open(allocator, exe_dir) catch return orelse return;
+    defer cache.deinit(allocator);
+    cache.storeInstalled(allocator, hash, name, manifest_path) catch |err| {
+        std.debug.print("Warning: Could not add {s} to the download cache: {any}\n", .{ name, err });
+    };
+}
+
+fn package_manifest_path(allocator: std.mem.Allocator, exe_dir: []const u8, name: []const u8) ![]const u8 {
+    const file_name = try std.fmt.allocPrint(allocator, "{s}.json", .{name});
+    defer allocator.free(file_name);
+    return std.fs.path.join(allocator, &[_][]const u8{ exe_dir, "..", "manifest", file_name });
+}
+
+// creates temp/<prefix>-<random hex> so concurrent installs never share a staging directory
+fn make_stage_dir(allocator: std.mem.Allocator, exe_dir: []const u8, prefix: []const u8) ![]const u8 {
+    var random_bytes: [8]u8 = undefined;
+    std.crypto.random.bytes(&random_bytes);
+    const dir_name = try std.fmt.allocPrint(allocator, "{s}-{s}", .{ prefix, std.fmt.fmtSliceHexLower(&random_bytes) });
+    defer allocator.free(dir_name);
+
+    const stage_dir = try std.fs.path.join(allocator, &[_][]const u8{ exe_dir, "..", "temp", dir_name });
+    try std.fs.cwd().makePath(stage_dir);
+    return stage_dir;
+}
+
+// turns any supported source into a directory of package files, downloading,
+// copying or extracting into a private staging directory as needed
+// downloads come from the cache when it is enabled, and archives from an earlier,
+// untouched install of the same archive, in which case the returned directory is not
+// ours and must not be modified
+fn stage_package(allocator: std.mem.Allocator, ctx: *Context, package_path: []const u8) !StagedPackage {
+    const exe_dir = try ctx.exeDir();
+    //make an enum for exe, dir, and compressed
+    var package_source: PackageSource = try determine_if_local_dir(package_path);
+    std.debug.print("Package source: {}\n", .{package_source});
+    if (package_source == PackageSource.Dir) {
+        return .{ .dir = package_path, .stage_dir = null };
+    }
+
+    const cache = try Cache.open(allocator, exe_dir);
+    defer if (cache) |c| c.deinit(allocator);
+
+    package_source = try determine_source_type(package_path);
+    std.debug.print("Package source: {}\n", .{package_source});
+    switch (package_source) {
+        .URL => {
+            if (cache) |c| {
+                if (try c.lookupUrl(allocator, package_path)) |hash| {
+                    std.debug.print("Using cached download of {s}\n", .{package_path});
+                    return stage_cached_download(allocator, ctx, c, hash);
+                }
+            }
+
+            const stage_dir = try make_stage_dir(allocator, exe_dir, "download");
+            errdefer (StagedPackage{ .dir = stage_dir, .stage_dir = stage_dir }).cleanup();
+
+            const output_path = try download_package(allocator, exe_dir, package_path, stage_dir);
+            defer allocator.free(output_path);
+
+            if (cache) |c| {
+                const hash = try c.storeDownload(allocator, package_path, output_path);
+                // the download moved into the cache, leaving the staging directory empty
+                (StagedPackage{ .dir = stage_dir, .stage_dir = stage_dir }).cleanup();
+                return stage_cached_download(allocator, ctx, c, hash);
+            }
+
+            // Now that we have the file, determine its type and stage it
+            switch (try determine_source_type(output_path)) {
+                // the download is the only file in the staging directory
+                .Exe => return .{ .dir = stage_dir, .stage_dir = stage_dir },
+                .Compressed => {
+                    const extract_dir = try std.fs.path.join(allocator, &[_][]const u8{ stage_dir, "extract" });
+                    try std.fs.cwd().makePath(extract_dir);
+                    try extract_archive(allocator, ctx, output_path, extract_dir);
+                    return .{ .dir = extract_dir, .stage_dir = stage_dir };
+                },
+                else => {
+                    std.debug.print("Package is not a supported format\n", .{});
+                    return error.UnsupportedSource;
+                },
+            }
+        },
+        .Exe => {
+            const stage_dir = try make_stage_dir(allocator, exe_dir, "exe");
+            errdefer (StagedPackage{ .dir = stage_dir, .stage_dir = stage_dir }).cleanup();
+
+            // Copy the exe to the staging directory
+            const dest_path = try std.fs.path.join(allocator, &[_][]const u8{ stage_dir, std.fs.path.basename(package_path) });
+            defer allocator.free(dest_path);
+            try std.fs.cwd().copyFile(package_path, std.fs.cwd(), dest_path, .{});
+            return .{ .dir = stage_dir, .stage_dir = stage_dir };
+        },
+        .Compressed => {
+            if (cache) |c| {
+                return stage_cached_archive(allocator, ctx, c, try cache_mod.hashFile(package_path), package_path, null);
+            }
+
+            const stage_dir = try make_stage_dir(allocator, exe_dir, "extract");
+            errdefer (StagedPackage{ .dir = stage_dir, .stage_dir = stage_dir }).cleanup();
+
+            try extract_archive(allocator, ctx, package_path, stage_dir);
+            return .{ .dir = stage_dir, .stage_dir = stage_dir };
+        },
+        else => {
+            std.debug.print("Package source is not supported: {s}\n", .{package_path});
+            return error.UnsupportedSource;
+        },
     }
+}
 
-    // Now that we have the file, determine its type and install it
-    const source_type = try determine_source_type(output_path);
-    switch (source_type) {
-        .Exe => try install_exe(allocator, output_path, false),
-        .Compressed => try install_compressed(allocator, output_path, false),
+// stages a download that is already in the cache
+fn stage_cached_download(allocator: std.mem.Allocator, ctx: *Context, cache: Cache, hash: cache_mod.Hash) !StagedPackage {
+    const download_path = try cache.downloadPath(allocator, hash);
+    defer allocator.free(download_path);
+
+    switch (try determine_source_type(download_path)) {
+        .Exe => {
+            // curl does not set the executable bit, the copy into lib/ keeps whatever the cache has
+            if (builtin.os.tag != .windows) {
+                const file = try std.fs.cwd().openFile(download_path, .{});
+                defer file.close();
+                try file.chmod(0o755);
+            }
+            try cache.touch(allocator, hash, false);
+            return .{ .dir = try cache.downloadDir(allocator, hash), .stage_dir = null };
+        },
+        .Compressed => return stage_cached_archive(allocator, ctx, cache, hash, download_path, null),
         else => {
             std.debug.print("Package is not a supported format\n", .{});
-            return error.Unknown;
+            return error.UnsupportedSource;
         },
     }
-
-    // Clean up the temporary file
-    std.fs.deleteFileAbsolute(output_path) catch |err| {
-        std.debug.print("Warning: Could not delete temporary file: {any}\n", .{err});
-    };
 }
 
-fn install_exe(allocator: std.mem.Allocator, package_path: []const u8, is_global: bool) !void {
-    // Get executable directory path
-    var exe_dir_buf: [std.fs.max_path_bytes]u8 = undefined;
-    const exe_dir = try std.fs.selfExeDirPath(&exe_dir_buf);
+// stages an archive from a package it was installed as before, as long as that package
+// is exactly as it was placed. otherwise the archive is extracted into a staging
+// directory that place_package moves into lib/ and the cache then refers to
+// target is the lib/ directory the package goes to when that is known already. the package
+// installed there is never staged, it would be copied onto itself
+fn stage_cached_archive(allocator: std.mem.Allocator, ctx: *Context, cache: Cache, hash: cache_mod.Hash, archive_path: []const u8, target: ?[]const u8) !StagedPackage {
+    const exe_dir = try ctx.exeDir();
+    if (try find_installed_extraction(allocator, exe_dir, cache, hash, target)) |lib_path| {
+        std.debug.print("Using the extraction of {s} installed at {s}\n", .{ archive_path, lib_path });
+        try cache.touch(allocator, hash, false);
+        return .{
+            .dir = lib_path,
+            .stage_dir = null,
+            .archive = .{ .hash = hash, .path = try allocator.dupe(u8, archive_path) },
+        };
+    }
 
-    // Create a temporary directory for the exe
-    const temp_dir = try std.fs.path.join(allocator, &[_][]const u8{ exe_dir, "..", "temp", "exe_install" });
-    defer allocator.free(temp_dir);
+    const stage_dir = try make_stage_dir(allocator, exe_dir, "extract");
+    errdefer (StagedPackage{ .dir = stage_dir, .stage_dir = stage_dir }).cleanup();
 
-    // Create the temp directory if it doesn't exist
-    try std.fs.cwd().makePath(temp_dir);
-    defer std.fs.deleteTreeAbsolute(temp_dir) catch |err| {
-        std.debug.print("Warning: Could not delete temporary directory: {any}\n", .{err});
-    };
+    try extract_archive(allocator, ctx, archive_path, stage_dir);
+    return .{ .dir = stage_dir, .stage_dir = stage_dir, .cache_hash = hash };
+}
+
+// the first package other than target the archive with content hash was installed as that
+// has not changed since. references to packages that did change are dropped
+fn find_installed_extraction(allocator: std.mem.Allocator, exe_dir: []const u8, cache: Cache, hash: cache_mod.Hash, target: ?[]const u8) !?[]const u8 {
+    const manifests = try cache.installed(allocator, hash);
+    defer {
+        for (manifests) |path| allocator.free(path);
+        allocator.free(manifests);
+    }
+    for (manifests) |manifest_path| {
+        const file_name = std.fs.path.basename(manifest_path);
+        const name = file_name[0 .. file_name.len - ".json".len];
+        const lib_path = try std.fs.path.join(allocator, &[_][]const u8{ exe_dir, "..", "lib", name });
+        if (target) |target_path| {
+            if (try same_path(allocator, lib_path, target_path)) {
+                allocator.free(lib_path);
+                continue;
+            }
+        }
+        if (verify.unchanged(allocator, lib_path, manifest_path) catch false) return lib_path;
+        allocator.free(lib_path);
+        std.fs.cwd().deleteFile(manifest_path) catch {};
+    }
+    return null;
+}
 
-    // Copy the exe to the temp directory
-    const dest_path = try std.fs.path.join(allocator, &[_][]const u8{ temp_dir, std.fs.path.basename(package_path) });
-    defer allocator.free(dest_path);
+// a package staged from the package installed at lib_path cannot be placed there, the
+// copy would read what it overwrites. the archive is staged again without it, returning
+// null when staged can be placed as it is
+// the archive is still where staging found it, the cache is only trimmed after installing
+fn restage_over(allocator: std.mem.Allocator, ctx: *Context, staged: StagedPackage, lib_path: []const u8) !?StagedPackage {
+    const archive_source = staged.archive orelse return null;
+    if (!try same_path(allocator, staged.dir, lib_path)) return null;
+
+    const exe_dir = try ctx.exeDir();
+    const cache = try Cache.open(allocator, exe_dir) orelse return error.CacheDisabled;
+    defer cache.deinit(allocator);
+    return try stage_cached_archive(allocator, ctx, cache, archive_source.hash, archive_source.path, lib_path);
+}
 
-    try std.fs.copyFileAbsolute(package_path, dest_path, .{});
+fn same_path(allocator: std.mem.Allocator, a: []const u8, b: []const u8) !bool {
+    const resolved_a = try std.fs.path.resolve(allocator, &[_][]const u8{a});
+    defer allocator.free(resolved_a);
+    const resolved_b = try std.fs.path.resolve(allocator, &[_][]const u8{b});
+    defer allocator.free(resolved_b);
+    return std.mem.eql(u8, resolved_a, resolved_b);
+}
 
-    // Now install from the temp directory, which will handle getting the keyword and setting up the package
-    try install_local_dir(allocator, temp_dir, is_global);
+// trims the cache back under its size cap once an install no longer needs its entries
+fn evict_cache(allocator: std.mem.Allocator, exe_dir: []const u8) void {
+    const cache = Cache.open(allocator, exe_dir) catch return orelse return;
+    defer cache.deinit(allocator);
+    cache.evict(allocator) catch |err| {
+        std.debug.print("Warning: Could not trim the download cache: {any}\n", .{err});
+    };
 }
 
-fn install_compressed(allocator: std.mem.Allocator, package_path: []const u8, is_global: bool) !void {
-    // Get executable directory path
-    var exe_dir_buf: [std.fs.max_path_bytes]u8 = undefined;
-    const exe_dir = try std.fs.selfExeDirPath(&exe_dir_buf);
-    
-    // Create a temporary extraction directory
-    const temp_dir = try std.fs.path.join(allocator, &[_][]const u8{ exe_dir, "..", "temp", "extract" });
+// downloads a url into dest_dir and returns the path of the downloaded file
+// partial downloads are kept in temp/ so an interrupted install can resume them
+fn download_package(allocator: std.mem.Allocator, exe_dir: []const u8, package_path: []const u8, dest_dir: []const u8) ![]const u8 {
+    // Extract filename from URL
+    const url_basename = std.fs.path.basename(package_path);
+    const output_path = try std.fs.path.join(allocator, &[_][]const u8{ dest_dir, url_basename });
+    errdefer allocator.free(output_path);
+
+    const temp_dir = try std.fs.path.join(allocator, &[_][]const u8{ exe_dir, "..", "temp" });
     defer allocator.free(temp_dir);
-    
-    try std.fs.cwd().makePath(temp_dir);
-    defer std.fs.deleteTreeAbsolute(temp_dir) catch |err| {
-        std.debug.print("Warning: Could not delete temporary directory: {any}\n", .{err});
-    };
+    var span = trace.begin("download", package_path);
+    try download.download(allocator, temp_dir, package_path, output_path);
+    if (trace.enabled()) {
+        span.bytes = if (std.fs.cwd().statFile(output_path)) |stat| stat.size else |_| null;
+    }
+    span.end();
+    return output_path;
+}
+
+// extracts an archive into dest_dir, zip archives and tarballs in process and
+// anything else with the bundled 7zr
+fn extract_archive(allocator: std.mem.Allocator, ctx: *Context, package_path: []const u8, dest_dir: []const u8) !void {
+    const format = archive.formatOf(package_path) orelse .seven_zip;
+    if (format.isNative(archive.modeFromEnv())) {
+        std.debug.print("Extracting {s} to {s}\n", .{ package_path, dest_dir });
+        var span = trace.begin("extract", package_path);
+        defer span.end();
+        if (trace.enabled()) {
+            span.bytes = if (std.fs.cwd().statFile(package_path)) |stat| stat.size else |_| null;
+        }
+
+        var dest = try std.fs.cwd().openDir(dest_dir, .{});
+        defer dest.close();
+        const count = archive.extract(allocator, package_path, dest, format) catch |err| {
+            std.debug.print("Could not extract {s}: {any}\n", .{ package_path, err });
+            return err;
+        };
+        span.count = count;
+        return;
+    }
 
     // Get absolute paths
     const abs_package_path = try std.fs.path.resolve(allocator, &[_][]const u8{package_path});
     defer allocator.free(abs_package_path);
     
-    const abs_temp_dir = try std.fs.path.resolve(allocator, &[_][]const u8{temp_dir});
+    const abs_temp_dir = try std.fs.path.resolve(allocator, &[_][]const u8{dest_dir});
     defer allocator.free(abs_temp_dir);
 
     // Debug prints
@@ -681,60 +879,380 @@ fn install_compressed(allocator: std.mem.Allocator, package_path: []const u8, is
     }
     std.debug.print("\n", .{});
 
+    var span = trace.begin("7zr", abs_package_path);
+    defer span.end();
+    if (trace.enabled()) {
+        span.bytes = if (std.fs.cwd().statFile(abs_package_path)) |stat| stat.size else |_| null;
+    }
+
     // Run 7zr through the package manager
-    try run_package(allocator, "7zr", &args);
+    try run_package(allocator, ctx, "7zr", &args);
+}
+
+fn install_package(allocator: std.mem.Allocator, ctx: *Context, package_path: []const u8, is_global: bool) !void {
+    const exe_dir = try ctx.exeDir();
 
-    // Now that we've extracted the files, install from the temp directory
-    try install_local_dir(allocator, abs_temp_dir, is_global);
+    // runs after staged.cleanup, once nothing reads from the cache anymore
+    defer evict_cache(allocator, exe_dir);
+    const staged = stage_package(allocator, ctx, package_path) catch |err| switch (err) {
+        error.UnsupportedSource => return,
+        else => return err,
+    };
+    defer staged.cleanup();
+
+    // Now that the files are laid out as a directory, install from it
+    try install_local_dir(allocator, ctx, staged, is_global);
 }
 
-fn install_package(allocator: std.mem.Allocator, package_path: []const u8, is_global: bool) !void {
-    //make an enum for exe, dir, and compressed
-    var package_source: PackageSource = try determine_if_local_dir(package_path); // Added try
-    std.debug.print("Package source: {}\n", .{package_source});
-    if(package_source == PackageSource.Unknown) {
-        package_source = try determine_source_type(package_path);
-        std.debug.print("Package source: {}\n", .{package_source});
-        if (package_source == PackageSource.URL ) {
-            try download_package(allocator, package_path);
+// one entry of an install manifest, see apply_manifest
+const ManifestEntry = struct {
+    source: []const u8,
+    keyword: []const u8,
+    // path of the executable inside the package, may be left out when there is only one
+    exe: ?[]const u8 = null,
+    description: []const u8 = "",
+    global: bool = false,
+};
+
+const Manifest = struct {
+    package: []ManifestEntry,
+};
+
+// one source of a batch install, each job gets its own arena so workers never share an allocator
+const BatchJob = struct {
+    arena: std.heap.ArenaAllocator,
+    ctx: *Context,
+    exe_dir: []const u8,
+    source: []const u8,
+    global: bool,
+    // answers taken from a manifest, the user is prompted when this is null
+    preset: ?ManifestEntry = null,
+    staged: ?StagedPackage = null,
+    choice: ?PackageChoice = null,
+    lib_path: []const u8 = "",
+    err: ?anyerror = null,
+
+    fn init(ctx: *Context, exe_dir: []const u8, source: []const u8, global: bool) BatchJob {
+        return .{
+            .arena = std.heap.ArenaAllocator.init(std.heap.page_allocator),
+            .ctx = ctx,
+            .exe_dir = exe_dir,
+            .source = source,
+            .global = global,
+        };
+    }
+
+    // the keyword the job installs under, once it is known and while the job has not failed
+    fn keyword(job: *const BatchJob) ?[]const u8 {
+        if (job.err != null) return null;
+        if (job.choice) |choice| return choice.keyword;
+        if (job.preset) |entry| return entry.keyword;
+        return null;
+    }
+
+    fn stage(job: *BatchJob) void {
+        // rejected before staging, see reject_duplicate_keywords
+        if (job.err != null) return;
+        job.staged = stage_package(job.arena.allocator(), job.ctx, job.source) catch |err| {
+            job.err = err;
+            return;
+        };
+    }
+
+    fn copy(job: *BatchJob) void {
+        // a package staged in place of its archive has no staging directory to clean up,
+        // so the one staged over it takes its place
+        const restaged = restage_over(job.arena.allocator(), job.ctx, job.staged.?, job.lib_path) catch |err| {
+            job.err = err;
+            return;
+        };
+        if (restaged) |fresh| job.staged = fresh;
+        place_package(job.arena.allocator(), job.exe_dir, job.staged.?, job.lib_path) catch |err| {
+            job.err = err;
+        };
+    }
+};
+
+// installs several sources at once, see run_batch
+fn install_batch(allocator: std.mem.Allocator, ctx: *Context, sources: []const []const u8, is_global: bool) !void {
+    const exe_dir = try ctx.exeDir();
+
+    const jobs = try allocator.alloc(BatchJob, sources.len);
+    defer allocator.free(jobs);
+    for (jobs, sources) |*job, source| {
+        job.* = BatchJob.init(ctx, exe_dir, source, is_global);
+    }
+    try run_batch(allocator, ctx, jobs);
+}
+
+// picks the executable named by a manifest entry without asking anything
+fn choose_from_manifest(allocator: std.mem.Allocator, dir: std.fs.Dir, package_path: []const u8, entry: ManifestEntry) !PackageChoice {
+    const exe = if (entry.exe) |exe| blk: {
+        const stat = dir.statFile(exe) catch |err| {
+            std.debug.print("Executable {s} not found in {s}: {any}\n", .{ exe, package_path, err });
+            return error.ExecutableNotFound;
+        };
+        if (stat.kind != .file) {
+            std.debug.print("Executable {s} is not a file\n", .{exe});
+            return error.ExecutableNotFound;
+        }
+        break :blk try allocator.dupe(u8, exe);
+    } else blk: {
+        var exe_paths = try discover.findExecutables(allocator, dir);
+        defer {
+            for (exe_paths.items) |path| {
+                allocator.free(path);
+            }
+            exe_paths.deinit();
         }
-        else if (package_source == PackageSource.Exe) {
-            try install_exe(allocator, package_path, is_global);
+        if (exe_paths.items.len != 1) {
+            std.debug.print("{d} executables found in {s}, set \"exe\" for {s}:\n", .{ exe_paths.items.len, package_path, entry.keyword });
+            for (exe_paths.items) |exe| {
+                std.debug.print("  {s}\n", .{exe});
+            }
+            return error.AmbiguousExecutable;
         }
-        else if (package_source == PackageSource.Compressed) {
-            try install_compressed(allocator, package_path, is_global);
+        break :blk try allocator.dupe(u8, exe_paths.items[0]);
+    };
+
+    return PackageChoice{
+        .exe = exe,
+        .keyword = try allocator.dupe(u8, entry.keyword),
+        .description = try allocator.dupe(u8, entry.description),
+    };
+}
+
+// a keyword names one directory in lib/ and one entry of packages.json, so a batch must
+// neither give one keyword to two of its packages nor take a keyword that is already
+// registered. the jobs that would are failed before anything of theirs is copied
+fn reject_duplicate_keywords(allocator: std.mem.Allocator, ctx: *Context, jobs: []BatchJob) !void {
+    const Use = struct { count: usize = 0, registered: bool = false, reported: bool = false };
+    var uses = std.StringHashMap(Use).init(allocator);
+    defer uses.deinit();
+    for (jobs) |*job| {
+        const keyword = job.keyword() orelse continue;
+        const use = try uses.getOrPutValue(keyword, .{});
+        use.value_ptr.count += 1;
+    }
+    if (uses.count() == 0) return;
+
+    {
+        var reader = try registry.Reader.init(allocator, try ctx.registryFile());
+        defer reader.deinit();
+        while (try reader.next()) |pkg| {
+            if (uses.getPtr(pkg.keyword)) |use| use.registered = true;
         }
-        return;
     }
-    try install_local_dir(allocator, package_path, is_global);
+
+    for (jobs) |*job| {
+        const keyword = job.keyword() orelse continue;
+        const use = uses.getPtr(keyword).?;
+        if (!use.registered and use.count == 1) continue;
+        if (!use.reported) {
+            if (use.registered) {
+                std.debug.print("Keyword {s} is already registered, remove it first\n", .{keyword});
+            } else {
+                std.debug.print("Keyword {s} is given to {d} packages of the batch\n", .{ keyword, use.count });
+            }
+            use.reported = true;
+        }
+        job.err = if (use.registered) error.KeywordTaken else error.DuplicateKeyword;
+    }
+}
+
+// downloads, extractions and copies run on a worker pool, prompts are asked one
+// package at a time, and packages.json is written once at the end
+// keywords are checked before staging where a manifest gives them, and again once
+// every prompt has been answered
+// run_batch owns the jobs: their staging directories and arenas are released before it returns
+fn run_batch(allocator: std.mem.Allocator, ctx: *Context, jobs: []BatchJob) !void {
+    const exe_dir = try ctx.exeDir();
+    defer evict_cache(allocator, exe_dir);
+    defer for (jobs) |*job| {
+        if (job.staged) |staged| staged.cleanup();
+        job.arena.deinit();
+    };
+
+    // the pool frees its closures from worker threads, so it gets a thread-safe allocator
+    var pool: std.Thread.Pool = undefined;
+    try pool.init(.{ .allocator = std.heap.page_allocator });
+    defer pool.deinit();
+
+    try reject_duplicate_keywords(allocator, ctx, jobs);
+
+    std.debug.print("Preparing {d} packages...\n", .{jobs.len});
+    {
+        var wait_group: std.Thread.WaitGroup = .{};
+        for (jobs) |*job| pool.spawnWg(&wait_group, BatchJob.stage, .{job});
+        pool.waitAndWork(&wait_group);
+    }
+
+    // prompts need the terminal, so they are asked one package at a time
+    for (jobs) |*job| {
+        const staged = job.staged orelse {
+            std.debug.print("Skipping {s}: {any}\n", .{ job.source, job.err.? });
+            continue;
+        };
+        const job_allocator = job.arena.allocator();
+
+        var dir = std.fs.cwd().openDir(staged.dir, .{ .iterate = true }) catch |err| {
+            job.err = err;
+            std.debug.print("Skipping {s}: {any}\n", .{ job.source, err });
+            continue;
+        };
+        defer dir.close();
+
+        if (job.preset) |entry| {
+            job.choice = choose_from_manifest(job_allocator, dir, staged.dir, entry) catch |err| {
+                job.err = err;
+                std.debug.print("Skipping {s}: {any}\n", .{ job.source, err });
+                continue;
+            };
+        } else {
+            std.debug.print("\nPackage: {s}\n", .{job.source});
+            job.choice = try prompt_package(job_allocator, dir, staged.dir) orelse continue;
+        }
+        job.lib_path = try std.fs.path.join(job_allocator, &[_][]const u8{ exe_dir, "..", "lib", job.choice.?.keyword });
+    }
+
+    try reject_duplicate_keywords(allocator, ctx, jobs);
+
+    std.debug.print("Copying package files...\n", .{});
+    {
+        var wait_group: std.Thread.WaitGroup = .{};
+        for (jobs) |*job| {
+            if (job.choice != null and job.err == null) pool.spawnWg(&wait_group, BatchJob.copy, .{job});
+        }
+        pool.waitAndWork(&wait_group);
+    }
+
+    var new_packages = std.ArrayList(Package).init(allocator);
+    defer new_packages.deinit();
+    for (jobs) |*job| {
+        const choice = job.choice orelse continue;
+        if (job.err) |err| {
+            std.debug.print("Failed to install {s}: {any}\n", .{ job.source, err });
+            continue;
+        }
+        if (job.global) {
+            try createGlobalScript(allocator, exe_dir, choice.keyword, choice.keyword, choice.exe);
+        }
+        try new_packages.append(.{
+            .name = choice.keyword,
+            .path = choice.exe,
+            .keyword = choice.keyword,
+            .description = choice.description,
+            .global = job.global,
+        });
+    }
+
+    // every package of the batch is registered with a single write of packages.json
+    if (new_packages.items.len > 0) {
+        try add_packages_info(allocator, ctx, new_packages.items);
+    }
+    std.debug.print("Installed {d} of {d} packages\n", .{ new_packages.items.len, jobs.len });
+    if (new_packages.items.len != jobs.len) {
+        return error.BatchInstallIncomplete;
+    }
+}
+
+// installs everything listed in a manifest without prompting
+// entries whose keyword is already registered with the same executable are skipped
+//
+// { "package": [ { "source": "tools/rg.zip", "keyword": "rg", "exe": "rg.exe",
+//                  "description": "ripgrep", "global": true } ] }
+//
+// relative sources are resolved against the directory of the manifest
+fn apply_manifest(allocator: std.mem.Allocator, ctx: *Context, manifest_path: []const u8) !void {
+    const exe_dir = try ctx.exeDir();
+
+    const manifest_content = std.fs.cwd().readFileAlloc(allocator, manifest_path, std.math.maxInt(usize)) catch |err| {
+        std.debug.print("Could not read manifest {s}: {any}\n", .{ manifest_path, err });
+        return err;
+    };
+    defer allocator.free(manifest_content);
+
+    const manifest = std.json.parseFromSlice(Manifest, allocator, manifest_content, .{ .ignore_unknown_fields = true }) catch |err| {
+        std.debug.print("Invalid manifest {s}: {any}\n", .{ manifest_path, err });
+        return err;
+    };
+    defer manifest.deinit();
+
+    // what the registry already holds for each manifest entry, found in one pass over it
+    const Registered = enum { no, same, different };
+    const registered = try allocator.alloc(Registered, manifest.value.package.len);
+    defer allocator.free(registered);
+    @memset(registered, .no);
+    {
+        var reader = try registry.Reader.init(allocator, try ctx.registryFile());
+        defer reader.deinit();
+        while (try reader.next()) |pkg| {
+            for (manifest.value.package, registered) |entry, *status| {
+                if (status.* != .no or !std.mem.eql(u8, pkg.keyword, entry.keyword)) continue;
+                const same_exe = if (entry.exe) |exe| std.mem.eql(u8, pkg.path, exe) else true;
+                status.* = if (same_exe and pkg.global == entry.global) .same else .different;
+            }
+        }
+    }
+
+    const manifest_dir = std.fs.path.dirname(manifest_path) orelse ".";
+
+    var jobs = std.ArrayList(BatchJob).init(allocator);
+    defer jobs.deinit();
+    var conflicts: usize = 0;
+    for (manifest.value.package, registered) |entry, status| {
+        switch (status) {
+            .no => {},
+            .same => {
+                std.debug.print("Already installed: {s}\n", .{entry.keyword});
+                continue;
+            },
+            .different => {
+                std.debug.print("Keyword {s} is already registered with a different package, remove it first\n", .{entry.keyword});
+                conflicts += 1;
+                continue;
+            },
+        }
+
+        const is_url = std.mem.startsWith(u8, entry.source, "http://") or std.mem.startsWith(u8, entry.source, "https://");
+        const source = if (is_url or std.fs.path.isAbsolute(entry.source))
+            entry.source
+        else
+            try std.fs.path.join(allocator, &[_][]const u8{ manifest_dir, entry.source });
+
+        var job = BatchJob.init(ctx, exe_dir, source, entry.global);
+        job.preset = entry;
+        try jobs.append(job);
+    }
+
+    if (jobs.items.len > 0) {
+        try run_batch(allocator, ctx, jobs.items);
+    } else {
+        std.debug.print("Nothing to install\n", .{});
+    }
+    if (conflicts > 0) {
+        return error.ManifestConflict;
+    }
 }
 
-fn globalize_package(allocator: std.mem.Allocator, keyword: []const u8, is_add: bool) !void {
+fn globalize_package(allocator: std.mem.Allocator, ctx: *Context, keyword: []const u8, is_add: bool) !void {
     // Get package info
-    if (try parse_package_info(allocator, keyword)) |pkg| {
+    if (try parse_package_info(allocator, ctx, keyword)) |pkg| {
         defer pkg.deinit(allocator);
-        // Get executable directory path
-        var exe_dir_buf: [std.fs.max_path_bytes]u8 = undefined;
-        const exe_dir = try std.fs.selfExeDirPath(&exe_dir_buf);
+        const exe_dir = try ctx.exeDir();
 
         if (is_add) {
             // Create the batch file using the full path from package info
             try createGlobalScript(allocator, exe_dir, pkg.keyword, pkg.name, pkg.path);
+            try set_package_global(allocator, ctx, pkg.keyword, true);
             std.debug.print("Added global script for: {s}\n", .{pkg.keyword});
         } else {
-            // Remove the batch file
-            const batch_path = try std.fs.path.join(allocator, &[_][]const u8{
-                exe_dir,
-                "..",
-                "bin",
-                try std.fmt.allocPrint(allocator, "{s}.cmd", .{pkg.keyword})
-            });
-            defer allocator.free(batch_path);
-
-            std.fs.deleteFileAbsolute(batch_path) catch |err| {
-                std.debug.print("Warning: Could not delete batch file: {any}\n", .{err});
+            // Remove the global shim
+            removeGlobalScript(allocator, exe_dir, pkg.keyword) catch |err| {
+                std.debug.print("Warning: Could not delete global script: {any}\n", .{err});
                 return err;
             };
+            try set_package_global(allocator, ctx, pkg.keyword, false);
             std.debug.print("Removed global script for: {s}\n", .{pkg.keyword});
         }
     } else {
@@ -743,11 +1261,16 @@ fn globalize_package(allocator: std.mem.Allocator, keyword: []const u8, is_add:
     }
 }
 
-fn remove_package(allocator: std.mem.Allocator, keyword: []const u8) !void {
+fn remove_package(allocator: std.mem.Allocator, ctx: *Context, keyword: []const u8) !void {
     // Get the package info first
-    if (try parse_package_info(allocator, keyword)) |pkg| {
+    if (try parse_package_info(allocator, ctx, keyword)) |pkg| {
         defer pkg.deinit(allocator);
-        try remove_package_info(allocator, pkg);
+        remove_package_info(allocator, ctx, pkg) catch |err| {
+            if (err == error.PackageNotFound) {
+                std.debug.print("Package not found: {s}\n", .{keyword});
+            }
+            return err;
+        };
         std.debug.print("Successfully removed package: {s}\n", .{keyword});
     } else {
         std.debug.print("Package not found: {s}\n", .{keyword});
@@ -755,7 +1278,90 @@ fn remove_package(allocator: std.mem.Allocator, keyword: []const u8) !void {
     }
 }
 
-fn link_package(allocator: std.mem.Allocator, path: []const u8, is_global: bool) !void {
+// checks installed packages against the manifests recorded when they were installed,
+// keyword null verifies every package. linked packages are not copied into lib and
+// have nothing to verify
+fn verify_packages(allocator: std.mem.Allocator, ctx: *Context, keyword: ?[]const u8) !void {
+    const exe_dir = try ctx.exeDir();
+
+    var arena = std.heap.ArenaAllocator.init(allocator);
+    defer arena.deinit();
+    const arena_allocator = arena.allocator();
+
+    var reader = try registry.Reader.init(arena_allocator, try ctx.registryFile());
+    defer reader.deinit();
+
+    var targets = std.ArrayList(verify.Target).init(arena_allocator);
+    while (try reader.next()) |pkg| {
+        if (keyword) |kw| {
+            if (!std.mem.eql(u8, pkg.keyword, kw)) continue;
+            if (std.mem.startsWith(u8, pkg.name, "link@")) {
+                std.debug.print("{s} is a linked package, there are no installed files to verify\n", .{kw});
+                return;
+            }
+        } else if (std.mem.startsWith(u8, pkg.name, "link@")) {
+            continue;
+        }
+        try targets.append(.{
+            .name = try arena_allocator.dupe(u8, pkg.name),
+            .lib_path = try std.fs.path.join(arena_allocator, &[_][]const u8{ exe_dir, "..", "lib", pkg.name }),
+            .manifest_path = try package_manifest_path(arena_allocator, exe_dir, pkg.name),
+        });
+    }
+    if (keyword != null and targets.items.len == 0) {
+        std.debug.print("Package not found: {s}\n", .{keyword.?});
+        return error.PackageNotFound;
+    }
+
+    if (!try verify.verify(allocator, targets.items)) {
+        return error.VerifyFailed;
+    }
+}
+
+// moves an installed package to a new version from any install source, rewriting only
+// the files that changed, see upgrade.zig
+fn upgrade_package(allocator: std.mem.Allocator, ctx: *Context, keyword: []const u8, package_path: []const u8) !void {
+    const exe_dir = try ctx.exeDir();
+
+    const pkg = try find_package(allocator, ctx, keyword) orelse {
+        std.debug.print("Package not found: {s}\n", .{keyword});
+        return error.PackageNotFound;
+    };
+    defer pkg.deinit(allocator);
+    if (std.mem.startsWith(u8, pkg.name, "link@")) {
+        std.debug.print("{s} is a linked package, link the new version instead\n", .{keyword});
+        return;
+    }
+
+    // runs after staged.cleanup, once nothing reads from the cache anymore
+    defer evict_cache(allocator, exe_dir);
+    const staged = stage_package(allocator, ctx, package_path) catch |err| switch (err) {
+        error.UnsupportedSource => return,
+        else => return err,
+    };
+    defer staged.cleanup();
+
+    const lib_path = try std.fs.path.join(allocator, &[_][]const u8{ exe_dir, "..", "lib", pkg.name });
+    defer allocator.free(lib_path);
+    const manifest_path = try package_manifest_path(allocator, exe_dir, pkg.name);
+    defer allocator.free(manifest_path);
+
+    const stats = try upgrade.upgrade(allocator, staged.dir, lib_path, manifest_path, pkg.path);
+    if (stats.upToDate()) {
+        std.debug.print("{s} is already up to date\n", .{keyword});
+        return;
+    }
+    std.debug.print("Upgraded {s}: {d} changed, {d} added, {d} removed, {d} unchanged, {d} bytes written\n", .{
+        keyword,
+        stats.changed,
+        stats.added,
+        stats.removed,
+        stats.unchanged,
+        stats.bytes_written,
+    });
+}
+
+fn link_package(allocator: std.mem.Allocator, ctx: *Context, path: []const u8, is_global: bool) !void {
     std.debug.print("Linking package from: {s}\n", .{path});
     
     // Open and verify package directory
@@ -774,56 +1380,19 @@ fn link_package(allocator: std.mem.Allocator, path: []const u8, is_global: bool)
     const linked_name = try std.fmt.allocPrint(allocator, "link@{s}", .{base_name});
     defer allocator.free(linked_name);
 
-    // Find executables
-    var exe_paths = try findExecutables(allocator, dir, path);
-    defer {
-        for (exe_paths.items) |exe_path| {
-            allocator.free(exe_path);
-        }
-        exe_paths.deinit();
-    }
-
-    // Select executable
-    const selected_exe = selectExecutable(exe_paths) catch |err| {
-        switch (err) {
-            error.NoExecutablesFound => {
-                std.debug.print("No executable files found in the package\n", .{});
-                return;
-            },
-            else => return err,
-        }
-    };
-
-    // Get package metadata
-    var keyword_copy: []u8 = undefined;
-    while (true) {
-        std.debug.print("Enter the keyword for the package: ", .{});
-        const keyword = try getline();
-        if (keyword.len == 0) {
-            std.debug.print("Keyword cannot be empty. Please try again.\n", .{});
-            continue;
-        }
-        keyword_copy = try allocator.dupe(u8, keyword);
-        break;
-    }
-    defer allocator.free(keyword_copy);
-
-    std.debug.print("Enter the description for the package: ", .{});
-    const description = try getline();
-    const desc_copy = try allocator.dupe(u8, description);
-    defer allocator.free(desc_copy);
+    const choice = try prompt_package(allocator, dir, path) orelse return;
+    const selected_exe = choice.exe;
+    const keyword_copy = choice.keyword;
+    const desc_copy = choice.description;
 
     // Get absolute path for the linked package
     const abs_path = try std.fs.realpathAlloc(allocator, path);
     defer allocator.free(abs_path);
 
     if (is_global) {
-        var exe_dir_buf: [std.fs.max_path_bytes]u8 = undefined;
-        const exe_dir = try std.fs.selfExeDirPath(&exe_dir_buf);
-        
         // Create the global script with the full absolute path
         const full_exe_path = try std.fs.path.join(allocator, &[_][]const u8{ abs_path, selected_exe });
-        try createGlobalScript(allocator, exe_dir, keyword_copy, linked_name, full_exe_path);
+        try createGlobalScript(allocator, try ctx.exeDir(), keyword_copy, linked_name, full_exe_path);
     }
 
     // Create and save package metadata
@@ -834,66 +1403,117 @@ fn link_package(allocator: std.mem.Allocator, path: []const u8, is_global: bool)
         .description = desc_copy,
         .global = is_global,
     };
-    try add_package_info(allocator, new_package);
+    try add_package_info(allocator, ctx, new_package);
 
     std.debug.print("Successfully linked package: {s}\n", .{linked_name});
 }
 
-fn run_package(allocator: std.mem.Allocator, keyword: []const u8, extra_args: []const []const u8) !void {
-    if (try parse_package_info(allocator, keyword)) |pkg| {
+fn run_package(allocator: std.mem.Allocator, ctx: *Context, keyword: []const u8, extra_args: []const []const u8) !void {
+    if (try find_package(allocator, ctx, keyword)) |pkg| {
         defer pkg.deinit(allocator);
-        var exe_dir_buf: [std.fs.max_path_bytes]u8 = undefined;
-        const exe_dir = try std.fs.selfExeDirPath(&exe_dir_buf);
-        
-        // Construct the full path to the executable
-        const exe_path = if (std.mem.startsWith(u8, pkg.name, "link@"))
-            try allocator.dupe(u8, pkg.path)  // Use the absolute path directly
-        else try std.fs.path.join(allocator, &[_][]const u8{
-            exe_dir, "..", "lib", pkg.name, pkg.path
-        });
-        defer allocator.free(exe_path);
-
-        // Collect all arguments
-        var child_args = std.ArrayList([]const u8).init(allocator);
-        defer child_args.deinit();
-        
-        // Add the executable path as the first argument
-        try child_args.append(exe_path);
-        
-        // Add any extra arguments
-        for (extra_args) |arg| {
-            try child_args.append(arg);
-        }
-
-        // Create child process
-        var child = std.process.Child.init(child_args.items, allocator);
-        child.stderr_behavior = .Inherit;
-        child.stdout_behavior = .Inherit;
-        
-        const term = try child.spawnAndWait();
-        if (term != .Exited or term.Exited != 0) {
-            return error.CommandFailed;
-        }
+        try exec_package(allocator, try ctx.exeDir(), pkg, extra_args);
     } else {
         std.debug.print("Package not found: {s}\n", .{keyword});
         return error.PackageNotFound;
     }
 }
 
+// builds the argv for a package, the executable first and then extra_args
+fn package_argv(allocator: std.mem.Allocator, exe_dir: []const u8, pkg: Package, extra_args: []const []const u8) !std.ArrayList([]const u8) {
+    // Construct the full path to the executable
+    const exe_path = if (std.mem.startsWith(u8, pkg.name, "link@"))
+        try allocator.dupe(u8, pkg.path)  // Use the absolute path directly
+    else try std.fs.path.join(allocator, &[_][]const u8{
+        exe_dir, "..", "lib", pkg.name, pkg.path
+    });
+
+    // Collect all arguments
+    var child_args = std.ArrayList([]const u8).init(allocator);
+    errdefer child_args.deinit();
+    try child_args.ensureTotalCapacity(extra_args.len + 1);
+
+    // Add the executable path as the first argument
+    child_args.appendAssumeCapacity(exe_path);
+
+    // Add any extra arguments
+    child_args.appendSliceAssumeCapacity(extra_args);
+    return child_args;
+}
+
+// runs a package popaman needs for its own work (7zr) and waits for it
+fn exec_package(allocator: std.mem.Allocator, exe_dir: []const u8, pkg: Package, extra_args: []const []const u8) !void {
+    const child_args = try package_argv(allocator, exe_dir, pkg, extra_args);
+    defer {
+        allocator.free(child_args.items[0]);
+        child_args.deinit();
+    }
+
+    // Create child process
+    var child = std.process.Child.init(child_args.items, allocator);
+    child.stderr_behavior = .Inherit;
+    child.stdout_behavior = .Inherit;
+    
+    var span = trace.begin("spawn", child_args.items[0]);
+    const term = try child.spawnAndWait();
+    span.end();
+    if (term != .Exited or term.Exited != 0) {
+        return error.CommandFailed;
+    }
+}
+
+// runs a package the user asked for by keyword, in place of popaman
+//
+// on posix popaman execs the package, so the package keeps popaman's pid, gets its
+// signals and stdio directly and its exit status is the one the caller sees. windows
+// cannot replace a process, there popaman waits for the package and exits with its code
+fn dispatch_package(allocator: std.mem.Allocator, exe_dir: []const u8, pkg: Package, extra_args: []const []const u8) !void {
+    const child_args = try package_argv(allocator, exe_dir, pkg, extra_args);
+    defer {
+        allocator.free(child_args.items[0]);
+        child_args.deinit();
+    }
+
+    if (builtin.os.tag != .windows) {
+        // everything popaman did before the package takes over
+        const span = trace.beginAtStart("exec", child_args.items[0]);
+        span.end();
+        // only returns when the exec failed
+        const err = std.process.execv(allocator, child_args.items);
+        std.debug.print("Could not run {s}: {any}\n", .{ child_args.items[0], err });
+        return err;
+    }
+
+    var child = std.process.Child.init(child_args.items, allocator);
+    var span = trace.begin("spawn", child_args.items[0]);
+    const term = try child.spawnAndWait();
+    span.end();
+    switch (term) {
+        .Exited => |code| std.process.exit(code),
+        else => std.process.exit(1),
+    }
+}
+
 fn help_menu() !void {
     std.debug.print("Usage: popaman <command> [options]\n", .{});
     std.debug.print("Commands:\n", .{});
     std.debug.print("  install <package>         Install a package\n", .{});
     std.debug.print("  install <package> -g      Install a package globally\n", .{});
+    std.debug.print("  install <pkg> <pkg> ...   Install several packages concurrently\n", .{});
+    std.debug.print("  apply <manifest.json>     Install the packages listed in a manifest without prompts\n", .{});
     std.debug.print("  globalize <package> -a    Add package to global list\n", .{});
     std.debug.print("  globalize <package> -r    Remove package from global list\n", .{});
     std.debug.print("  remove <package>          Remove a package\n", .{});
     std.debug.print("  link <path>               Link a package from elsewhere\n", .{});
     std.debug.print("  list                      List all available packages\n", .{});
     std.debug.print("  list -v                   List all available packages with descriptions\n", .{});
+    std.debug.print("  upgrade <package> <path>  Update a package to a new version, writing only changed files\n", .{});
+    std.debug.print("  verify <package>          Check a package's files against its install manifest\n", .{});
+    std.debug.print("  verify --all              Check every installed package\n", .{});
+    std.debug.print("Options:\n", .{});
+    std.debug.print("  --trace <command>         Print timing spans as json lines (or set POPAMAN_TRACE)\n", .{});
 }
 
-pub fn run_popaman() !void {
+pub fn run_popaman(ctx: *Context) !void {
     var arena = std.heap.ArenaAllocator.init(std.heap.page_allocator);
     defer arena.deinit();
     const allocator = arena.allocator();
@@ -906,20 +1526,55 @@ pub fn run_popaman() !void {
     _ = args.skip();
 
     // Show help if no arguments
-    const command = args.next() orelse {
+    var command = args.next() orelse {
         try help_menu();
         return;
     };
 
+    // --trace goes before the command so it never reaches a package's arguments
+    const trace_flag = cmd_helper.isTraceFlag(command);
+    trace.init(trace_flag);
+    if (trace_flag) {
+        command = args.next() orelse {
+            try help_menu();
+            return;
+        };
+    }
+
     // Handle install command
     if (cmd_helper.isInstallCommand(command)) {
-        const package = args.next() orelse {
+        var sources = std.ArrayList([]const u8).init(allocator);
+        defer sources.deinit();
+        var is_global = false;
+        while (args.next()) |arg| {
+            if (cmd_helper.isGlobalFlag(arg)) {
+                is_global = true;
+            } else {
+                try sources.append(arg);
+            }
+        }
+
+        if (sources.items.len == 0) {
             std.debug.print("Error: Package path is required\n", .{});
-            std.debug.print("Usage: popaman install <package path> [-g]\n", .{});
+            std.debug.print("Usage: popaman install <package path> [<package path> ...] [-g]\n", .{});
+            return;
+        }
+        if (sources.items.len == 1) {
+            try install_package(allocator, ctx, sources.items[0], is_global);
+        } else {
+            try install_batch(allocator, ctx, sources.items, is_global);
+        }
+        return;
+    }
+
+    // Handle apply command
+    if (cmd_helper.isApplyCommand(command)) {
+        const manifest_path = args.next() orelse {
+            std.debug.print("Error: Manifest path is required\n", .{});
+            std.debug.print("Usage: popaman apply <manifest.json>\n", .{});
             return;
         };
-        const is_global = if (args.next()) |flag| cmd_helper.isGlobalFlag(flag) else false;
-        try install_package(allocator, package, is_global);
+        try apply_manifest(allocator, ctx, manifest_path);
         return;
     }
 
@@ -935,11 +1590,11 @@ pub fn run_popaman() !void {
         };
         
         if (cmd_helper.isAddFlag(flag)) {
-            try globalize_package(allocator, package, true);
+            try globalize_package(allocator, ctx, package, true);
             return;
         }
         if (cmd_helper.isRemoveFlag(flag)) {
-            try globalize_package(allocator, package, false);
+            try globalize_package(allocator, ctx, package, false);
             return;
         }
         
@@ -956,7 +1611,34 @@ pub fn run_popaman() !void {
             std.debug.print("Usage: popaman remove <package-name>\n", .{});
             return;
         };
-        try remove_package(allocator, package);
+        try remove_package(allocator, ctx, package);
+        return;
+    }
+
+    // Handle upgrade command
+    if (cmd_helper.isUpgradeCommand(command)) {
+        const package = args.next() orelse {
+            std.debug.print("Error: Package name is required\n", .{});
+            std.debug.print("Usage: popaman upgrade <package-name> <package path>\n", .{});
+            return;
+        };
+        const source = args.next() orelse {
+            std.debug.print("Error: Package path is required\n", .{});
+            std.debug.print("Usage: popaman upgrade <package-name> <package path>\n", .{});
+            return;
+        };
+        try upgrade_package(allocator, ctx, package, source);
+        return;
+    }
+
+    // Handle verify command
+    if (cmd_helper.isVerifyCommand(command)) {
+        const target = args.next() orelse {
+            std.debug.print("Error: Package name or --all is required\n", .{});
+            std.debug.print("Usage: popaman verify <package-name>|--all\n", .{});
+            return;
+        };
+        try verify_packages(allocator, ctx, if (cmd_helper.isAllFlag(target)) null else target);
         return;
     }
 
@@ -968,40 +1650,19 @@ pub fn run_popaman() !void {
             return;
         };
         const is_global = if (args.next()) |flag| cmd_helper.isGlobalFlag(flag) else false;
-        try link_package(allocator, path, is_global);
+        try link_package(allocator, ctx, path, is_global);
         return;
     }
 
     // Handle list command
     if (cmd_helper.isListCommand(command)) {
-        const packages = try get_packages(allocator);
         const verbose = if (args.next()) |flag| cmd_helper.isVerboseFlag(flag) else false;
-        
-        if (verbose) {
-            std.debug.print("Available packages with descriptions:\n", .{});
-            for (packages) |keyword| {
-                if (try parse_package_info(allocator, keyword)) |pkg| {
-                    defer pkg.deinit(allocator);
-                    std.debug.print("\n({s}\\{s}) {s} \nGlobal: {}\nDescription: {s}\n", .{
-                        pkg.name, 
-                        pkg.path,
-                        pkg.keyword, 
-                        pkg.global,
-                        pkg.description
-                    });
-                }   
-            }
-            return;
-        }
-
-        for (packages) |keyword| {
-            std.debug.print("Available package: {s}\n", .{keyword});
-        }
+        try list_packages(allocator, ctx, verbose);
         return;
     }
 
     // Try to run as package command
-    if (try parse_package_info(allocator, command)) |pkg| {
+    if (try find_package(allocator, ctx, command)) |pkg| {
         defer pkg.deinit(allocator);
         var remaining_args = std.ArrayList([]const u8).init(allocator);
         defer remaining_args.deinit();
@@ -1010,7 +1671,7 @@ pub fn run_popaman() !void {
             try remaining_args.append(arg);
         }
 
-        try run_package(allocator, command, remaining_args.items);
+        try dispatch_package(allocator, try ctx.exeDir(), pkg, remaining_args.items);
         return;
     }
 
@@ -0,0 +1,164 @@
+const std = @import("std");
+const builtin = @import("builtin");
+const verify = @import("verify.zig");
+const copy = @import("../utils/copy.zig");
+const trace = @import("../utils/trace.zig");
+
+// replaces an installed package with a new version of its files, writing only what changed
+//
+// the installed tree (hashed mostly from its manifest) and the new source tree are
+// compared by path, size and content. the new version is assembled next to the installed
+// one in lib/: unchanged files are hardlinked from the installed tree, so their data is
+// not written again, and only new and changed files are copied from the source. files
+// the source no longer has are simply not carried over. the finished tree is then
+// swapped with the installed one, in a single atomic exchange where the os supports it,
+// and the old tree is deleted
+
+// linux uapi flag for renameat2, swaps the two paths in one step
+const RENAME_EXCHANGE = 1 << 1;
+
+pub const Stats = struct {
+    unchanged: usize = 0,
+    changed: usize = 0,
+    added: usize = 0,
+    removed: usize = 0,
+    bytes_written: u64 = 0,
+
+    pub fn upToDate(stats: Stats) bool {
+        return stats.changed == 0 and stats.added == 0 and stats.removed == 0;
+    }
+};
+
+// upgrades the package at lib_path to the files at source_path and rewrites its manifest
+// exe is the package's executable, which the new version must still have
+pub fn upgrade(allocator: std.mem.Allocator, source_path: []const u8, lib_path: []const u8, manifest_path: []const u8, exe: []const u8) !Stats {
+    var arena = std.heap.ArenaAllocator.init(allocator);
+    defer arena.deinit();
+    const arena_allocator = arena.allocator();
+
+    var source_dir = try std.fs.cwd().openDir(source_path, .{ .iterate = true });
+    defer source_dir.close();
+    var installed_dir = try std.fs.cwd().openDir(lib_path, .{ .iterate = true });
+    defer installed_dir.close();
+
+    var diff_span = trace.begin("upgrade.diff", lib_path);
+    const known = verify.readManifest(arena_allocator, manifest_path) catch null;
+    const installed = try verify.hashTree(arena_allocator, installed_dir, known);
+    // a source file with the size and mtime of the installed file is taken to be the same
+    const source = try verify.hashTree(arena_allocator, source_dir, .{ .files = installed });
+    diff_span.count = source.len;
+    diff_span.end();
+
+    var installed_by_path = std.StringHashMap(*const verify.FileEntry).init(arena_allocator);
+    try installed_by_path.ensureTotalCapacity(@intCast(installed.len));
+    for (installed) |*file| installed_by_path.putAssumeCapacity(file.path, file);
+
+    var stats = Stats{};
+    var has_exe = false;
+    var to_link = std.ArrayList([]const u8).init(arena_allocator);
+    var to_copy = std.ArrayList([]const u8).init(arena_allocator);
+    for (source) |file| {
+        if (std.mem.eql(u8, file.path, exe)) has_exe = true;
+        if (installed_by_path.fetchRemove(file.path)) |old| {
+            if (old.value.size == file.size and std.mem.eql(u8, old.value.hash, file.hash) and
+                sameMode(installed_dir, source_dir, file.path))
+            {
+                try to_link.append(file.path);
+                stats.unchanged += 1;
+                continue;
+            }
+            stats.changed += 1;
+        } else {
+            stats.added += 1;
+        }
+        try to_copy.append(file.path);
+        stats.bytes_written += file.size;
+    }
+    // what is left was not in the source
+    stats.removed = installed_by_path.count();
+
+    if (!has_exe) {
+        std.debug.print("The new version has no {s}, remove the package and install it again instead\n", .{exe});
+        return error.ExecutableMissing;
+    }
+    if (stats.upToDate()) {
+        // a package installed before manifests existed gets one now
+        if (known == null) verify.writeManifest(manifest_path, .{ .files = installed }) catch {};
+        return stats;
+    }
+
+    const work_path = try siblingPath(arena_allocator, lib_path, "upgrade");
+    try std.fs.cwd().makePath(work_path);
+    var swapped = false;
+    errdefer if (!swapped) std.fs.cwd().deleteTree(work_path) catch {};
+    var work_dir = try std.fs.cwd().openDir(work_path, .{});
+    defer work_dir.close();
+
+    // directories first, including empty ones, then the files inside them
+    {
+        var walker = try source_dir.walk(arena_allocator);
+        defer walker.deinit();
+        while (try walker.next()) |entry| {
+            if (entry.kind == .directory) try work_dir.makePath(entry.path);
+        }
+    }
+    for (to_link.items) |path| {
+        if (builtin.os.tag != .windows) {
+            if (std.posix.linkat(installed_dir.fd, path, work_dir.fd, path, 0)) continue else |_| {}
+        }
+        // no hardlinks here, the unchanged file has to be written after all
+        try installed_dir.copyFile(path, work_dir, path, .{});
+        const stat = try work_dir.statFile(path);
+        stats.bytes_written += stat.size;
+    }
+    try copy.copyFiles(source_dir, work_dir, to_copy.items, .{});
+
+    // the manifest describes the files as they are in lib/, with their new mtimes
+    for (source) |*file| {
+        file.mtime = (try work_dir.statFile(file.path)).mtime;
+    }
+
+    const old_path = try swap(arena_allocator, lib_path, work_path);
+    swapped = true;
+    std.fs.cwd().deleteTree(old_path) catch |err| {
+        std.debug.print("Warning: Could not delete the old version at {s}: {any}\n", .{ old_path, err });
+    };
+    verify.writeManifest(manifest_path, .{ .files = source }) catch |err| {
+        std.debug.print("Warning: Could not record manifest of {s}: {any}\n", .{ lib_path, err });
+    };
+    return stats;
+}
+
+// permission changes count as changes, a file that became executable must not be linked
+fn sameMode(installed_dir: std.fs.Dir, source_dir: std.fs.Dir, path: []const u8) bool {
+    const installed = installed_dir.statFile(path) catch return false;
+    const source = source_dir.statFile(path) catch return false;
+    return installed.mode == source.mode;
+}
+
+// <lib_path>.<what>-<random hex>, next to lib_path so renames stay on one filesystem
+fn siblingPath(allocator: std.mem.Allocator, lib_path: []const u8, what: []const u8) ![]const u8 {
+    var random_bytes: [8]u8 = undefined;
+    std.crypto.random.bytes(&random_bytes);
+    return std.fmt.allocPrint(allocator, "{s}.{s}-{s}", .{ lib_path, what, std.fmt.fmtSliceHexLower(&random_bytes) });
+}
+
+// puts the tree at work_path in place of lib_path and returns where the old tree went
+fn swap(allocator: std.mem.Allocator, lib_path: []const u8, work_path: []const u8) ![]const u8 {
+    if (builtin.os.tag == .linux) {
+        const lib_path_z = try std.posix.toPosixPath(lib_path);
+        const work_path_z = try std.posix.toPosixPath(work_path);
+        const rc = std.os.linux.renameat2(std.posix.AT.FDCWD, &lib_path_z, std.posix.AT.FDCWD, &work_path_z, RENAME_EXCHANGE);
+        // anything else, such as a filesystem without exchange support, takes the two renames
+        if (std.os.linux.E.init(rc) == .SUCCESS) return work_path;
+    }
+
+    // lib_path is missing between the two renames, for as long as one rename takes
+    const old_path = try siblingPath(allocator, lib_path, "old");
+    try std.fs.cwd().rename(lib_path, old_path);
+    std.fs.cwd().rename(work_path, lib_path) catch |err| {
+        std.fs.cwd().rename(old_path, lib_path) catch {};
+        return err;
+    };
+    return old_path;
+}
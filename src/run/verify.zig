@@ -0,0 +1,331 @@
+const std = @import("std");
+const cache = @import("cache.zig");
+const trace = @import("../utils/trace.zig");
+
+// integrity manifests of installed packages
+//
+// installing a package records the size, mtime and sha256 of every file it put into
+// lib/<name> in manifest/<name>.json. verify walks lib/<name> again and compares it with
+// the manifest: files whose size and mtime still match are trusted without being read,
+// files whose size changed are reported without being read, and the rest are hashed.
+// the hashing of every package being verified is shared by one set of threads, so an
+// audit of many small packages keeps all cores busy
+//
+// a file whose content still matches after its mtime changed gets the new mtime written
+// back to the manifest, so the next verify can skip it again
+
+const max_threads = 8;
+
+pub const FileEntry = struct {
+    path: []const u8,
+    size: u64,
+    mtime: i128,
+    hash: []const u8,
+};
+
+pub const Manifest = struct {
+    files: []FileEntry,
+};
+
+// a package to record or verify
+pub const Target = struct {
+    name: []const u8,
+    lib_path: []const u8,
+    manifest_path: []const u8,
+};
+
+// one file found on disk
+const Job = struct {
+    target: usize,
+    path: []const u8,
+    size: u64,
+    mtime: i128,
+    // what the manifest says about the file, null when recording
+    entry: ?*FileEntry,
+    needs_hash: bool,
+    hash: cache.Hash = undefined,
+    err: ?anyerror = null,
+};
+
+const Pool = struct {
+    dirs: []const std.fs.Dir,
+    jobs: []Job,
+    next: std.atomic.Value(usize) = .init(0),
+
+    // claims jobs one at a time, so a few large files do not leave the other threads idle
+    fn worker(pool: *Pool) void {
+        while (true) {
+            const i = pool.next.fetchAdd(1, .monotonic);
+            if (i >= pool.jobs.len) return;
+            const job = &pool.jobs[i];
+            if (!job.needs_hash) continue;
+            job.hash = cache.hashFileAt(pool.dirs[job.target], job.path) catch |err| {
+                job.err = err;
+                continue;
+            };
+        }
+    }
+};
+
+// hashes every file of an installed package and writes its manifest
+pub fn record(allocator: std.mem.Allocator, target: Target) !void {
+    var arena = std.heap.ArenaAllocator.init(allocator);
+    defer arena.deinit();
+    const arena_allocator = arena.allocator();
+
+    var span = trace.begin("record", target.lib_path);
+    defer span.end();
+
+    var dir = try std.fs.cwd().openDir(target.lib_path, .{ .iterate = true });
+    defer dir.close();
+
+    const files = try hashTree(arena_allocator, dir, null);
+    var total: u64 = 0;
+    for (files) |file| total += file.size;
+    span.count = files.len;
+    span.bytes = total;
+    try writeManifest(target.manifest_path, .{ .files = files });
+}
+
+// the regular files under dir with their size, mtime and hash
+// a file whose path, size and mtime match an entry of known takes the hash from there
+// instead of being read. everything is allocated with allocator, meant to be an arena
+pub fn hashTree(allocator: std.mem.Allocator, dir: std.fs.Dir, known: ?Manifest) ![]FileEntry {
+    var jobs = std.ArrayList(Job).init(allocator);
+    try collect(allocator, dir, 0, &jobs);
+
+    var recorded = std.StringHashMap(*const FileEntry).init(allocator);
+    if (known) |manifest| {
+        try recorded.ensureTotalCapacity(@intCast(manifest.files.len));
+        for (manifest.files) |*file| recorded.putAssumeCapacity(file.path, file);
+    }
+    for (jobs.items) |*job| {
+        job.needs_hash = true;
+        const entry = recorded.get(job.path) orelse continue;
+        if (entry.size == job.size and entry.mtime == job.mtime and entry.hash.len == job.hash.len) {
+            @memcpy(&job.hash, entry.hash);
+            job.needs_hash = false;
+        }
+    }
+    hashAll(&[_]std.fs.Dir{dir}, jobs.items);
+
+    const files = try allocator.alloc(FileEntry, jobs.items.len);
+    for (jobs.items, files) |*job, *file| {
+        if (job.err) |err| return err;
+        file.* = .{ .path = job.path, .size = job.size, .mtime = job.mtime, .hash = &job.hash };
+    }
+    return files;
+}
+
+// verifies each target against its manifest and prints what differs
+// returns false when any package was modified, a target without a manifest is only reported
+pub fn verify(allocator: std.mem.Allocator, targets: []const Target) !bool {
+    var arena = std.heap.ArenaAllocator.init(allocator);
+    defer arena.deinit();
+    const arena_allocator = arena.allocator();
+
+    var span = trace.begin("verify", "");
+    defer span.end();
+
+    const manifests = try arena_allocator.alloc(?Manifest, targets.len);
+    const dirs = try arena_allocator.alloc(std.fs.Dir, targets.len);
+    // a package whose directory is gone has no dir, all its files are reported missing
+    const opened = try arena_allocator.alloc(bool, targets.len);
+    @memset(opened, false);
+    defer for (dirs, opened) |*dir, is_open| {
+        if (is_open) dir.close();
+    };
+    const extras = try arena_allocator.alloc(std.ArrayListUnmanaged([]const u8), targets.len);
+
+    var jobs = std.ArrayList(Job).init(arena_allocator);
+    for (targets, 0..) |target, i| {
+        extras[i] = .empty;
+        manifests[i] = readManifest(arena_allocator, target.manifest_path) catch |err| switch (err) {
+            error.FileNotFound => null,
+            else => return err,
+        };
+        const manifest = manifests[i] orelse continue;
+        dirs[i] = std.fs.cwd().openDir(target.lib_path, .{ .iterate = true }) catch |err| switch (err) {
+            error.FileNotFound => continue,
+            else => return err,
+        };
+        opened[i] = true;
+
+        var recorded = std.StringHashMap(*FileEntry).init(arena_allocator);
+        try recorded.ensureTotalCapacity(@intCast(manifest.files.len));
+        for (manifest.files) |*file| recorded.putAssumeCapacity(file.path, file);
+
+        const first = jobs.items.len;
+        try collect(arena_allocator, dirs[i], i, &jobs);
+        var kept = first;
+        for (jobs.items[first..]) |job| {
+            const entry = recorded.get(job.path) orelse {
+                try extras[i].append(arena_allocator, job.path);
+                continue;
+            };
+            jobs.items[kept] = job;
+            jobs.items[kept].entry = entry;
+            jobs.items[kept].needs_hash = job.size == entry.size and job.mtime != entry.mtime;
+            kept += 1;
+        }
+        jobs.shrinkRetainingCapacity(kept);
+    }
+
+    hashAll(dirs, jobs.items);
+
+    var hashed: u64 = 0;
+    var hashed_bytes: u64 = 0;
+    for (jobs.items) |job| {
+        if (!job.needs_hash) continue;
+        hashed += 1;
+        hashed_bytes += job.size;
+    }
+    span.count = hashed;
+    span.bytes = hashed_bytes;
+
+    var failed: usize = 0;
+    var skipped: usize = 0;
+    var job_index: usize = 0;
+    for (targets, manifests, extras, 0..) |target, maybe_manifest, extra, i| {
+        const manifest = maybe_manifest orelse {
+            std.debug.print("No manifest for {s}, install it again to record one\n", .{target.name});
+            skipped += 1;
+            continue;
+        };
+
+        var problems = std.ArrayList(u8).init(arena_allocator);
+        const writer = problems.writer();
+        var seen = std.StringHashMap(void).init(arena_allocator);
+        var refreshed = false;
+        var target_hashed: usize = 0;
+        while (job_index < jobs.items.len and jobs.items[job_index].target == i) : (job_index += 1) {
+            const job = &jobs.items[job_index];
+            const entry = job.entry.?;
+            try seen.put(job.path, {});
+            if (job.needs_hash) target_hashed += 1;
+
+            if (job.size != entry.size) {
+                try writer.print("  modified: {s}\n", .{job.path});
+            } else if (!job.needs_hash) {
+                continue;
+            } else if (job.err) |err| {
+                try writer.print("  unreadable: {s} ({any})\n", .{ job.path, err });
+            } else if (!std.mem.eql(u8, &job.hash, entry.hash)) {
+                try writer.print("  modified: {s}\n", .{job.path});
+            } else {
+                entry.mtime = job.mtime;
+                refreshed = true;
+            }
+        }
+        for (manifest.files) |file| {
+            if (!seen.contains(file.path)) try writer.print("  missing: {s}\n", .{file.path});
+        }
+        for (extra.items) |path| {
+            try writer.print("  extra: {s}\n", .{path});
+        }
+
+        if (refreshed) {
+            writeManifest(target.manifest_path, manifest) catch |err| {
+                std.debug.print("Warning: Could not update manifest of {s}: {any}\n", .{ target.name, err });
+            };
+        }
+        if (problems.items.len > 0) {
+            std.debug.print("FAILED {s}\n{s}", .{ target.name, problems.items });
+            failed += 1;
+        } else {
+            std.debug.print("OK {s} ({d} files, {d} hashed)\n", .{ target.name, manifest.files.len, target_hashed });
+        }
+    }
+
+    std.debug.print("Verified {d} packages: {d} ok, {d} failed, {d} without manifest\n", .{
+        targets.len,
+        targets.len - failed - skipped,
+        failed,
+        skipped,
+    });
+    return failed == 0;
+}
+
+// whether the regular files under lib_path are exactly those of the manifest at
+// manifest_path, with the same sizes and mtimes. nothing is read or hashed, it is the
+// cheap check that a tree was left alone since the manifest was recorded
+pub fn unchanged(allocator: std.mem.Allocator, lib_path: []const u8, manifest_path: []const u8) !bool {
+    var arena = std.heap.ArenaAllocator.init(allocator);
+    defer arena.deinit();
+    const arena_allocator = arena.allocator();
+
+    const manifest = try readManifest(arena_allocator, manifest_path);
+    var dir = std.fs.cwd().openDir(lib_path, .{ .iterate = true }) catch |err| switch (err) {
+        error.FileNotFound => return false,
+        else => return err,
+    };
+    defer dir.close();
+
+    var jobs = std.ArrayList(Job).init(arena_allocator);
+    try collect(arena_allocator, dir, 0, &jobs);
+    if (jobs.items.len != manifest.files.len) return false;
+
+    var recorded = std.StringHashMap(*const FileEntry).init(arena_allocator);
+    try recorded.ensureTotalCapacity(@intCast(manifest.files.len));
+    for (manifest.files) |*file| recorded.putAssumeCapacity(file.path, file);
+    for (jobs.items) |job| {
+        const entry = recorded.get(job.path) orelse return false;
+        if (entry.size != job.size or entry.mtime != job.mtime) return false;
+    }
+    return true;
+}
+
+// appends a job for every regular file under dir, with its size and mtime
+fn collect(allocator: std.mem.Allocator, dir: std.fs.Dir, target: usize, jobs: *std.ArrayList(Job)) !void {
+    var walker = try dir.walk(allocator);
+    defer walker.deinit();
+    while (try walker.next()) |entry| {
+        if (entry.kind != .file) continue;
+        const stat = try entry.dir.statFile(entry.basename);
+        try jobs.append(.{
+            .target = target,
+            .path = try allocator.dupe(u8, entry.path),
+            .size = stat.size,
+            .mtime = stat.mtime,
+            .entry = null,
+            .needs_hash = false,
+        });
+    }
+}
+
+fn hashAll(dirs: []const std.fs.Dir, jobs: []Job) void {
+    var to_hash: usize = 0;
+    for (jobs) |job| {
+        if (job.needs_hash) to_hash += 1;
+    }
+    if (to_hash == 0) return;
+
+    var pool = Pool{ .dirs = dirs, .jobs = jobs };
+    const cpu_count = std.Thread.getCpuCount() catch 1;
+    const thread_count = std.math.clamp(@min(cpu_count, to_hash), 1, max_threads);
+
+    // this thread hashes too, alongside the others
+    var threads = [_]?std.Thread{null} ** max_threads;
+    for (threads[1..thread_count]) |*thread| {
+        thread.* = std.Thread.spawn(.{}, Pool.worker, .{&pool}) catch null;
+    }
+    pool.worker();
+    for (threads[1..thread_count]) |thread| {
+        if (thread) |t| t.join();
+    }
+}
+
+pub fn readManifest(allocator: std.mem.Allocator, path: []const u8) !Manifest {
+    const content = try std.fs.cwd().readFileAlloc(allocator, path, std.math.maxInt(usize));
+    return std.json.parseFromSliceLeaky(Manifest, allocator, content, .{ .allocate = .alloc_always });
+}
+
+pub fn writeManifest(path: []const u8, manifest: Manifest) !void {
+    if (std.fs.path.dirname(path)) |dir| try std.fs.cwd().makePath(dir);
+    var atomic_file = try std.fs.cwd().atomicFile(path, .{});
+    defer atomic_file.deinit();
+    var buffered = std.io.bufferedWriter(atomic_file.file.writer());
+    try std.json.stringify(manifest, .{}, buffered.writer());
+    try buffered.flush();
+    try atomic_file.finish();
+}
@@ -0,0 +1,94 @@
+const std = @import("std");
+
+// what every command needs to know about the popaman root, worked out at most once per run
+//
+// main creates one context and hands it to install.verify_install and run.run_popaman,
+// which pass it on to the commands. the root is resolved from the executable's path the
+// first time something asks for it, and packages.json is opened once and shared by every
+// step that reads the registry, instead of each of them resolving and opening it again
+//
+// the context is shared by the staging threads of a batch install, so the lazy setup is
+// done under a lock and the registry is only ever read with positional reads
+
+pub const Context = struct {
+    mutex: std.Thread.Mutex = .{},
+    exe_dir_buf: [std.fs.max_path_bytes]u8 = undefined,
+    exe_dir: ?[]const u8 = null,
+    lib_path_buf: [std.fs.max_path_bytes]u8 = undefined,
+    lib_path: ?[]const u8 = null,
+    registry_path_buf: [std.fs.max_path_bytes]u8 = undefined,
+    registry_path: ?[]const u8 = null,
+    // packages.json, open from the first read until the registry is replaced
+    registry: ?std.fs.File = null,
+
+    pub fn deinit(ctx: *Context) void {
+        if (ctx.registry) |file| file.close();
+        ctx.registry = null;
+    }
+
+    // bin/, where the popaman executable is
+    pub fn exeDir(ctx: *Context) ![]const u8 {
+        ctx.mutex.lock();
+        defer ctx.mutex.unlock();
+        return ctx.resolveExeDir();
+    }
+
+    // lib/, next to bin/
+    pub fn libPath(ctx: *Context) ![]const u8 {
+        ctx.mutex.lock();
+        defer ctx.mutex.unlock();
+        return ctx.resolveLibPath();
+    }
+
+    pub fn registryPath(ctx: *Context) ![]const u8 {
+        ctx.mutex.lock();
+        defer ctx.mutex.unlock();
+        return ctx.resolveRegistryPath();
+    }
+
+    // packages.json, opened on first use. read it with pread, the handle is shared
+    pub fn registryFile(ctx: *Context) !std.fs.File {
+        ctx.mutex.lock();
+        defer ctx.mutex.unlock();
+        if (ctx.registry) |file| return file;
+        const file = try std.fs.cwd().openFile(try ctx.resolveRegistryPath(), .{});
+        ctx.registry = file;
+        return file;
+    }
+
+    // forgets the open packages.json, for when it was replaced or may have been
+    // replaced by another process. the next registryFile opens the current one
+    pub fn dropRegistry(ctx: *Context) void {
+        ctx.mutex.lock();
+        defer ctx.mutex.unlock();
+        ctx.deinit();
+    }
+
+    fn resolveExeDir(ctx: *Context) ![]const u8 {
+        if (ctx.exe_dir) |dir| return dir;
+        const dir = try std.fs.selfExeDirPath(&ctx.exe_dir_buf);
+        ctx.exe_dir = dir;
+        return dir;
+    }
+
+    fn resolveLibPath(ctx: *Context) ![]const u8 {
+        if (ctx.lib_path) |path| return path;
+        const exe_dir = try ctx.resolveExeDir();
+        const path = try joinInto(&ctx.lib_path_buf, &[_][]const u8{ exe_dir, "..", "lib" });
+        ctx.lib_path = path;
+        return path;
+    }
+
+    fn resolveRegistryPath(ctx: *Context) ![]const u8 {
+        if (ctx.registry_path) |path| return path;
+        const lib_path = try ctx.resolveLibPath();
+        const path = try joinInto(&ctx.registry_path_buf, &[_][]const u8{ lib_path, "packages.json" });
+        ctx.registry_path = path;
+        return path;
+    }
+};
+
+fn joinInto(buf: []u8, paths: []const []const u8) ![]const u8 {
+    var fba = std.heap.FixedBufferAllocator.init(buf);
+    return std.fs.path.join(fba.allocator(), paths) catch error.NameTooLong;
+}
@@ -0,0 +1,264 @@
+const std = @import("std");
+const builtin = @import("builtin");
+const trace = @import("trace.zig");
+
+// copies a package tree into lib/, shared by the installer and the package manager
+//
+// the tree is walked once: directories are created as the walk reaches them and files
+// are collected, then split across threads. each file is cloned with a reflink where
+// the filesystem supports it (btrfs, xfs), which shares the data blocks copy-on-write,
+// and copied otherwise. symlinks are recreated with the same target, unless it leads
+// out of the tree
+//
+// POPAMAN_COPY picks the strategy:
+//   auto      reflink, falling back to a copy (default)
+//   hardlink  hardlink, falling back to auto. the installed files are the source files,
+//             so editing one edits the other
+//   copy      always copy the bytes
+
+pub const Mode = enum { auto, hardlink, copy };
+
+pub const Options = struct {
+    // warn about files that cannot be copied and go on instead of failing
+    skip_errors: bool = false,
+};
+
+// linux ioctl that clones the data of one file into another, _IOW(0x94, 9, int)
+const FICLONE = 0x40049409;
+
+const max_threads = 8;
+// below this many files per thread the threads cost more than they save
+const files_per_thread = 32;
+
+pub fn modeFromEnv() Mode {
+    var buf: [64]u8 = undefined;
+    var fba = std.heap.FixedBufferAllocator.init(&buf);
+    const value = std.process.getEnvVarOwned(fba.allocator(), "POPAMAN_COPY") catch return .auto;
+    return std.meta.stringToEnum(Mode, value) orelse .auto;
+}
+
+const Worker = struct {
+    source_dir: std.fs.Dir,
+    dest_dir: std.fs.Dir,
+    files: []const []const u8,
+    mode: Mode,
+    options: Options,
+    // cleared by the first file the filesystem refuses to clone, shared by all workers
+    reflink: *std.atomic.Value(bool),
+    err: ?anyerror = null,
+
+    fn run(worker: *Worker) void {
+        for (worker.files) |path| {
+            copyOne(worker, path) catch |err| {
+                if (worker.options.skip_errors) {
+                    std.debug.print("Warning: Could not copy file {s}: {any}\n", .{ path, err });
+                    continue;
+                }
+                worker.err = err;
+                return;
+            };
+        }
+    }
+
+    fn copyOne(worker: *Worker, path: []const u8) !void {
+        // the clone and the hardlink replace the destination before the source is read, which
+        // would destroy a source that is the destination
+        if (try isSameFile(worker.source_dir, worker.dest_dir, path)) return error.SameFile;
+        if (worker.mode == .hardlink and builtin.os.tag != .windows) {
+            if (hardlink(worker.source_dir, worker.dest_dir, path)) return else |_| {}
+        }
+        if (worker.mode != .copy and builtin.os.tag == .linux and worker.reflink.load(.monotonic)) {
+            // an error here is about this one file, the copy below gets to report it
+            if (reflink(worker.source_dir, worker.dest_dir, path)) |cloned| {
+                if (cloned) return;
+                worker.reflink.store(false, .monotonic);
+            } else |_| {}
+        }
+        try worker.source_dir.copyFile(path, worker.dest_dir, path, .{});
+    }
+};
+
+// copies the tree at source_path into dest_path, creating dest_path if needed
+pub fn copyTree(allocator: std.mem.Allocator, source_path: []const u8, dest_path: []const u8, options: Options) !void {
+    try std.fs.cwd().makePath(dest_path);
+
+    var source_dir = try std.fs.cwd().openDir(source_path, .{ .iterate = true });
+    defer source_dir.close();
+    var dest_dir = try std.fs.cwd().openDir(dest_path, .{});
+    defer dest_dir.close();
+
+    var arena = std.heap.ArenaAllocator.init(allocator);
+    defer arena.deinit();
+    var files = std.ArrayList([]const u8).init(arena.allocator());
+
+    var walker = try source_dir.walk(allocator);
+    defer walker.deinit();
+
+    var walk_span = trace.begin("walk", source_path);
+    // sizes are only needed for the copy span, so they are only looked up when tracing
+    var total_bytes: u64 = 0;
+
+    // the walk reaches every directory before anything inside it, so one makeDir each is enough
+    while (try walker.next()) |entry| {
+        switch (entry.kind) {
+            .file => {
+                try files.append(try arena.allocator().dupe(u8, entry.path));
+                if (trace.enabled()) {
+                    if (entry.dir.statFile(entry.basename)) |stat| total_bytes += stat.size else |_| {}
+                }
+            },
+            .directory => dest_dir.makeDir(entry.path) catch |err| switch (err) {
+                error.PathAlreadyExists => {},
+                else => {
+                    if (!options.skip_errors) return err;
+                    std.debug.print("Warning: Could not create directory {s}: {any}\n", .{ entry.path, err });
+                },
+            },
+            .sym_link => copyLink(source_dir, dest_dir, entry.path) catch |err| switch (err) {
+                error.LinkOutsideTree => std.debug.print("Warning: Skipping symlink {s}, it points outside the package\n", .{entry.path}),
+                else => {
+                    if (!options.skip_errors) return err;
+                    std.debug.print("Warning: Could not copy symlink {s}: {any}\n", .{ entry.path, err });
+                },
+            },
+            else => {
+                std.debug.print("Warning: Skipping unsupported file type for {s}\n", .{entry.path});
+            },
+        }
+    }
+
+    walk_span.count = files.items.len;
+    walk_span.end();
+
+    try copyFilesTraced(source_dir, dest_dir, dest_path, files.items, total_bytes, options);
+}
+
+// copies the files at paths, relative to both dirs, from source_dir into dest_dir
+// their parent directories must already exist in dest_dir
+pub fn copyFiles(source_dir: std.fs.Dir, dest_dir: std.fs.Dir, paths: []const []const u8, options: Options) !void {
+    var total_bytes: u64 = 0;
+    if (trace.enabled()) {
+        for (paths) |path| {
+            if (source_dir.statFile(path)) |stat| total_bytes += stat.size else |_| {}
+        }
+    }
+    try copyFilesTraced(source_dir, dest_dir, "", paths, total_bytes, options);
+}
+
+fn copyFilesTraced(source_dir: std.fs.Dir, dest_dir: std.fs.Dir, detail: []const u8, paths: []const []const u8, total_bytes: u64, options: Options) !void {
+    var copy_span = trace.begin("copy", detail);
+    copy_span.bytes = total_bytes;
+    copy_span.count = paths.len;
+    defer copy_span.end();
+
+    const mode = modeFromEnv();
+    var reflink_ok = std.atomic.Value(bool).init(true);
+    const cpu_count = std.Thread.getCpuCount() catch 1;
+    const thread_count = std.math.clamp(paths.len / files_per_thread, 1, @min(cpu_count, max_threads));
+
+    var workers: [max_threads]Worker = undefined;
+    for (workers[0..thread_count], 0..) |*worker, i| {
+        worker.* = .{
+            .source_dir = source_dir,
+            .dest_dir = dest_dir,
+            .files = paths[paths.len * i / thread_count .. paths.len * (i + 1) / thread_count],
+            .mode = mode,
+            .options = options,
+            .reflink = &reflink_ok,
+        };
+    }
+
+    // the first share runs on this thread, the others on their own
+    var threads = [_]?std.Thread{null} ** max_threads;
+    for (workers[1..thread_count], threads[1..thread_count]) |*worker, *thread| {
+        thread.* = std.Thread.spawn(.{}, Worker.run, .{worker}) catch null;
+        // without a thread the share is copied after the first one
+        if (thread.* == null) worker.run();
+    }
+    workers[0].run();
+    for (threads[1..thread_count]) |thread| {
+        if (thread) |t| t.join();
+    }
+
+    for (workers[0..thread_count]) |worker| {
+        if (worker.err) |err| return err;
+    }
+}
+
+// recreates the symlink at path in dest_dir with the target it has in source_dir
+// a link that leads out of the tree is not copied, the copy would point somewhere else
+fn copyLink(source_dir: std.fs.Dir, dest_dir: std.fs.Dir, path: []const u8) !void {
+    var target_buf: [std.fs.max_path_bytes]u8 = undefined;
+    const target = try source_dir.readLink(path, &target_buf);
+    if (!isContainedLink(path, target)) return error.LinkOutsideTree;
+    dest_dir.symLink(target, path, .{}) catch |err| switch (err) {
+        error.PathAlreadyExists => {
+            try dest_dir.deleteFile(path);
+            try dest_dir.symLink(target, path, .{});
+        },
+        else => return err,
+    };
+}
+
+// whether path in dest_dir already is the file at path in source_dir, as when a tree is
+// copied onto itself
+fn isSameFile(source_dir: std.fs.Dir, dest_dir: std.fs.Dir, path: []const u8) !bool {
+    if (builtin.os.tag == .windows) return false;
+    const dest = std.posix.fstatat(dest_dir.fd, path, 0) catch |err| switch (err) {
+        error.FileNotFound => return false,
+        else => return err,
+    };
+    const source = try std.posix.fstatat(source_dir.fd, path, 0);
+    return source.dev == dest.dev and source.ino == dest.ino;
+}
+
+// clones path from source_dir into dest_dir, false when the filesystem cannot clone it
+fn reflink(source_dir: std.fs.Dir, dest_dir: std.fs.Dir, path: []const u8) !bool {
+    const source = try source_dir.openFile(path, .{});
+    defer source.close();
+    const stat = try source.stat();
+
+    const dest = try dest_dir.createFile(path, .{ .mode = stat.mode });
+    defer dest.close();
+
+    const rc = std.os.linux.ioctl(dest.handle, FICLONE, @intCast(source.handle));
+    return std.os.linux.E.init(rc) == .SUCCESS;
+}
+
+fn hardlink(source_dir: std.fs.Dir, dest_dir: std.fs.Dir, path: []const u8) !void {
+    std.posix.linkat(source_dir.fd, path, dest_dir.fd, path, 0) catch |err| switch (err) {
+        error.PathAlreadyExists => {
+            try dest_dir.deleteFile(path);
+            try std.posix.linkat(source_dir.fd, path, dest_dir.fd, path, 0);
+        },
+        else => return err,
+    };
+}
+
+// whether a symlink at name, relative to the root of a tree, pointing at target stays
+// inside the tree: target is relative, its leading .. do not climb above the root, and
+// it has no .. after a name, which could step out of whatever that name links to
+pub fn isContainedLink(name: []const u8, target: []const u8) bool {
+    if (target.len == 0 or std.fs.path.isAbsolute(target)) return false;
+
+    // directories between the root and the link
+    var depth: usize = 0;
+    var name_components = std.mem.tokenizeAny(u8, name, "/\\");
+    while (name_components.next()) |component| {
+        if (!std.mem.eql(u8, component, ".")) depth += 1;
+    }
+    depth -|= 1;
+
+    var after_name = false;
+    var components = std.mem.tokenizeAny(u8, target, "/\\");
+    while (components.next()) |component| {
+        if (std.mem.eql(u8, component, ".")) continue;
+        if (std.mem.eql(u8, component, "..")) {
+            if (after_name or depth == 0) return false;
+            depth -= 1;
+        } else {
+            after_name = true;
+        }
+    }
+    return true;
+}
@@ -0,0 +1,125 @@
+const std = @import("std");
+const builtin = @import("builtin");
+
+// timing spans for seeing where install and dispatch time goes without a profiler
+//
+// with --trace or POPAMAN_TRACE=1 each span is written to stderr as one json line when it
+// ends, POPAMAN_TRACE=<path> appends the lines to that file instead. spans that never
+// measure anything cost a null check
+//
+//   {"span":"copy","us":5210,"bytes":1048576,"count":12,"detail":"/root/popaman/lib/foo"}
+//
+// us is the duration in microseconds, bytes and count are left out when a span has none
+
+var sink: ?std.fs.File = null;
+var sink_is_stderr = false;
+var file_mutex: std.Thread.Mutex = .{};
+var process_start: ?std.time.Instant = null;
+
+// picks the sink once at startup, force_stderr is the --trace flag
+pub fn init(force_stderr: bool) void {
+    process_start = std.time.Instant.now() catch null;
+    if (force_stderr) {
+        useStderr();
+        return;
+    }
+
+    var buf: [std.fs.max_path_bytes]u8 = undefined;
+    var fba = std.heap.FixedBufferAllocator.init(&buf);
+    const value = std.process.getEnvVarOwned(fba.allocator(), "POPAMAN_TRACE") catch return;
+    if (value.len == 0 or std.mem.eql(u8, value, "0")) return;
+    if (std.mem.eql(u8, value, "1") or std.mem.eql(u8, value, "stderr")) {
+        useStderr();
+        return;
+    }
+
+    sink = openAppend(value) catch |err| {
+        std.debug.print("Warning: Could not open trace file {s}: {any}\n", .{ value, err });
+        return;
+    };
+}
+
+pub fn enabled() bool {
+    return sink != null;
+}
+
+pub const Span = struct {
+    name: []const u8,
+    // must stay valid until end
+    detail: []const u8,
+    start: ?std.time.Instant,
+    bytes: ?u64 = null,
+    count: ?u64 = null,
+
+    pub fn end(self: *const Span) void {
+        const start = self.start orelse return;
+        const now = std.time.Instant.now() catch return;
+        emit(self, now.since(start) / std.time.ns_per_us);
+    }
+};
+
+pub fn begin(name: []const u8, detail: []const u8) Span {
+    return .{
+        .name = name,
+        .detail = detail,
+        .start = if (sink != null) std.time.Instant.now() catch null else null,
+    };
+}
+
+// a span that started with popaman itself, for the time spent before handing over to a package
+pub fn beginAtStart(name: []const u8, detail: []const u8) Span {
+    return .{
+        .name = name,
+        .detail = detail,
+        .start = if (sink != null) process_start else null,
+    };
+}
+
+const Line = struct {
+    span: []const u8,
+    us: u64,
+    bytes: ?u64,
+    count: ?u64,
+    detail: []const u8,
+};
+
+fn emit(span: *const Span, us: u64) void {
+    const file = sink orelse return;
+
+    var line = Line{ .span = span.name, .us = us, .bytes = span.bytes, .count = span.count, .detail = span.detail };
+    var buf: [4096]u8 = undefined;
+    var stream = std.io.fixedBufferStream(&buf);
+    std.json.stringify(line, .{ .emit_null_optional_fields = false }, stream.writer()) catch {
+        // a detail too long for the buffer is dropped rather than the whole span
+        stream.reset();
+        line.detail = "";
+        std.json.stringify(line, .{ .emit_null_optional_fields = false }, stream.writer()) catch return;
+    };
+    stream.writer().writeByte('\n') catch return;
+
+    // one write per line keeps lines from concurrent threads and processes whole
+    if (sink_is_stderr) {
+        std.debug.lockStdErr();
+        defer std.debug.unlockStdErr();
+        file.writeAll(stream.getWritten()) catch {};
+    } else {
+        file_mutex.lock();
+        defer file_mutex.unlock();
+        if (builtin.os.tag == .windows) file.seekFromEnd(0) catch {};
+        file.writeAll(stream.getWritten()) catch {};
+    }
+}
+
+fn useStderr() void {
+    sink = std.io.getStdErr();
+    sink_is_stderr = true;
+}
+
+fn openAppend(path: []const u8) !std.fs.File {
+    if (builtin.os.tag == .windows) {
+        return std.fs.cwd().createFile(path, .{ .truncate = false });
+    }
+    // O_APPEND makes every write land at the end, even with other processes writing too
+    const fd = try std.posix.open(path, .{ .ACCMODE = .WRONLY, .CREAT = true, .APPEND = true, .CLOEXEC = true }, 0o644);
+    return .{ .handle = fd };
+}
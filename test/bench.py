@@ -0,0 +1,749 @@
+import os
+import json
+import time
+import random
+import itertools
+import shutil
+import tarfile
+import asyncio
+import argparse
+import platform
+import tempfile
+import subprocess
+from pathlib import Path
+
+from test import (
+    AssetTracker,
+    COMMAND_TIMEOUT,
+    run_command,
+    install_prompts,
+    create_sandbox,
+    populate_registry,
+    SetupCache,
+    build_installer,
+    install_popaman,
+    build_test_package,
+    create_test_archives,
+    write_zip,
+    write_tar,
+    SPAN_PREFIX,
+    TRACE_SPANS,
+    can_measure_usage,
+    with_usage_helper,
+    read_usage,
+    git_commit,
+)
+
+# the archive fixture tracked in the repository, the other archives are generated
+FIXTURE_ZIP = Path('test') / 'archives' / 'test-package.zip'
+
+def percentile(samples, pct):
+    """Linear-interpolated percentile of a list of numbers"""
+    ordered = sorted(samples)
+    if not ordered:
+        return None
+    rank = (len(ordered) - 1) * pct / 100
+    low = int(rank)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+def summarize(samples):
+    return {
+        'n': len(samples),
+        'min': min(samples),
+        'max': max(samples),
+        'mean': sum(samples) / len(samples),
+        'p50': percentile(samples, 50),
+        'p95': percentile(samples, 95),
+        'p99': percentile(samples, 99),
+        'samples': samples,
+    }
+
+class BenchTracker:
+    def __init__(self, iterations, warmup):
+        self.iterations = iterations
+        self.warmup = warmup
+        self.samples = {}  # benchmark name -> list of seconds
+        self.written = {}  # benchmark name -> list of bytes written to disk
+        self.peak_rss = {}  # benchmark name -> list of peak resident set sizes in bytes
+        self.skipped = {}  # benchmark name -> reason
+        self.cells = {}  # benchmark name -> corpus cell it installed and the spans of each install
+
+    def add(self, name, seconds):
+        self.samples.setdefault(name, []).append(seconds)
+
+    def add_written(self, name, written):
+        self.written.setdefault(name, []).append(written)
+
+    def add_peak_rss(self, name, peak):
+        self.peak_rss.setdefault(name, []).append(peak)
+
+    def skip(self, name, reason):
+        self.skipped[name] = reason
+
+    def results(self):
+        return {name: summarize(samples) for name, samples in self.samples.items() if samples}
+
+    def report(self):
+        print("\n=== Benchmark Results (ms) ===")
+        print(f"{'benchmark':<24}{'n':>5}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}")
+        for name, stats in self.results().items():
+            print(f"{name:<24}{stats['n']:>5}"
+                  f"{stats['p50'] * 1000:>10.2f}{stats['p95'] * 1000:>10.2f}"
+                  f"{stats['p99'] * 1000:>10.2f}{stats['max'] * 1000:>10.2f}")
+        for name, reason in self.skipped.items():
+            print(f"{name:<24} skipped: {reason}")
+        if self.written:
+            print("\n=== Bytes Written (MB) ===")
+            print(f"{'benchmark':<24}{'n':>5}{'p50':>10}{'max':>10}")
+            for name, samples in self.written.items():
+                if None in samples:
+                    print(f"{name:<24}{len(samples):>5}{'n/a':>10}{'n/a':>10}")
+                    continue
+                print(f"{name:<24}{len(samples):>5}{percentile(samples, 50) / 2**20:>10.1f}{max(samples) / 2**20:>10.1f}")
+        if self.peak_rss:
+            print("\n=== Peak RSS (MB) ===")
+            print(f"{'benchmark':<24}{'n':>5}{'p50':>10}{'max':>10}")
+            for name, samples in self.peak_rss.items():
+                print(f"{name:<24}{len(samples):>5}{percentile(samples, 50) / 2**20:>10.1f}{max(samples) / 2**20:>10.1f}")
+
+    def to_json(self):
+        return {
+            'meta': {
+                'commit': git_commit(),
+                'platform': platform.platform(),
+                'python': platform.python_version(),
+                'iterations': self.iterations,
+                'warmup': self.warmup,
+                'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            },
+            'results': self.results(),
+            'written': {name: None if None in samples else summarize(samples)
+                        for name, samples in self.written.items()},
+            'peak_rss': {name: summarize(samples) for name, samples in self.peak_rss.items()},
+            'throughput': corpus_rows(self),
+            'skipped': self.skipped,
+        }
+
+async def timed_command(command, prompts=None, timeout=COMMAND_TIMEOUT):
+    """Run a command and return its wall time, raising if it fails"""
+    start = time.perf_counter()
+    returncode, stdout, stderr = await run_command(command, prompts=prompts, timeout=timeout)
+    elapsed = time.perf_counter() - start
+    if returncode != 0:
+        raise RuntimeError(f"{' '.join(map(str, command))} failed: {stderr}")
+    return elapsed
+
+async def bench_command(bench, name, command):
+    for i in range(bench.warmup + bench.iterations):
+        elapsed = await timed_command(command)
+        if i >= bench.warmup:
+            bench.add(name, elapsed)
+
+async def bench_install_remove(bench, sandbox, kind, source, link=False):
+    """Time installing a source and removing it again, once per iteration"""
+    popaman = str(sandbox.get_file('popaman_exe').absolute())
+    keyword = f'bench-{kind}'
+    for i in range(bench.warmup + bench.iterations):
+        command = [popaman, 'link' if link else 'install', str(Path(source).absolute())]
+        install_time = await timed_command(command, prompts=install_prompts(keyword))
+        remove_time = await timed_command([popaman, 'remove', keyword])
+        if i >= bench.warmup:
+            bench.add(f'install:{kind}', install_time)
+            bench.add(f'remove:{kind}', remove_time)
+
+async def bench_latency(bench, ass_tracker, sandbox):
+    popaman = str(sandbox.get_file('popaman_exe').absolute())
+    test_package = str(ass_tracker.get_file('test_package').absolute())
+
+    # a resident package for list and dispatch to find
+    await timed_command([popaman, 'install', str(ass_tracker.get_directory('test_package_dir').absolute())],
+                        prompts=install_prompts('bench-hello'))
+
+    await bench_command(bench, 'direct', [test_package])
+    await bench_command(bench, 'dispatch', [popaman, 'bench-hello'])
+
+    # the same package started from its global shim in bin/, without popaman in between
+    bin_dir = sandbox.get_file('popaman_exe').parent
+    modes = ['cmd'] if os.name == 'nt' else ['symlink', 'script']
+    for mode in modes:
+        os.environ['POPAMAN_SHIM'] = mode
+        try:
+            await timed_command([popaman, 'globalize', 'bench-hello', '-a'])
+        finally:
+            os.environ.pop('POPAMAN_SHIM', None)
+        shim = bin_dir / ('bench-hello.cmd' if os.name == 'nt' else 'bench-hello')
+        await bench_command(bench, f'shim:{mode}', [str(shim)])
+
+    await bench_command(bench, 'list', [popaman, 'list'])
+    await bench_command(bench, 'list -v', [popaman, 'list', '-v'])
+
+    sources = [
+        ('dir', ass_tracker.get_directory('test_package_dir'), False),
+        ('link', ass_tracker.get_directory('test_package_dir'), True),
+        ('exe', ass_tracker.get_file('test_package'), False),
+        ('7z', ass_tracker.get_archive('7z'), False),
+        ('zip', ass_tracker.get_archive('zip'), False),
+    ]
+    for kind, source, link in sources:
+        if not source or not Path(source).exists():
+            bench.skip(f'install:{kind}', 'source not available')
+            continue
+        try:
+            await bench_install_remove(bench, sandbox, kind, source, link)
+        except Exception as e:
+            bench.skip(f'install:{kind}', str(e).splitlines()[0])
+
+async def bench_scaling_size(bench, ass_tracker, sandbox, size, timeout):
+    """Time list, dispatch, install and remove against a registry of `size` synthetic entries"""
+    popaman = str(sandbox.get_file('popaman_exe').absolute())
+    source = str(ass_tracker.get_directory('test_package_dir').absolute())
+    await asyncio.to_thread(populate_registry, sandbox, size)
+
+    # installed after the synthetic entries so dispatch has to scan past all of them
+    await timed_command([popaman, 'install', source], prompts=install_prompts('bench-hello'), timeout=timeout)
+
+    commands = [
+        ('list', [popaman, 'list'], None),
+        ('list -v', [popaman, 'list', '-v'], None),
+        ('dispatch', [popaman, 'bench-hello'], None),
+        ('install', [popaman, 'install', source], install_prompts('bench-scale')),
+        ('remove', [popaman, 'remove', 'bench-scale'], None),
+    ]
+    timed_out = set()
+    for i in range(bench.warmup + bench.iterations):
+        for name, command, prompts in commands:
+            label = f'{name}@{size}'
+            # remove needs the install of the same iteration to have happened
+            if label in timed_out or (name == 'remove' and f'install@{size}' in timed_out):
+                continue
+            try:
+                elapsed = await timed_command(command, prompts=prompts, timeout=timeout)
+            except Exception as e:
+                timed_out.add(label)
+                bench.skip(label, str(e).splitlines()[0])
+                continue
+            if i >= bench.warmup:
+                bench.add(label, elapsed)
+
+    await measure_scaling_rss(bench, ass_tracker, popaman, source, size)
+
+async def measure_scaling_rss(bench, ass_tracker, popaman, source, size):
+    """Peak RSS of each registry command at `size` entries. install goes through apply,
+    which needs no prompts, so it can run with stdin closed like the others"""
+    if not can_measure_usage():
+        bench.skip(f'rss@{size}', 'needs os.posix_spawnp')
+        return
+    manifest_path = Path(tempfile.mkdtemp(prefix='popaman-rss-')) / 'bench.json'
+    try:
+        with open(manifest_path, 'w') as f:
+            json.dump({'package': [{'source': source, 'keyword': 'bench-rss',
+                                    'exe': ass_tracker.get_file('test_package').name}]}, f)
+        commands = [
+            ('list', [popaman, 'list']),
+            ('list -v', [popaman, 'list', '-v']),
+            ('dispatch', [popaman, 'bench-hello']),
+            ('install', [popaman, 'apply', str(manifest_path)]),
+            ('remove', [popaman, 'remove', 'bench-rss']),
+        ]
+        for name, command in commands:
+            label = f'{name}@{size}'
+            try:
+                _, _, peak = await asyncio.to_thread(measured_run, command, dict(os.environ))
+            except Exception as e:
+                bench.skip(f'rss:{label}', str(e).splitlines()[0])
+                continue
+            bench.add_peak_rss(label, peak)
+    finally:
+        await asyncio.to_thread(shutil.rmtree, manifest_path.parent, True)
+
+async def bench_scaling(bench, ass_tracker, sizes, timeout):
+    for size in sizes:
+        print(f"\nBenchmarking registry of {size} packages...")
+        sandbox_root = tempfile.mkdtemp(prefix=f'popaman-scale-{size}-')
+        try:
+            sandbox = create_sandbox(ass_tracker, sandbox_root)
+            await bench_scaling_size(bench, ass_tracker, sandbox, size, timeout)
+        finally:
+            await asyncio.to_thread(shutil.rmtree, sandbox_root, True)
+
+def children_written():
+    """Bytes all finished child processes wrote to disk, from their block output counts.
+    None where there is no resource module to count them, as on windows"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    return resource.getrusage(resource.RUSAGE_CHILDREN).ru_oublock * 512
+
+def make_large_package(root, test_package, size_mb, file_count):
+    """A package directory with the test executable, size_mb of incompressible data and
+    file_count small files spread over nested directories, the way SDKs are laid out"""
+    package_dir = Path(root) / 'large-package'
+    package_dir.mkdir()
+    shutil.copy2(test_package, package_dir / test_package.name)
+    with open(package_dir / 'data.bin', 'wb') as f:
+        for _ in range(size_mb):
+            f.write(os.urandom(2**20))
+    for i in range(file_count):
+        path = package_dir / 'include' / f'group{i % 16}' / f'sub{i % 7}' / f'header{i}.h'
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(os.urandom(4096))
+    return package_dir
+
+def touch_tree(root):
+    """Bump the mtime of every file under root without changing its content"""
+    for path in Path(root).rglob('*'):
+        if path.is_file():
+            path.touch()
+
+async def bench_volume(bench, ass_tracker, sandbox, size_mb, file_count):
+    """Time installs of a size_mb package and count the bytes each one writes to disk"""
+    popaman = str(sandbox.get_file('popaman_exe').absolute())
+    test_package = ass_tracker.get_file('test_package')
+    work_dir = tempfile.mkdtemp(prefix='popaman-volume-')
+    try:
+        package_dir = await asyncio.to_thread(make_large_package, work_dir, test_package, size_mb, file_count)
+
+        # trailing data does not stop the executable from running
+        large_exe = Path(work_dir) / f'large{test_package.suffix or ".exe"}'
+        with open(large_exe, 'wb') as f:
+            f.write(test_package.read_bytes())
+            f.write((package_dir / 'data.bin').read_bytes())
+        large_exe.chmod(0o755)
+
+        # stored without compression, the cost being measured is extraction and placement
+        tar_archive = Path(work_dir) / 'large-package.tar'
+        with tarfile.open(tar_archive, 'w') as tar:
+            for path in sorted(package_dir.iterdir()):
+                tar.add(path, arcname=path.name)
+        archive = Path(work_dir) / 'large-package.7z'
+        sources = [('dir', package_dir), ('exe', large_exe), ('tar', tar_archive)]
+        try:
+            await timed_command([popaman, '7zr', 'a', '-mx0', str(archive), str(package_dir / '*')])
+            sources.append(('7z', archive))
+        except Exception as e:
+            bench.skip(f'volume:7z', str(e).splitlines()[0])
+
+        # 'default' is what users get: the cache on with its default cap
+        for cache in ('nocache', 'default'):
+            if cache == 'nocache':
+                os.environ['POPAMAN_CACHE_SIZE'] = '0'
+            else:
+                os.environ.pop('POPAMAN_CACHE_SIZE', None)
+            for kind, source in sources:
+                name = f'volume:{kind}:{cache}'
+                for i in range(bench.warmup + bench.iterations):
+                    before = children_written()
+                    elapsed = await timed_command([popaman, 'install', str(source)],
+                                                  prompts=install_prompts('bench-volume'))
+                    written = None if before is None else children_written() - before
+                    await timed_command([popaman, 'remove', 'bench-volume'])
+                    if i >= bench.warmup:
+                        bench.add(name, elapsed)
+                        bench.add_written(name, written)
+
+        # verify trusts files whose size and mtime match the manifest, and hashes the
+        # rest. touching every file first makes it hash the whole package
+        await timed_command([popaman, 'install', str(package_dir)], prompts=install_prompts('bench-verify'))
+        lib_dir = sandbox.get_packages_json().parent / 'bench-verify'
+        for i in range(bench.warmup + bench.iterations):
+            cached = await timed_command([popaman, 'verify', 'bench-verify'])
+            await asyncio.to_thread(touch_tree, lib_dir)
+            hashed = await timed_command([popaman, 'verify', 'bench-verify'])
+            if i >= bench.warmup:
+                bench.add('verify:cached', cached)
+                bench.add('verify:hashed', hashed)
+        await timed_command([popaman, 'remove', 'bench-verify'])
+    finally:
+        os.environ.pop('POPAMAN_CACHE_SIZE', None)
+        await asyncio.to_thread(shutil.rmtree, work_dir, True)
+
+def measured_run(command, env):
+    """Run a command to completion and return its wall time, stderr and peak RSS in bytes.
+    The peak covers the command and every process it waited for, so 7zr started by popaman
+    is included. It is never below the few MB of the helper interpreter, and the wall time
+    includes that interpreter starting"""
+    fd, usage_path = tempfile.mkstemp(prefix='popaman-usage-')
+    os.close(fd)
+    try:
+        start = time.perf_counter()
+        proc = subprocess.run(with_usage_helper(command, usage_path), stdin=subprocess.DEVNULL,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, env=env)
+        elapsed = time.perf_counter() - start
+        stderr = proc.stderr.decode(errors='replace')
+        if proc.returncode != 0:
+            errors = ''.join(line for line in stderr.splitlines(keepends=True) if not line.startswith(SPAN_PREFIX))
+            raise RuntimeError(f"{' '.join(map(str, command))} failed: {errors}")
+        usage = read_usage(usage_path)
+    finally:
+        os.unlink(usage_path)
+    return elapsed, stderr, usage['maxrss']
+
+def extract_seconds(stderr):
+    """Duration of the extraction span of a traced install, native or 7zr"""
+    for line in stderr.splitlines():
+        if line.startswith(SPAN_PREFIX):
+            span = json.loads(line)
+            if span['span'] in ('extract', '7zr'):
+                return span['us'] / 1e6
+    raise RuntimeError("install did not trace an extraction")
+
+async def bench_extract(bench, ass_tracker, sandbox, size_mb, file_count):
+    """Time extracting zip, tar.gz and 7z archives and record the peak memory of each install,
+    natively and through 7zr, with the cache off so every install extracts. the tracked
+    fixture is measured alongside the small and large archives generated here"""
+    if not can_measure_usage():
+        bench.skip('extract', 'needs os.posix_spawnp')
+        return
+    popaman = str(sandbox.get_file('popaman_exe').absolute())
+    test_package = ass_tracker.get_file('test_package')
+    work_dir = tempfile.mkdtemp(prefix='popaman-extract-')
+    try:
+        package_dir = await asyncio.to_thread(make_large_package, work_dir, test_package, size_mb, file_count)
+        contents = sorted(package_dir.iterdir())
+        archives = [
+            ('fixture.zip', FIXTURE_ZIP),
+            ('small.zip', ass_tracker.get_archive('zip')),
+            ('small.tar.gz', ass_tracker.get_archive('tar')),
+            ('small.7z', ass_tracker.get_archive('7z')),
+        ]
+        for name, writer in (('large.zip', write_zip), ('large.tar.gz', write_tar)):
+            path = Path(work_dir) / name
+            await asyncio.to_thread(writer, path, contents)
+            archives.append((name, path))
+        try:
+            large_7z = Path(work_dir) / 'large.7z'
+            await timed_command([popaman, '7zr', 'a', str(large_7z)] + [str(path) for path in contents])
+            archives.append(('large.7z', large_7z))
+        except Exception as e:
+            bench.skip('extract:large.7z:7zr', str(e).splitlines()[0])
+
+        manifest_path = Path(work_dir) / 'bench.json'
+        for name, archive in archives:
+            if not archive or not Path(archive).exists():
+                bench.skip(f'extract:{name}', 'archive not available')
+                continue
+            # 7zr cannot unpack a compressed tarball in one step and 7z has no native path
+            if name.endswith('.zip'):
+                modes = ['native', '7zr']
+            else:
+                modes = ['7zr'] if name.endswith('.7z') else ['native']
+            entry = {'source': str(Path(archive).absolute()), 'keyword': 'bench-extract'}
+            # the fixture was built elsewhere, its only executable is found without a name
+            if archive != FIXTURE_ZIP:
+                entry['exe'] = test_package.name
+            with open(manifest_path, 'w') as f:
+                json.dump({'package': [entry]}, f)
+            for mode in modes:
+                label = f'extract:{name}:{mode}'
+                env = dict(os.environ, POPAMAN_TRACE='1', POPAMAN_CACHE_SIZE='0',
+                           POPAMAN_EXTRACT='7zr' if mode == '7zr' else 'auto')
+                try:
+                    for i in range(bench.warmup + bench.iterations):
+                        _, stderr, peak = await asyncio.to_thread(measured_run, [popaman, 'apply', str(manifest_path)], env)
+                        await timed_command([popaman, 'remove', 'bench-extract'])
+                        if i >= bench.warmup:
+                            bench.add(label, extract_seconds(stderr))
+                            bench.add_peak_rss(label, peak)
+                except Exception as e:
+                    bench.skip(label, str(e).splitlines()[0])
+                    await run_command([popaman, 'remove', 'bench-extract'])
+    finally:
+        await asyncio.to_thread(shutil.rmtree, work_dir, True)
+
+CORPUS_FORMATS = ['zip', 'tar', 'tar.gz', 'tar.xz', 'tar.zst', '7z']
+CORPUS_FANOUT = 8
+CORPUS_TEXT_BLOCK = 4096
+
+def corpus_file_path(index, depth):
+    """Where the index-th data file of a corpus tree goes, depth directories down. Consecutive
+    files land in different directories, so every level fills up evenly"""
+    parts = [f'dir{index // CORPUS_FANOUT ** level % CORPUS_FANOUT}' for level in range(depth)]
+    return Path(*parts, f'file{index}.dat')
+
+def write_corpus_data(f, size, compressibility, rng, text):
+    """size bytes of which the compressible fraction repeats a block of text and the rest is random"""
+    remaining = round(size * compressibility)
+    while remaining > 0:
+        chunk = text[:remaining]
+        f.write(chunk)
+        remaining -= len(chunk)
+    remaining = size - round(size * compressibility)
+    while remaining > 0:
+        chunk = min(remaining, 2**20)
+        f.write(rng.randbytes(chunk))
+        remaining -= chunk
+
+def make_corpus_tree(root, test_package, size_mb, file_count, depth, compressibility):
+    """A package directory with the test executable and file_count data files of size_mb in
+    total, depth directories down. compressibility is the fraction of every file that
+    compresses away. The same parameters always give the same bytes"""
+    package_dir = Path(root)
+    package_dir.mkdir(parents=True)
+    shutil.copy2(test_package, package_dir / test_package.name)
+    rng = random.Random(f'{size_mb}-{file_count}-{depth}-{compressibility}')
+    text = bytes(rng.choice(b'abcdefghijklmnopqrstuvwxyz \n') for _ in range(CORPUS_TEXT_BLOCK))
+    total = round(size_mb * 2**20)
+    for i in range(file_count):
+        path = package_dir / corpus_file_path(i, depth)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, 'wb') as f:
+            write_corpus_data(f, total // file_count + (i < total % file_count), compressibility, rng, text)
+    return package_dir
+
+async def write_corpus_archive(popaman, package_dir, archive):
+    """Pack the contents of package_dir into archive, in the format its extension names"""
+    contents = sorted(package_dir.iterdir())
+    name = archive.name
+    if name.endswith('.zip'):
+        await asyncio.to_thread(write_zip, archive, contents)
+    elif name.endswith('.7z'):
+        # 7zr expands the wildcard itself, an 80k file tree would not fit on a command line
+        await timed_command([popaman, '7zr', 'a', str(archive), str(package_dir / '*')], timeout=None)
+    elif name.endswith('.tar.zst'):
+        # python only writes zstd from 3.14 on, the zstd tool compresses the tarball instead
+        zstd = shutil.which('zstd')
+        if not zstd:
+            raise RuntimeError("zstd not found")
+        tarball = archive.with_suffix('')
+        await asyncio.to_thread(write_tar, tarball, contents)
+        await timed_command([zstd, '-q', '-f', '--rm', str(tarball), '-o', str(archive)], timeout=None)
+    else:
+        await asyncio.to_thread(write_tar, archive, contents)
+
+def corpus_label(size_mb, file_count, depth, compressibility, format_name):
+    return f'corpus:{size_mb}MB:{file_count}f:d{depth}:c{compressibility}:{format_name}'
+
+async def bench_corpus(bench, ass_tracker, sandbox, matrix, timeout):
+    """Install every cell of an archive matrix, one generated tree per combination of size,
+    file count, depth and compressibility packed in every format, with the cache off so
+    every install extracts. The extract and record spans of each install are kept"""
+    popaman = str(sandbox.get_file('popaman_exe').absolute())
+    test_package = ass_tracker.get_file('test_package')
+    work_dir = Path(tempfile.mkdtemp(prefix='popaman-corpus-'))
+    manifest_path = work_dir / 'bench.json'
+    os.environ['POPAMAN_CACHE_SIZE'] = '0'
+    os.environ['POPAMAN_TRACE'] = '1'
+    try:
+        for size_mb, file_count, depth, compressibility in itertools.product(
+                matrix['sizes'], matrix['files'], matrix['depths'], matrix['compressibility']):
+            tree_dir = work_dir / 'tree'
+            package_dir = await asyncio.to_thread(make_corpus_tree, tree_dir, test_package,
+                                                  size_mb, file_count, depth, compressibility)
+            for format_name in matrix['formats']:
+                label = corpus_label(size_mb, file_count, depth, compressibility, format_name)
+                archive = work_dir / f'corpus.{format_name}'
+                try:
+                    await write_corpus_archive(popaman, package_dir, archive)
+                    with open(manifest_path, 'w') as f:
+                        json.dump({'package': [{'source': str(archive), 'keyword': 'bench-corpus',
+                                                'exe': test_package.name}]}, f)
+                    spans = {}
+                    for i in range(bench.warmup + bench.iterations):
+                        token = TRACE_SPANS.set([])
+                        try:
+                            elapsed = await timed_command([popaman, 'apply', str(manifest_path)], timeout=timeout)
+                            install_spans = TRACE_SPANS.get()
+                        finally:
+                            TRACE_SPANS.reset(token)
+                        await timed_command([popaman, 'remove', 'bench-corpus'], timeout=timeout)
+                        if i >= bench.warmup:
+                            bench.add(label, elapsed)
+                            for span in install_spans:
+                                # 7z archives are extracted by 7zr
+                                name = 'extract' if span['span'] == '7zr' else span['span']
+                                spans.setdefault(name, [0.0] * bench.iterations)[i - bench.warmup] += span['us'] / 1e6
+                    bench.cells[label] = {
+                        'format': format_name,
+                        'size_mb': size_mb,
+                        'files': file_count + 1,
+                        'depth': depth,
+                        'compressibility': compressibility,
+                        'bytes': test_package.stat().st_size + round(size_mb * 2**20),
+                        'archive_bytes': archive.stat().st_size,
+                        'spans': spans,
+                    }
+                except Exception as e:
+                    bench.skip(label, str(e).splitlines()[0])
+                    await run_command([popaman, 'remove', 'bench-corpus'])
+                finally:
+                    archive.unlink(missing_ok=True)
+            await asyncio.to_thread(shutil.rmtree, tree_dir, True)
+    finally:
+        os.environ.pop('POPAMAN_CACHE_SIZE', None)
+        os.environ.pop('POPAMAN_TRACE', None)
+        await asyncio.to_thread(shutil.rmtree, work_dir, True)
+
+def corpus_rows(bench):
+    """One row per installed corpus cell with the p50 install time, how it splits into
+    extraction, recording the manifest and the rest, and the throughput at the p50"""
+    results = bench.results()
+    rows = []
+    for label, cell in bench.cells.items():
+        p50 = results[label]['p50']
+        no_span = [0.0] * len(bench.samples[label])
+        extract = cell['spans'].get('extract', no_span)
+        record = cell['spans'].get('record', no_span)
+        rest = [total - e - r for total, e, r in zip(bench.samples[label], extract, record)]
+        rows.append({
+            'benchmark': label,
+            **{key: value for key, value in cell.items() if key != 'spans'},
+            'p50': p50,
+            'extract_p50': percentile(extract, 50),
+            'record_p50': percentile(record, 50),
+            'rest_p50': percentile(rest, 50),
+            'mb_per_s': cell['bytes'] / 2**20 / p50,
+            'files_per_s': cell['files'] / p50,
+        })
+    return rows
+
+def report_corpus(bench, table_path):
+    """Print the throughput of every corpus cell as a markdown table and write it to table_path"""
+    lines = [
+        '| format | MB | files | depth | compressibility | archive MB | p50 ms | extract ms | record ms | rest ms | MB/s | files/s |',
+        '|---|--:|--:|--:|--:|--:|--:|--:|--:|--:|--:|--:|',
+    ]
+    for row in corpus_rows(bench):
+        lines.append(f"| {row['format']} | {row['bytes'] / 2**20:.1f} | {row['files']} | {row['depth']} "
+                     f"| {row['compressibility']} | {row['archive_bytes'] / 2**20:.1f} | {row['p50'] * 1000:.1f} "
+                     f"| {row['extract_p50'] * 1000:.1f} | {row['record_p50'] * 1000:.1f} | {row['rest_p50'] * 1000:.1f} "
+                     f"| {row['mb_per_s']:.1f} | {row['files_per_s']:.0f} |")
+    table = '\n'.join(lines) + '\n'
+    print("\n=== Install Throughput ===")
+    print(table, end='')
+    with open(table_path, 'w') as f:
+        f.write(table)
+    print(f"\nWrote throughput table to {table_path}")
+
+def report_curve(bench, sizes):
+    """p50 of every scaling benchmark as one row per command and one column per registry size"""
+    results = bench.results()
+    print("\n=== Registry Scaling, p50 (ms) ===")
+    print(f"{'command':<12}" + ''.join(f"{size:>12}" for size in sizes))
+    for name in ('list', 'list -v', 'dispatch', 'install', 'remove'):
+        row = f"{name:<12}"
+        for size in sizes:
+            stats = results.get(f'{name}@{size}')
+            row += f"{stats['p50'] * 1000:>12.2f}" if stats else f"{'timeout':>12}"
+        print(row)
+
+    print("\n=== Registry Scaling, peak RSS (MB) ===")
+    print(f"{'command':<12}" + ''.join(f"{size:>12}" for size in sizes))
+    for name in ('list', 'list -v', 'dispatch', 'install', 'remove'):
+        row = f"{name:<12}"
+        for size in sizes:
+            samples = bench.peak_rss.get(f'{name}@{size}')
+            row += f"{max(samples) / 2**20:>12.1f}" if samples else f"{'-':>12}"
+        print(row)
+
+def compare(results, baseline_path):
+    """Print the p50/p95 change of every benchmark against a stored run"""
+    with open(baseline_path) as f:
+        baseline = json.load(f)['results']
+    print(f"\n=== Compared to {baseline_path} ===")
+    for name, stats in results.items():
+        if name not in baseline:
+            continue
+        for key in ('p50', 'p95'):
+            before, after = baseline[name][key], stats[key]
+            change = (after - before) / before * 100 if before else 0.0
+            print(f"{name:<24}{key:>5}{before * 1000:>10.2f} -> {after * 1000:>8.2f} ms ({change:+.1f}%)")
+
+async def setup(ass_tracker):
+    """Build popaman and the test package the same way test.py does"""
+    cache = SetupCache()
+    await build_installer(cache)
+    await install_popaman(ass_tracker, cache)
+    await build_test_package(ass_tracker, cache)
+    try:
+        await create_test_archives(ass_tracker, cache)
+    except Exception as e:
+        print(f"Warning: archives unavailable, skipping archive installs: {e}")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmarks for Popaman')
+    parser.add_argument('suite', nargs='?', default='latency',
+                        choices=['latency', 'scaling', 'volume', 'extract', 'corpus'],
+                        help='latency: per-command timings, scaling: timings and peak memory against growing registries, '
+                             'volume: time and bytes written installing a large package, '
+                             'extract: extraction time and peak memory of native extraction and 7zr, '
+                             'corpus: install throughput across a matrix of generated archives')
+    parser.add_argument('-n', '--iterations', type=int,
+                        help='Timed iterations per benchmark, 20 by default and 3 for the corpus suite')
+    parser.add_argument('--warmup', type=int, default=1, help='Untimed iterations before measuring')
+    parser.add_argument('--output', type=Path, default=Path('bench_output.json'), help='Where to write JSON results')
+    parser.add_argument('--compare', type=Path, help='Earlier JSON results to compare against')
+    parser.add_argument('--sizes', default='1000,10000,100000',
+                        help='Comma separated registry sizes for the scaling suite')
+    parser.add_argument('--size-mb', type=int, default=256, help='Package size for the volume and extract suites')
+    parser.add_argument('--files', type=int, default=2000, help='Small files in the volume and extract suite package')
+    parser.add_argument('--timeout', type=float, default=COMMAND_TIMEOUT,
+                        help='Seconds before a command counts as broken at a registry size or corpus cell')
+    parser.add_argument('--corpus-sizes', default='1,64', help='Comma separated package sizes in MB for the corpus suite')
+    parser.add_argument('--corpus-files', default='1,1000',
+                        help='Comma separated data file counts for the corpus suite, the executable comes on top')
+    parser.add_argument('--corpus-depths', default='0,4', help='Comma separated directory depths for the corpus suite')
+    parser.add_argument('--corpus-compressibility', default='0,0.9',
+                        help='Comma separated fractions of each file that compress away, for the corpus suite')
+    parser.add_argument('--corpus-formats', default=','.join(CORPUS_FORMATS),
+                        help='Comma separated archive formats for the corpus suite')
+    parser.add_argument('--table', type=Path, default=Path('bench_corpus.md'),
+                        help='Where to write the corpus throughput table')
+    args = parser.parse_args()
+    if args.iterations is None:
+        args.iterations = 3 if args.suite == 'corpus' else 20
+    unknown = set(args.corpus_formats.split(',')) - set(CORPUS_FORMATS)
+    if unknown:
+        parser.error(f"unknown corpus formats: {', '.join(sorted(unknown))}")
+    return args
+
+def corpus_matrix(args):
+    return {
+        'sizes': [float(size) if '.' in size else int(size) for size in args.corpus_sizes.split(',')],
+        'files': [int(count) for count in args.corpus_files.split(',')],
+        'depths': [int(depth) for depth in args.corpus_depths.split(',')],
+        'compressibility': [float(fraction) for fraction in args.corpus_compressibility.split(',')],
+        'formats': args.corpus_formats.split(','),
+    }
+
+async def main():
+    args = parse_args()
+    ass_tracker = AssetTracker()
+    bench = BenchTracker(args.iterations, args.warmup)
+
+    print("++ Benchmarking Popaman ++")
+    await setup(ass_tracker)
+
+    if args.suite == 'scaling':
+        sizes = [int(size) for size in args.sizes.split(',')]
+        await bench_scaling(bench, ass_tracker, sizes, args.timeout)
+    else:
+        sandbox_root = tempfile.mkdtemp(prefix='popaman-bench-')
+        try:
+            sandbox = create_sandbox(ass_tracker, sandbox_root)
+            if args.suite == 'volume':
+                await bench_volume(bench, ass_tracker, sandbox, args.size_mb, args.files)
+            elif args.suite == 'extract':
+                await bench_extract(bench, ass_tracker, sandbox, args.size_mb, args.files)
+            elif args.suite == 'corpus':
+                await bench_corpus(bench, ass_tracker, sandbox, corpus_matrix(args), args.timeout)
+            else:
+                await bench_latency(bench, ass_tracker, sandbox)
+        finally:
+            shutil.rmtree(sandbox_root, ignore_errors=True)
+
+    bench.report()
+    if args.suite == 'scaling':
+        report_curve(bench, sizes)
+    elif args.suite == 'corpus':
+        report_corpus(bench, args.table)
+    with open(args.output, 'w') as f:
+        json.dump(bench.to_json(), f, indent=2)
+    print(f"\nWrote results to {args.output}")
+
+    if args.compare:
+        compare(bench.results(), args.compare)
+
+if __name__ == "__main__":
+    asyncio.run(main())
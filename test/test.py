@@ -1,4 +1,5 @@
 import os
+import io
 import shutil
 import time
 import asyncio
@@ -6,7 +7,22 @@ from pathlib import Path
 import sys
 import tempfile
 import json
+import re
+import signal
+import platform
+import subprocess
 import argparse
+import tarfile
+import zipfile
+import copy
+import struct
+import threading
+import contextlib
+import contextvars
+import hashlib
+import inspect
+import xml.etree.ElementTree as ET
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 
 class AssetTracker:
     def __init__(self):
@@ -25,6 +41,7 @@ class AssetTracker:
             'archives': {  # Dictionary of archive files
                 '7z': None,
                 'zip': None,
+                'tar': None,
             }
         }
     
@@ -52,6 +69,13 @@ class AssetTracker:
     def get_archive(self, format):
         return self.files['archives'].get(format)
     
+    def get_packages_json(self):
+        """packages.json of the popaman root this tracker points at"""
+        popaman_bin = self.get_directory('popaman_bin')
+        if not popaman_bin:
+            raise RuntimeError("popaman_bin directory not set")
+        return popaman_bin.parent / 'lib' / 'packages.json'
+    
     def verify_assets(self):
         """Verify that all tracked assets exist and are accessible"""
         missing = []
@@ -72,19 +96,92 @@ class AssetTracker:
         
         return missing
 
+class StepMetrics:
+    """What one step of a case cost: its wall time and, summed or maxed over the commands
+    it ran, their cpu time, peak RSS and exit code"""
+    def __init__(self):
+        self.duration = None  # seconds
+        self.cpu = None  # user + system seconds, None where rusage is not available
+        self.peak_rss = None  # bytes, of the largest command
+        self.exit_code = None  # of the first command that failed, 0 when none did
+        self.commands = 0
+        self.error = None
+
+    def add_command(self, returncode, usage):
+        self.commands += 1
+        if self.exit_code in (None, 0):
+            self.exit_code = returncode
+        if usage:
+            self.cpu = (self.cpu or 0.0) + usage['utime'] + usage['stime']
+            self.peak_rss = max(self.peak_rss or 0, usage['maxrss'])
+
+    def __str__(self):
+        parts = [f"{self.duration:.2f}s"]
+        if self.cpu is not None:
+            parts.append(f"cpu {self.cpu:.2f}s")
+        if self.peak_rss is not None:
+            parts.append(f"peak {self.peak_rss / 2**20:.1f} MB")
+        return ', '.join(parts)
+
+    def to_json(self):
+        return {
+            'duration': self.duration,
+            'cpu': self.cpu,
+            'peak_rss': self.peak_rss,
+            'exit_code': self.exit_code,
+            'commands': self.commands,
+            'error': self.error,
+        }
+
+STEP_STATUS = {None: 'untested', True: 'passed', False: 'failed'}
+
 class TestCase:
+    STEPS = ('install', 'run', 'remove')
+
     def __init__(self, name):
         self.name = name
         self.install = None
         self.run = None
         self.remove = None
+        # trace spans of every popaman command the case ran, filled with --trace
+        self.spans = []
+        # step name -> StepMetrics, filled by step()
+        self.metrics = {}
+
+    @contextlib.asynccontextmanager
+    async def step(self, name):
+        """Run one step: it passes when the body does not raise, and the commands the
+        body runs through run_command are measured into the step's metrics"""
+        metrics = StepMetrics()
+        self.metrics[name] = metrics
+        token = STEP_METRICS.set(metrics)
+        start = time.perf_counter()
+        try:
+            yield metrics
+            setattr(self, name, True)
+        except Exception as e:
+            setattr(self, name, False)
+            metrics.error = str(e).strip().splitlines()[0] if str(e).strip() else type(e).__name__
+            raise
+        finally:
+            metrics.duration = time.perf_counter() - start
+            STEP_METRICS.reset(token)
+
+    def to_json(self):
+        steps = {}
+        for step in self.STEPS:
+            metrics = self.metrics.get(step)
+            steps[step] = {'status': STEP_STATUS[getattr(self, step)], **(metrics.to_json() if metrics else {})}
+        return {'name': self.name, 'steps': steps}
     
     def __str__(self):
         status_map = {None: "⚪ UNTESTED", True: "✅ PASSED", False: "❌ FAILED"}
-        return (f"{self.name}:\n"
-                f"  Install: {status_map[self.install]}\n"
-                f"  Run: {status_map[self.run]}\n"
-                f"  Remove: {status_map[self.remove]}")
+        lines = [f"{self.name}:"]
+        for step in self.STEPS:
+            metrics = self.metrics.get(step)
+            cost = f" ({metrics})" if metrics and metrics.duration is not None else ""
+            lines.append(f"  {step.capitalize()}: {status_map[getattr(self, step)]}{cost}")
+        return '\n'.join(lines)
 
 class TestTracker:
     def __init__(self):
@@ -92,23 +189,48 @@ class TestTracker:
             'dir': TestCase('Directory Package'),
             'link': TestCase('Linked Package'),
             'exe': TestCase('Executable Package'),
-            #'url_exe': TestCase('URL Executable Package'),
+            'url_exe': TestCase('URL Executable Package'),
+            'url_ranges': TestCase('Ranged URL Package'),
             '7z': TestCase('7z Archive Package'),
             #'url_7z': TestCase('URL 7z Archive Package'),
-            'zip': TestCase('Zip Archive Package')
+            'zip': TestCase('Zip Archive Package'),
+            'tar': TestCase('Tar Archive Package'),
+            'batch': TestCase('Batch Install'),
+            'manifest': TestCase('Manifest Install'),
+        }
+        # standalone checks that are not part of an install/run/remove lifecycle
+        self.checks = {
+            'list_latency': None,
+            'exe_discovery': None,
+            'dispatch': None,
+            'startup': None,
+            'verify': None,
+            'upgrade': None,
+            'archive_cache': None,
+            'archive_symlinks': None,
+            'archive_modes': None,
         }
+        # check name -> seconds it took
+        self.check_durations = {}
     
     def report(self):
         print("\n=== Test Results ===")
         for case in self.cases.values():
             print(f"\n{case}")
+
+        status_map = {None: "⚪ UNTESTED", True: "✅ PASSED", False: "❌ FAILED"}
+        print("\nChecks:")
+        for name, val in self.checks.items():
+            print(f"  {name}: {status_map[val]}")
         
         # Summary counts
-        total = len(self.cases) * 3  # 3 steps per case
+        total = len(self.cases) * 3 + len(self.checks)  # 3 steps per case
         passed = sum(sum(1 for val in [case.install, case.run, case.remove] if val is True)
                     for case in self.cases.values())
+        passed += sum(1 for val in self.checks.values() if val is True)
         failed = sum(sum(1 for val in [case.install, case.run, case.remove] if val is False)
                     for case in self.cases.values())
+        failed += sum(1 for val in self.checks.values() if val is False)
         untested = total - (passed + failed)
         
         print(f"\nSummary:")
@@ -117,8 +239,189 @@ class TestTracker:
         print(f"  Failed: {failed}")
         print(f"  Untested: {untested}")
 
+    def to_json(self, jobs):
+        return {
+            'meta': {
+                'commit': git_commit(),
+                'platform': platform.platform(),
+                'python': platform.python_version(),
+                'jobs': jobs,
+                'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            },
+            'cases': {key: case.to_json() for key, case in self.cases.items()},
+            'checks': {
+                name: {'status': STEP_STATUS[val], 'duration': self.check_durations.get(name)}
+                for name, val in self.checks.items()
+            },
+        }
+
+    def to_junit(self):
+        """One testcase per case step and per check, cpu, RSS and exit code as properties"""
+        suite = ET.Element('testsuite', name='popaman')
+        counts = {'tests': 0, 'failures': 0, 'skipped': 0}
+        total_time = 0.0
+
+        def add(classname, name, status, duration, properties=None, message=None):
+            nonlocal total_time
+            element = ET.SubElement(suite, 'testcase', classname=classname, name=name,
+                                    time=f"{duration or 0.0:.3f}")
+            counts['tests'] += 1
+            total_time += duration or 0.0
+            if status is False:
+                counts['failures'] += 1
+                ET.SubElement(element, 'failure', message=message or 'failed')
+            elif status is None:
+                counts['skipped'] += 1
+                ET.SubElement(element, 'skipped')
+            if properties:
+                props = ET.SubElement(element, 'properties')
+                for key, value in properties.items():
+                    if value is not None:
+                        ET.SubElement(props, 'property', name=key, value=str(value))
+
+        for key, case in self.cases.items():
+            for step in case.STEPS:
+                metrics = case.metrics.get(step) or StepMetrics()
+                add(f'popaman.{key}', step, getattr(case, step), metrics.duration, {
+                    'cpu_seconds': metrics.cpu,
+                    'peak_rss_bytes': metrics.peak_rss,
+                    'exit_code': metrics.exit_code,
+                }, metrics.error)
+        for name, val in self.checks.items():
+            add('popaman.checks', name, val, self.check_durations.get(name))
+
+        for key, value in counts.items():
+            suite.set(key, str(value))
+        suite.set('time', f"{total_time:.3f}")
+        root = ET.Element('testsuites')
+        root.append(suite)
+        ET.indent(root)
+        return ET.ElementTree(root)
+
+# a step may take this much longer or use this much more memory than in the baseline
+# before it counts as a regression, on top of a floor that absorbs run to run noise
+REGRESSION_TOLERANCE = 0.5
+REGRESSION_MIN_SECONDS = 0.1
+REGRESSION_MIN_RSS = 4 * 2**20
+
+def find_regressions(results, baseline, tolerance=REGRESSION_TOLERANCE):
+    """Steps that passed in both runs but got slower or bigger than in the baseline.
+    Wall time is only compared between runs with the same --jobs, cases running side by
+    side slow each other down; cpu time and peak RSS are compared either way"""
+    fields = [('cpu', REGRESSION_MIN_SECONDS, 1.0), ('peak_rss', REGRESSION_MIN_RSS, 2**20)]
+    if baseline.get('meta', {}).get('jobs') == results['meta']['jobs']:
+        fields.insert(0, ('duration', REGRESSION_MIN_SECONDS, 1.0))
+    regressions = []
+    for key, case in results['cases'].items():
+        before_case = baseline.get('cases', {}).get(key)
+        if not before_case:
+            continue
+        for step, after in case['steps'].items():
+            before = before_case['steps'].get(step)
+            if not before or before['status'] != 'passed' or after['status'] != 'passed':
+                continue
+            for field, floor, unit in fields:
+                old, new = before.get(field), after.get(field)
+                if old is None or new is None:
+                    continue
+                if new > old * (1 + tolerance) and new - old > floor:
+                    regressions.append(f"{case['name']} {step} {field}: {old / unit:.2f} -> {new / unit:.2f}")
+    return regressions
 
-async def run_command(command, input_text=None):
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# seconds a command may run before it is killed; builds get a longer budget
+COMMAND_TIMEOUT = 60
+BUILD_TIMEOUT = 600
+
+def install_prompts(keyword, description='this is optional'):
+    """Answers for the executable, keyword and description prompts of install_local_dir"""
+    return [
+        ('Enter the number of the executable', '1'),
+        ('Enter the keyword for the package', keyword),
+        ('Enter the description for the package', description),
+    ]
+
+async def pump_stream(stream, sink, changed):
+    """Copy a child stream into sink, flagging every chunk that arrives"""
+    while True:
+        chunk = await stream.read(4096)
+        if not chunk:
+            break
+        sink.extend(chunk)
+        changed.set()
+    # wake answer_prompts so it notices the child closed its output
+    changed.set()
+
+async def answer_prompts(process, prompts, outputs, changed, pumps):
+    """Write each answer only once its prompt has shown up on stdout or stderr"""
+    offsets = [0] * len(outputs)
+    for prompt, answer in prompts:
+        needle = prompt.encode('utf-8')
+        while True:
+            match = None
+            for i, output in enumerate(outputs):
+                index = output.find(needle, offsets[i])
+                if index != -1:
+                    match = (i, index + len(needle))
+                    break
+            if match:
+                offsets[match[0]] = match[1]
+                break
+            if all(pump.done() for pump in pumps):
+                raise RuntimeError(f"Process exited before prompt: {prompt!r}")
+            changed.clear()
+            await changed.wait()
+
+        process.stdin.write(f"{answer}\n".encode('utf-8'))
+        await process.stdin.drain()
+    process.stdin.close()
+
+# where the cost of the commands of the running step goes, see TestCase.step
+STEP_METRICS = contextvars.ContextVar('step_metrics', default=None)
+
+# started in between the harness and a measured command. a process keeps the peak RSS of
+# whatever it exec'd from, so a command started straight from the harness would report at
+# least the harness's own size. this helper starts it from a small interpreter instead,
+# passes its exit status on and writes the rusage of its only child to argv[1]
+RUSAGE_HELPER = """
+import os, sys, json, signal, resource
+pid = os.posix_spawnp(sys.argv[2], sys.argv[2:], os.environ)
+_, status = os.waitpid(pid, 0)
+usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+with open(sys.argv[1], 'w') as f:
+    json.dump({'utime': usage.ru_utime, 'stime': usage.ru_stime, 'maxrss': usage.ru_maxrss}, f)
+if os.WIFSIGNALED(status):
+    signal.signal(os.WTERMSIG(status), signal.SIG_DFL)
+    os.kill(os.getpid(), os.WTERMSIG(status))
+sys.exit(os.waitstatus_to_exitcode(status))
+"""
+
+def can_measure_usage():
+    return hasattr(os, 'posix_spawnp')
+
+def with_usage_helper(args, usage_path):
+    """args run through RUSAGE_HELPER, which writes their rusage to usage_path"""
+    return [sys.executable, '-S', '-I', '-c', RUSAGE_HELPER, str(usage_path)] + [str(arg) for arg in args]
+
+def read_usage(usage_path):
+    """The rusage RUSAGE_HELPER wrote, with maxrss in bytes, None if the helper never got to it"""
+    try:
+        with open(usage_path) as f:
+            usage = json.load(f)
+    except (OSError, ValueError):
+        return None
+    # ru_maxrss is in kilobytes on linux and in bytes on macos
+    usage['maxrss'] *= 1 if sys.platform == 'darwin' else 1024
+    return usage
+
+async def run_command(command, input_text=None, prompts=None, timeout=COMMAND_TIMEOUT):
     # Handle both string and list commands
     if isinstance(command, str):
         if os.name == 'nt':
@@ -129,7 +432,23 @@ async def run_command(command, input_text=None):
             args = command.split()
     else:
         args = command
-    
+
+    # inside a case step every command is measured, in its own process group so a timeout
+    # kills the command and not just the helper in front of it
+    metrics = STEP_METRICS.get()
+    usage_path = None
+    spawn_args = args
+    if metrics is not None and can_measure_usage():
+        fd, usage_path = tempfile.mkstemp(prefix='popaman-usage-')
+        os.close(fd)
+        spawn_args = with_usage_helper(args, usage_path)
+    try:
+        return await run_process(args, spawn_args, input_text, prompts, timeout, metrics, usage_path)
+    finally:
+        if usage_path:
+            os.unlink(usage_path)
+
+async def run_process(args, spawn_args, input_text, prompts, timeout, metrics, usage_path):
     try:
         # On Windows, we need to use shell=True for .exe files
         if os.name == 'nt' and any(arg.endswith('.exe') for arg in args):
@@ -144,64 +463,253 @@ async def run_command(command, input_text=None):
             )
         else:
             process = await asyncio.create_subprocess_exec(
-                *args,
+                *spawn_args,
                 stdin=asyncio.subprocess.PIPE,
                 stdout=asyncio.subprocess.PIPE,
                 stderr=asyncio.subprocess.PIPE,
-                shell=False
+                shell=False,
+                start_new_session=usage_path is not None
             )
-        
-        if input_text:
-            # Split input into lines and send each line
-            lines = input_text.decode('utf-8').splitlines()
-            for line in lines:
-                # Add newline and encode
-                input_line = f"{line}\n".encode('utf-8')
-                process.stdin.write(input_line)
-                await process.stdin.drain()  # Ensure the line is sent
-                await asyncio.sleep(0.1)  # Small delay between inputs
-            process.stdin.close()
-            
-        stdout, stderr = await process.communicate()
-        return process.returncode, stdout.decode('utf-8'), stderr.decode('utf-8')
     except FileNotFoundError as e:
         raise RuntimeError(f"Command failed: {e}")
 
+    def kill():
+        with contextlib.suppress(ProcessLookupError):
+            if usage_path:
+                os.killpg(process.pid, signal.SIGKILL)
+            else:
+                process.kill()
 
-async def build_installer():
-    returncode, stdout, stderr = await run_command('zig build', ''.encode('utf-8'))
+    stdout, stderr = bytearray(), bytearray()
+    changed = asyncio.Event()
+    pumps = [
+        asyncio.ensure_future(pump_stream(process.stdout, stdout, changed)),
+        asyncio.ensure_future(pump_stream(process.stderr, stderr, changed)),
+    ]
+    tasks = list(pumps)
+    if prompts:
+        tasks.append(asyncio.ensure_future(
+            answer_prompts(process, prompts, [stdout, stderr], changed, pumps)))
+    else:
+        # Non-interactive input is written in one go so the child sees EOF right after
+        if input_text:
+            process.stdin.write(input_text)
+        process.stdin.close()
+    tasks.append(asyncio.ensure_future(process.wait()))
+
+    try:
+        await asyncio.wait_for(asyncio.gather(*tasks), timeout)
+    except asyncio.TimeoutError:
+        kill()
+        await process.wait()
+        raise RuntimeError(f"Command timed out after {timeout}s: {' '.join(map(str, args))}\n"
+                           f"{stderr.decode('utf-8', 'replace')}")
+    except Exception:
+        if process.returncode is None:
+            kill()
+            await process.wait()
+        raise
+    if metrics is not None:
+        metrics.add_command(process.returncode, read_usage(usage_path) if usage_path else None)
+    return process.returncode, stdout.decode('utf-8'), collect_spans(stderr.decode('utf-8'))
+
+# where the trace spans of the running case go, each case task sets its own list
+TRACE_SPANS = contextvars.ContextVar('trace_spans', default=None)
+SPAN_PREFIX = '{"span":'
+
+def collect_spans(stderr):
+    """Move popaman's trace lines out of stderr and into the current case's span list"""
+    if SPAN_PREFIX not in stderr:
+        return stderr
+    spans = TRACE_SPANS.get()
+    kept = []
+    for line in stderr.splitlines(keepends=True):
+        if line.startswith(SPAN_PREFIX):
+            if spans is not None:
+                spans.append(json.loads(line))
+        else:
+            kept.append(line)
+    return ''.join(kept)
+
+def report_spans(label, spans):
+    """Per span name: how often it ran, its total and slowest time and the bytes it moved"""
+    if not spans:
+        return
+    totals = {}
+    for span in spans:
+        entry = totals.setdefault(span['span'], {'count': 0, 'us': 0, 'max_us': 0, 'bytes': 0})
+        entry['count'] += 1
+        entry['us'] += span['us']
+        entry['max_us'] = max(entry['max_us'], span['us'])
+        entry['bytes'] += span.get('bytes', 0)
+    print(f"\n{label}:")
+    print(f"  {'span':<16} {'count':>6} {'total ms':>10} {'max ms':>10} {'MB':>10}")
+    for name, entry in sorted(totals.items(), key=lambda item: -item[1]['us']):
+        print(f"  {name:<16} {entry['count']:>6} {entry['us'] / 1000:>10.2f} "
+              f"{entry['max_us'] / 1000:>10.2f} {entry['bytes'] / 2**20:>10.2f}")
+
+
+def read_index(ass_tracker):
+    """Decode lib/packages.idx into its header and records in keyword lookup order"""
+    data = ass_tracker.get_packages_json().with_name('packages.idx').read_bytes()
+    magic, json_size = struct.unpack_from('<8sQ', data, 0)
+    json_mtime = int.from_bytes(data[16:32], 'little', signed=True)
+    (count,) = struct.unpack_from('<I', data, 32)
+    if magic != b'PPMIDX01':
+        raise RuntimeError(f"Bad index magic: {magic!r}")
+
+    records_start = 36 + count * 4
+    records = []
+    for slot in range(count):
+        (offset,) = struct.unpack_from('<I', data, 36 + slot * 4)
+        pos = records_start + offset
+        keyword_len, name_len, path_len, is_global = struct.unpack_from('<HHHB', data, pos)
+        pos += 7
+        keyword = data[pos:pos + keyword_len].decode('utf-8')
+        name = data[pos + keyword_len:pos + keyword_len + name_len].decode('utf-8')
+        path = data[pos + keyword_len + name_len:pos + keyword_len + name_len + path_len].decode('utf-8')
+        records.append((keyword, name, path, bool(is_global)))
+    return json_size, json_mtime, records
+
+def verify_index(ass_tracker):
+    """Check that packages.idx describes exactly what packages.json holds"""
+    packages_json = ass_tracker.get_packages_json()
+    json_size, json_mtime, records = read_index(ass_tracker)
+    stat = packages_json.stat()
+    if json_size != stat.st_size or json_mtime != stat.st_mtime_ns:
+        raise RuntimeError("packages.idx is stale relative to packages.json")
+
+    keywords = [record[0] for record in records]
+    if keywords != sorted(keywords, key=lambda keyword: keyword.encode('utf-8')):
+        raise RuntimeError("packages.idx is not sorted by keyword")
+
+    with open(packages_json) as f:
+        packages = json.load(f)['package']
+    expected = sorted((p['keyword'], p['name'], p['path'], p['global']) for p in packages)
+    if sorted(records) != expected:
+        raise RuntimeError(f"packages.idx does not match packages.json: {sorted(records)} != {expected}")
+
+# fingerprints of what each setup step was last done from, and the pristine popaman root
+HARNESS_CACHE = Path('test') / '.cache'
+INSTALLER_INPUTS = [Path('src'), Path('build.zig'), Path('build.zig.zon')]
+TEST_PACKAGE_INPUTS = [Path('test') / 'test_package.zig', Path('test') / 'build.zig', Path('test') / 'build.zig.zon']
+
+class SetupCache:
+    """Skips a setup step whose inputs hash the same as when it last succeeded and whose
+    outputs are still there. A disabled cache fingerprints nothing and redoes every step"""
+    def __init__(self, root=HARNESS_CACHE, enabled=True):
+        self.root = Path(root)
+        self.enabled = enabled
+        self._zig_version = None
+
+    def zig_version(self):
+        if self._zig_version is None:
+            try:
+                self._zig_version = subprocess.run(['zig', 'version'], capture_output=True,
+                                                   text=True, check=True).stdout.strip()
+            except (OSError, subprocess.CalledProcessError):
+                self._zig_version = ''
+        return self._zig_version
+
+    def fingerprint(self, paths, extra=()):
+        """sha256 over the path and content of every file under paths, then extra strings"""
+        digest = hashlib.sha256()
+        for path in map(Path, paths):
+            files = sorted(p for p in path.rglob('*') if p.is_file()) if path.is_dir() else [path]
+            for file in files:
+                digest.update(file.as_posix().encode() + b'\0')
+                digest.update(file.read_bytes() if file.exists() else b'missing')
+                digest.update(b'\0')
+        for value in extra:
+            digest.update(value.encode() + b'\0')
+        return digest.hexdigest()
+
+    @staticmethod
+    def output_stats(outputs):
+        """size and mtime of each output, so one replaced behind the cache's back is noticed"""
+        stats = {}
+        for output in map(Path, outputs):
+            stat = output.stat()
+            stats[output.as_posix()] = [stat.st_size, stat.st_mtime_ns]
+        return stats
+
+    def fresh(self, name, fingerprint, outputs):
+        if not self.enabled:
+            return False
+        try:
+            with open(self.root / f'{name}.json') as f:
+                stamp = json.load(f)
+            return stamp['inputs'] == fingerprint and stamp['outputs'] == self.output_stats(outputs)
+        except (OSError, ValueError, KeyError):
+            return False
+
+    def store(self, name, fingerprint, outputs):
+        if not self.enabled:
+            return
+        self.root.mkdir(parents=True, exist_ok=True)
+        with open(self.root / f'{name}.json', 'w') as f:
+            json.dump({'inputs': fingerprint, 'outputs': self.output_stats(outputs)}, f)
+
+    def forget(self, name):
+        with contextlib.suppress(FileNotFoundError):
+            (self.root / f'{name}.json').unlink()
+
+def installer_path():
+    executable_name = 'install-popaman'
+    if os.name == 'nt': # Add .exe for windows
+        executable_name += '.exe'
+    return Path('zig-out') / 'bin' / executable_name
+
+async def build_installer(cache=None):
+    if cache:
+        fingerprint = await asyncio.to_thread(cache.fingerprint, INSTALLER_INPUTS, [cache.zig_version()])
+        if cache.fresh('installer', fingerprint, [installer_path()]):
+            print("Installer is up to date, skipping zig build")
+            return
+    returncode, stdout, stderr = await run_command('zig build', ''.encode('utf-8'), timeout=BUILD_TIMEOUT)
     if returncode != 0:
         raise RuntimeError(f"Build failed: {stderr}")
+    if cache:
+        cache.store('installer', fingerprint, [installer_path()])
 
-async def install_popaman(ass_tracker):
+async def install_popaman(ass_tracker, cache=None):
     install_path = Path.cwd() # Use Path.cwd() for platform-independence
     popaman_dir = install_path / 'popaman'
     if popaman_dir.exists():
         shutil.rmtree(popaman_dir)
     
-    executable_name = 'install-popaman'
-    if os.name == 'nt': # Add .exe for windows
-        executable_name += '.exe'
-
     # Get the installer from zig-out/bin
-    installer_path = Path('zig-out') / 'bin' / executable_name
+    installer = installer_path()
 
     # Verify the installer exists
-    if not installer_path.exists():
-        raise RuntimeError(f"Installer executable not found at {installer_path}")
+    if not installer.exists():
+        raise RuntimeError(f"Installer executable not found at {installer}")
+
+    # a root installed by this very installer is kept and cloned instead of installing again
+    snapshot = None
+    if cache:
+        fingerprint = await asyncio.to_thread(cache.fingerprint, [installer])
+        snapshot = cache.root / 'popaman'
+        if cache.fresh('root', fingerprint, [snapshot]):
+            # symlinks=True keeps the 7zr link pointing at the system binary
+            await asyncio.to_thread(shutil.copytree, snapshot, popaman_dir, symlinks=True)
+        else:
+            snapshot = None
 
     # Construct the command using proper path handling
     command = [
-        str(installer_path.absolute()),  # Use absolute path
+        str(installer.absolute()),  # Use absolute path
         str(install_path.absolute()),  # Install to root directory
         '-f'  # Force installation
     ]
     
     try:
-        returncode, stdout, stderr = await run_command(command, input_text='y\n'.encode('utf-8'))
-        time.sleep(1)
-        if returncode != 0:
-            raise RuntimeError(f"Installation failed: {stderr}")
+        if snapshot is None:
+            returncode, stdout, stderr = await run_command(command, input_text='y\n'.encode('utf-8'))
+            if returncode != 0:
+                raise RuntimeError(f"Installation failed: {stderr}")
+            if cache:
+                await asyncio.to_thread(save_root_snapshot, cache, popaman_dir, fingerprint)
         
         # Set the paths in the tracker - use popaman.exe from the installed location
         popaman_exe_name = 'popaman'
@@ -214,43 +722,77 @@ async def install_popaman(ass_tracker):
             
         ass_tracker.set_file('popaman_exe', popaman_exe_path)
         ass_tracker.set_directory('popaman_bin', popaman_dir / 'bin')
-        print(f"Installed at {popaman_dir}")
+        print(f"Installed at {popaman_dir}" + (" from the cached root" if snapshot else ""))
     except Exception as e:
         print(f"Error during installation: {e}")
         raise
 
-async def build_test_package(ass_tracker):
-    # Store the original directory
-    original_dir = os.getcwd()
-    try:
-        # Change to test directory
-        os.chdir('test')
-        returncode, stdout, stderr = await run_command('zig build', ''.encode('utf-8'))
-        time.sleep(1)
-        if returncode != 0:
-            raise RuntimeError(f"Build failed: {stderr}")
-        test_package_name = "test-package"
-        if os.name == 'nt':
-            test_package_name += ".exe"
-        test_package_path = Path('test') / 'zig-out' / 'test-package' 
-        test_package_exe = test_package_path / test_package_name
-        ass_tracker.set_file('test_package', test_package_exe)
-        ass_tracker.set_directory('test_package_dir', test_package_path)
-    finally:
-        # Always return to the original directory
-        os.chdir(original_dir)
+def save_root_snapshot(cache, popaman_dir, fingerprint):
+    """Keep a copy of a freshly installed root for install_popaman to clone next time"""
+    if not cache.enabled:
+        return
+    snapshot = cache.root / 'popaman'
+    cache.forget('root')
+    shutil.rmtree(snapshot, ignore_errors=True)
+    cache.root.mkdir(parents=True, exist_ok=True)
+    shutil.copytree(popaman_dir, snapshot, symlinks=True)
+    cache.store('root', fingerprint, [snapshot])
 
-async def create_test_archives(ass_tracker):
+def test_package_paths():
+    test_package_name = "test-package"
+    if os.name == 'nt':
+        test_package_name += ".exe"
+    test_package_path = Path('test') / 'zig-out' / 'test-package' 
+    return test_package_path, test_package_path / test_package_name
+
+async def build_test_package(ass_tracker, cache=None):
+    test_package_path, test_package_exe = test_package_paths()
+    fingerprint = None
+    if cache:
+        fingerprint = await asyncio.to_thread(cache.fingerprint, TEST_PACKAGE_INPUTS, [cache.zig_version()])
+    if not (cache and cache.fresh('test-package', fingerprint, [test_package_exe])):
+        # Store the original directory
+        original_dir = os.getcwd()
+        try:
+            # Change to test directory
+            os.chdir('test')
+            returncode, stdout, stderr = await run_command('zig build', ''.encode('utf-8'), timeout=BUILD_TIMEOUT)
+            if returncode != 0:
+                raise RuntimeError(f"Build failed: {stderr}")
+        finally:
+            # Always return to the original directory
+            os.chdir(original_dir)
+        if cache:
+            cache.store('test-package', fingerprint, [test_package_exe])
+    else:
+        print("Test package is up to date, skipping zig build")
+    ass_tracker.set_file('test_package', test_package_exe)
+    ass_tracker.set_directory('test_package_dir', test_package_path)
+
+# archive format -> file extension
+TEST_ARCHIVES = [
+    ("zip", "zip"),
+    ("tar", "tar.gz"),
+    ("7z", "7z"),
+]
+
+async def create_test_archives(ass_tracker, cache=None):
     # Get the test package path
     test_package_path = ass_tracker.get_file('test_package')
     if not test_package_path:
         raise RuntimeError("test_package file not set")
 
-    # Create archives directory
-    archives_dir = Path("test") / "archives"
+    # generated next to the setup stamps, never in the tracked tree
+    archives_dir = HARNESS_CACHE / "archives"
     archives_dir.mkdir(parents=True, exist_ok=True)
     ass_tracker.set_directory('archives_dir', archives_dir)
 
+    # the archives only change with the test package and the code that writes them
+    fingerprint = None
+    if cache:
+        writer_source = [inspect.getsource(function) for function in (create_test_archives, write_zip, write_tar)]
+        fingerprint = await asyncio.to_thread(cache.fingerprint, [test_package_path], writer_source)
+
     popaman_exe = ass_tracker.get_file('popaman_exe')
     if not popaman_exe:
         raise RuntimeError("popaman_exe file not set")
@@ -258,36 +800,65 @@ async def create_test_archives(ass_tracker):
     if not popaman_exe.exists():
         raise RuntimeError(f"Popaman executable not found at {popaman_exe}")
     
-    # Create different archive formats
-    archive_formats = [
-        ("7z", "7z"),
-        ("zip", "zip"),
-    ]
+    # zip and tar archives are extracted by popaman itself, so python writes them and
+    # they do not depend on 7zr. 7z archives still need it
+    writers = {
+        'zip': lambda path: write_zip(path, [test_package_path]),
+        'tar': lambda path: write_tar(path, [test_package_path]),
+    }
     
-    for format_name, extension in archive_formats:
-        archive_name = f"test-package.{extension}"
-        archive_path = archives_dir / archive_name
-        
+    failed = []
+    for format_name, extension in TEST_ARCHIVES:
+        archive_path = archives_dir / f"test-package.{extension}"
+        if cache and cache.fresh(f'archive-{format_name}', fingerprint, [archive_path]):
+            print(f"{format_name} archive is up to date")
+            ass_tracker.set_archive(format_name, archive_path)
+            continue
+
         # Remove existing archive if it exists
         if archive_path.exists():
             archive_path.unlink()
         
-        # Use popaman to access its default 7zr installation
-        command = [
-            str(popaman_exe.absolute()),
-            "7zr",
-            "a",  # Add files to archive
-            str(archive_path.absolute()),
-            str(test_package_path.absolute())
-        ]
-        
-        # Execute the archive command
-        returncode, stdout, stderr = await run_command(command, None)
-        if returncode != 0:
-            raise RuntimeError(f"Failed to create {format_name} archive: {stderr}")
+        if format_name in writers:
+            await asyncio.to_thread(writers[format_name], archive_path)
+        else:
+            # Use popaman to access its default 7zr installation
+            command = [
+                str(popaman_exe.absolute()),
+                "7zr",
+                "a",  # Add files to archive
+                str(archive_path.absolute()),
+                str(test_package_path.absolute())
+            ]
+            
+            # Execute the archive command
+            returncode, stdout, stderr = await run_command(command, None)
+            if returncode != 0:
+                failed.append(f"Failed to create {format_name} archive: {stderr}")
+                continue
         
         print(f"Created {format_name} archive at {archive_path}")
         ass_tracker.set_archive(format_name, archive_path)
+        if cache:
+            cache.store(f'archive-{format_name}', fingerprint, [archive_path])
+    if failed:
+        raise RuntimeError('\n'.join(failed))
+
+def write_zip(archive_path, paths, compression=zipfile.ZIP_DEFLATED):
+    """Zip files and directory trees, keeping their unix modes so exec bits survive"""
+    with zipfile.ZipFile(archive_path, 'w', compression) as archive:
+        for path in map(Path, paths):
+            archive.write(path, path.name)
+            if path.is_dir():
+                for child in sorted(path.rglob('*')):
+                    archive.write(child, child.relative_to(path.parent))
+
+def write_tar(archive_path, paths):
+    """Tar files and directory trees, compressed the way the archive's extension says"""
+    mode = {'.gz': 'w:gz', '.tgz': 'w:gz', '.xz': 'w:xz', '.tar': 'w'}[Path(archive_path).suffix]
+    with tarfile.open(archive_path, mode) as archive:
+        for path in map(Path, paths):
+            archive.add(path, path.name)
 
 async def test_package_installation_from_dir(ass_tracker):
     popaman_exe = ass_tracker.get_file('popaman_exe')
@@ -306,7 +877,7 @@ async def test_package_installation_from_dir(ass_tracker):
     
     print("\nTesting directory package installation...")
     try:
-        inputs = b'1\ntest-hello\nthis is optional\n'
+        prompts = install_prompts('test-hello')
         # Use list command to avoid path quoting issues
         command = [
             str(popaman_exe.absolute()),
@@ -315,7 +886,7 @@ async def test_package_installation_from_dir(ass_tracker):
         ]
         returncode, stdout, stderr = await run_command(
             command,
-            input_text=inputs
+            prompts=prompts
         )
         if returncode != 0:
             raise RuntimeError(f"Installation failed: {stderr}")
@@ -326,12 +897,39 @@ async def test_package_installation_from_dir(ass_tracker):
     
     print("Verifying installation...")
     # Verify package exists in packages.json
-    with open('popaman/lib/packages.json') as f:
+    with open(ass_tracker.get_packages_json()) as f:
         packages = json.load(f)
         assert any(p['keyword'] == 'test-hello' for p in packages['package']), \
             "Package not found in packages.json"
+    verify_index(ass_tracker)
     print("Verification complete")
 
+    await test_package_globalize(ass_tracker, 'test-hello')
+
+async def test_package_globalize(ass_tracker, keyword):
+    print(f"\nTesting globalize of {keyword}...")
+    popaman_exe = ass_tracker.get_file('popaman_exe')
+    for flag, expected in (('-a', True), ('-r', False)):
+        command = [str(popaman_exe.absolute()), "globalize", keyword, flag]
+        returncode, stdout, stderr = await run_command(command)
+        if returncode != 0:
+            raise RuntimeError(f"globalize {flag} failed: {stderr}")
+
+        with open(ass_tracker.get_packages_json()) as f:
+            packages = json.load(f)
+            assert any(p['keyword'] == keyword and p['global'] == expected for p in packages['package']), \
+                f"Global flag not {expected} after globalize {flag}"
+        verify_index(ass_tracker)
+
+        # the shim in bin/ must follow the global flag and run the package without popaman
+        shim = popaman_exe.parent / (f"{keyword}.cmd" if os.name == 'nt' else keyword)
+        assert shim.exists() == expected, f"Shim {shim} exists={shim.exists()} after globalize {flag}"
+        if expected:
+            returncode, stdout, stderr = await run_command([str(shim)])
+            assert returncode == 0 and 'Hello, world!' in stdout + stderr, \
+                f"Shim {shim} did not run the package: {stdout} {stderr}"
+    print("Globalize verification complete")
+
 async def test_package_linking(ass_tracker):
     print("\nTesting linked package installation...")
     popaman_exe = ass_tracker.get_file('popaman_exe')
@@ -348,7 +946,7 @@ async def test_package_linking(ass_tracker):
     if not test_package_dir.exists():
         raise RuntimeError(f"Test package directory not found at {test_package_dir}")
     try:
-        inputs = b'1\ntest-hello-link\nthis is optional\n'
+        prompts = install_prompts('test-hello-link')
         # Use list command to avoid path quoting issues
         command = [
             str(popaman_exe.absolute()),
@@ -357,7 +955,7 @@ async def test_package_linking(ass_tracker):
         ]
         returncode, stdout, stderr = await run_command(
             command,
-            input_text=inputs
+            prompts=prompts
         )
         if returncode != 0:
             raise RuntimeError(f"Installation failed: {stderr}")
@@ -368,10 +966,11 @@ async def test_package_linking(ass_tracker):
     
     print("Verifying installation...")
     #Verify package exists in packages.json
-    with open('popaman/lib/packages.json') as f:
+    with open(ass_tracker.get_packages_json()) as f:
         packages = json.load(f)
         assert any(p['name'] == 'link@test-package' for p in packages['package']), \
             "Package not found in packages.json"
+    verify_index(ass_tracker)
     print("Verification complete")
 
 async def test_package_installation_from_7z(ass_tracker):
@@ -391,7 +990,7 @@ async def test_package_installation_from_7z(ass_tracker):
         raise RuntimeError(f"7z archive not found at {test_pkg_path}")
     
     try:
-        inputs = b'1\ntest-hello-7z\nthis is optional\n'
+        prompts = install_prompts('test-hello-7z')
         # Use list command to avoid path quoting issues
         command = [
             str(popaman_exe.absolute()),
@@ -400,7 +999,7 @@ async def test_package_installation_from_7z(ass_tracker):
         ]
         returncode, stdout, stderr = await run_command(
             command,
-            input_text=inputs
+            prompts=prompts
         )
         if returncode != 0:
             raise RuntimeError(f"Installation failed: {stderr}")
@@ -410,10 +1009,11 @@ async def test_package_installation_from_7z(ass_tracker):
         raise
     
     print("Verifying installation...")
-    with open('popaman/lib/packages.json') as f:
+    with open(ass_tracker.get_packages_json()) as f:
         packages = json.load(f)
         assert any(p['keyword'] == 'test-hello-7z' for p in packages['package']), \
             "Package not found in packages.json"
+    verify_index(ass_tracker)
     print("Verification complete")
 
 async def test_package_installation_from_zip(ass_tracker):
@@ -433,7 +1033,7 @@ async def test_package_installation_from_zip(ass_tracker):
         raise RuntimeError(f"zip archive not found at {test_pkg_path}")
     
     try:
-        inputs = b'1\ntest-hello-zip\nthis is optional\n'
+        prompts = install_prompts('test-hello-zip')
         # Use list command to avoid path quoting issues
         command = [
             str(popaman_exe.absolute()),
@@ -442,7 +1042,7 @@ async def test_package_installation_from_zip(ass_tracker):
         ]
         returncode, stdout, stderr = await run_command(
             command,
-            input_text=inputs
+            prompts=prompts
         )
         if returncode != 0:
             raise RuntimeError(f"Installation failed: {stderr}")
@@ -452,13 +1052,36 @@ async def test_package_installation_from_zip(ass_tracker):
         raise
     
     print("Verifying installation...")
-    with open('popaman/lib/packages.json') as f:
+    with open(ass_tracker.get_packages_json()) as f:
         packages = json.load(f)
         assert any(p['keyword'] == 'test-hello-zip' for p in packages['package']), \
             "Package not found in packages.json"
+    verify_index(ass_tracker)
     print("Verification complete")
 
-async def test_package_removal(ass_tracker):
+async def test_package_installation_from_tar(ass_tracker):
+    print("\nTesting tar.gz package installation...")
+    popaman_exe = ass_tracker.get_file('popaman_exe')
+    if not popaman_exe or not popaman_exe.exists():
+        raise RuntimeError(f"Popaman executable not found at {popaman_exe}")
+    
+    test_pkg_path = ass_tracker.get_archive('tar')
+    if not test_pkg_path or not test_pkg_path.exists():
+        raise RuntimeError(f"tar archive not found at {test_pkg_path}")
+    
+    command = [str(popaman_exe.absolute()), "install", str(test_pkg_path.absolute())]
+    returncode, stdout, stderr = await run_command(command, prompts=install_prompts('test-hello-tar'))
+    if returncode != 0:
+        raise RuntimeError(f"Installation failed: {stderr}")
+    
+    with open(ass_tracker.get_packages_json()) as f:
+        packages = json.load(f)
+        assert any(p['keyword'] == 'test-hello-tar' for p in packages['package']), \
+            "Package not found in packages.json"
+    verify_index(ass_tracker)
+    print("Verification complete")
+
+async def test_package_removal(ass_tracker, packages=None):
     print("\nTesting package removal...")
     popaman_exe = ass_tracker.get_file('popaman_exe')
     if not popaman_exe:
@@ -467,9 +1090,11 @@ async def test_package_removal(ass_tracker):
     if not popaman_exe.exists():
         raise RuntimeError(f"Popaman executable not found at {popaman_exe}")
     
-    # Add delays between removals
-    for pkg in ['test-hello', 'test-hello-link', 'test-hello-exe', 
-                'test-hello-7z', 'test-hello-zip']: 
+    if packages is None:
+        packages = ['test-hello', 'test-hello-link', 'test-hello-exe', 
+                    'test-hello-url-exe', 'test-hello-url-ranges', 'test-hello-7z', 'test-hello-zip', 'test-hello-tar'] + BATCH_KEYWORDS + MANIFEST_KEYWORDS
+
+    for pkg in packages:
         # Use list command to avoid path quoting issues
         command = [
             str(popaman_exe.absolute()),
@@ -484,17 +1109,13 @@ async def test_package_removal(ass_tracker):
             # Only raise error if it's not a "package not found" error
             if "Package not found" not in stderr:
                 raise RuntimeError(f"Failed to remove package {pkg}: {stderr}")
-        time.sleep(0.5)  # Give filesystem time between removals
     
     # Verify package is removed from packages.json
-    with open('popaman/lib/packages.json') as f:
-        packages = json.load(f)
-        assert not any(p['keyword'] == 'test-hello' or 
-                      p['keyword'] == 'test-hello-link' or 
-                      p['keyword'] == 'test-hello-exe' or 
-                      p['keyword'] == 'test-hello-7z' or 
-                      p['keyword'] == 'test-hello-zip' for p in packages['package']), \
+    with open(ass_tracker.get_packages_json()) as f:
+        installed = json.load(f)
+        assert not any(p['keyword'] in packages for p in installed['package']), \
             "Package still exists in packages.json"
+    verify_index(ass_tracker)
 
 async def test_package_installation_from_exe(ass_tracker):
     popaman_exe = ass_tracker.get_file('popaman_exe')
@@ -513,7 +1134,7 @@ async def test_package_installation_from_exe(ass_tracker):
     
     print("\nTesting executable package installation...")
     try:
-        inputs = b'1\ntest-hello-exe\nthis is optional\n'
+        prompts = install_prompts('test-hello-exe')
         # Use list command to avoid path quoting issues
         command = [
             str(popaman_exe.absolute()),
@@ -522,7 +1143,7 @@ async def test_package_installation_from_exe(ass_tracker):
         ]
         returncode, stdout, stderr = await run_command(
             command,
-            input_text=inputs
+            prompts=prompts
         )
         if returncode != 0:
             raise RuntimeError(f"Installation failed: {stderr}")
@@ -533,13 +1154,323 @@ async def test_package_installation_from_exe(ass_tracker):
     
     print("Verifying installation...")
     # Verify package exists in packages.json
-    with open('popaman/lib/packages.json') as f:
+    with open(ass_tracker.get_packages_json()) as f:
         packages = json.load(f)
-        assert any(p['keyword'] == 'test-hello' for p in packages['package']), \
+        assert any(p['keyword'] == 'test-hello-exe' for p in packages['package']), \
+            "Package not found in packages.json"
+    verify_index(ass_tracker)
+    print("Verification complete")
+
+@contextlib.contextmanager
+def serve_files(files, faults=None):
+    """Serve {url path: local file} over http on localhost with HEAD and Range support
+
+    Yields (base url, stats). stats counts requests per path, lists the requested ranges
+    and totals the bytes sent. While faults['cut_after'] is set, every range response
+    stops after that many bytes, the way a flaky link breaks off a transfer.
+    """
+    stats = {'requests': {}, 'ranges': [], 'bytes': 0}
+    faults = faults if faults is not None else {}
+    lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def send_file(self, with_body):
+            with lock:
+                stats['requests'][self.path] = stats['requests'].get(self.path, 0) + 1
+            if self.path not in files:
+                self.send_error(404)
+                return
+            data = Path(files[self.path]).read_bytes()
+            first, last = 0, len(data) - 1
+            range_header = self.headers.get('Range')
+            if range_header:
+                start, _, end = range_header.removeprefix('bytes=').partition('-')
+                first, last = int(start), min(int(end), len(data) - 1) if end else len(data) - 1
+                self.send_response(206)
+                self.send_header('Content-Range', f'bytes {first}-{last}/{len(data)}')
+            else:
+                self.send_response(200)
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('Content-Length', str(last - first + 1))
+            self.end_headers()
+            if not with_body:
+                return
+
+            body = data[first:last + 1]
+            cut_after = faults.get('cut_after')
+            if range_header and cut_after is not None:
+                body = body[:cut_after]
+                self.close_connection = True
+            with lock:
+                if range_header:
+                    stats['ranges'].append((first, last))
+                stats['bytes'] += len(body)
+            self.wfile.write(body)
+
+        def do_HEAD(self):
+            self.send_file(False)
+
+        def do_GET(self):
+            self.send_file(True)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f'http://127.0.0.1:{server.server_address[1]}', stats
+    finally:
+        server.shutdown()
+        server.server_close()
+
+async def test_package_installation_from_url_exe(ass_tracker):
+    print("\nTesting URL executable package installation...")
+    popaman_exe = ass_tracker.get_file('popaman_exe')
+    if not popaman_exe:
+        raise RuntimeError("popaman_exe file not set")
+
+    test_package_exe = ass_tracker.get_file('test_package')
+    if not test_package_exe:
+        raise RuntimeError("test_package file not set")
+
+    # the .exe suffix is what marks a download as an executable, on every platform
+    with serve_files({'/test-package.exe': test_package_exe}) as (base_url, stats):
+        url = f'{base_url}/test-package.exe'
+        command = [str(popaman_exe.absolute()), "install", url]
+        returncode, stdout, stderr = await run_command(command, prompts=install_prompts('test-hello-url-exe'))
+        if returncode != 0:
+            raise RuntimeError(f"Installation failed: {stderr}")
+        print("Installation command completed")
+
+        # reinstalling the same url is served from the download cache
+        returncode, stdout, stderr = await run_command([str(popaman_exe.absolute()), "remove", "test-hello-url-exe"])
+        if returncode != 0:
+            raise RuntimeError(f"Removal before reinstall failed: {stderr}")
+        returncode, stdout, stderr = await run_command(command, prompts=install_prompts('test-hello-url-exe'))
+        if returncode != 0:
+            raise RuntimeError(f"Reinstallation failed: {stderr}")
+        if stats['bytes'] != test_package_exe.stat().st_size:
+            raise RuntimeError(f"Expected the package to be downloaded once, the server sent {stats['bytes']} bytes")
+
+    print("Verifying installation...")
+    with open(ass_tracker.get_packages_json()) as f:
+        packages = json.load(f)
+        assert any(p['keyword'] == 'test-hello-url-exe' for p in packages['package']), \
             "Package not found in packages.json"
+    verify_index(ass_tracker)
+    print("Verification complete")
+
+# padding appended to the test package so its download is split into several ranges
+URL_RANGES_PADDING = 10 * 1024 * 1024
+# installed at the same time from one url, then removed again
+URL_RANGES_CONCURRENT = ['test-hello-url-concurrent-a', 'test-hello-url-concurrent-b']
+
+async def test_package_installation_from_url_ranges(ass_tracker):
+    print("\nTesting ranged URL package installation...")
+    popaman_exe = ass_tracker.get_file('popaman_exe')
+    if not popaman_exe:
+        raise RuntimeError("popaman_exe file not set")
+
+    test_package_exe = ass_tracker.get_file('test_package')
+    if not test_package_exe:
+        raise RuntimeError("test_package file not set")
+
+    # trailing bytes do not stop the executable from running
+    large_package = popaman_exe.parent.parent / 'large-package.exe'
+    with open(large_package, 'wb') as f:
+        f.write(test_package_exe.read_bytes())
+        f.write(os.urandom(URL_RANGES_PADDING))
+    size = large_package.stat().st_size
+
+    faults = {'cut_after': 64 * 1024}
+    files = {'/large-package.exe': large_package, '/concurrent/large-package.exe': large_package}
+    with serve_files(files, faults) as (base_url, stats):
+        command = [str(popaman_exe.absolute()), "install", f'{base_url}/large-package.exe']
+
+        # every range breaks off early, so the install gives up before prompting and leaves the parts in temp/
+        returncode, stdout, stderr = await run_command(command)
+        if returncode == 0:
+            raise RuntimeError("Installation succeeded although every transfer broke off")
+        first_attempt = stats['bytes']
+        if len({first for first, last in stats['ranges']}) < 2:
+            raise RuntimeError(f"Expected parallel ranges, the server saw {stats['ranges']}")
+
+        # the next install only fetches the bytes that are still missing
+        faults['cut_after'] = None
+        returncode, stdout, stderr = await run_command(command, prompts=install_prompts('test-hello-url-ranges'))
+        if returncode != 0:
+            raise RuntimeError(f"Resumed installation failed: {stderr}")
+        if 'Resuming partial download' not in stderr:
+            raise RuntimeError("Installation did not resume the partial download")
+        if stats['bytes'] != size:
+            raise RuntimeError(f"Expected {size} bytes in total, the server sent {first_attempt} "
+                               f"and then {stats['bytes'] - first_attempt}")
+
+        # two processes installing a url the cache has not seen share its partial directory
+        # and must take turns with it
+        manifests = []
+        for keyword in URL_RANGES_CONCURRENT:
+            manifest_path = popaman_exe.parent.parent / f'{keyword}.json'
+            with open(manifest_path, 'w') as f:
+                json.dump({'package': [{'source': f'{base_url}/concurrent/large-package.exe',
+                                        'keyword': keyword, 'exe': large_package.name}]}, f)
+            manifests.append(manifest_path)
+        results = await asyncio.gather(*(run_command([str(popaman_exe.absolute()), "apply", str(path)])
+                                         for path in manifests))
+        for keyword, (returncode, stdout, stderr) in zip(URL_RANGES_CONCURRENT, results):
+            if returncode != 0:
+                raise RuntimeError(f"Concurrent installation of {keyword} failed: {stderr}")
+        for path in manifests:
+            path.unlink()
+        print("Installation command completed")
+
+    print("Verifying installation...")
+    for keyword in ['test-hello-url-ranges'] + URL_RANGES_CONCURRENT:
+        installed = popaman_exe.parent.parent / 'lib' / keyword / large_package.name
+        if installed.read_bytes() != large_package.read_bytes():
+            raise RuntimeError(f"Downloaded package of {keyword} differs from the served file")
+    for keyword in URL_RANGES_CONCURRENT:
+        returncode, stdout, stderr = await run_command([str(popaman_exe.absolute()), "remove", keyword])
+        if returncode != 0:
+            raise RuntimeError(f"Removing {keyword} failed: {stderr}")
+    large_package.unlink()
+    verify_index(ass_tracker)
+    print("Verification complete")
+
+# keywords the batch case installs, one per source in BATCH_SOURCES order
+BATCH_KEYWORDS = ['test-hello-batch-dir', 'test-hello-batch-exe']
+
+async def test_package_installation_batch(ass_tracker):
+    print("\nTesting batch package installation...")
+    popaman_exe = ass_tracker.get_file('popaman_exe')
+    if not popaman_exe:
+        raise RuntimeError("popaman_exe file not set")
+    
+    sources = [ass_tracker.get_directory('test_package_dir'), ass_tracker.get_file('test_package')]
+    if not all(sources):
+        raise RuntimeError("test package not set")
+
+    try:
+        # prompts are asked package by package in the order the sources were given
+        prompts = [prompt for keyword in BATCH_KEYWORDS for prompt in install_prompts(keyword)]
+        command = [str(popaman_exe.absolute()), "install"] + [str(source.absolute()) for source in sources]
+        returncode, stdout, stderr = await run_command(
+            command,
+            prompts=prompts
+        )
+        if returncode != 0:
+            raise RuntimeError(f"Installation failed: {stderr}")
+        print("Installation command completed")
+    except Exception as e:
+        print(f"Installation failed: {e}")
+        raise
+
+    print("Verifying installation...")
+    with open(ass_tracker.get_packages_json()) as f:
+        packages = json.load(f)
+        for keyword in BATCH_KEYWORDS:
+            assert any(p['keyword'] == keyword for p in packages['package']), \
+                f"Package {keyword} not found in packages.json"
+    verify_index(ass_tracker)
+    print("Verification complete")
+
+# keywords the manifest case installs, one per source in the manifest
+MANIFEST_KEYWORDS = ['test-hello-manifest-dir', 'test-hello-manifest-exe']
+
+async def test_package_installation_manifest(ass_tracker):
+    print("\nTesting manifest package installation...")
+    popaman_exe = ass_tracker.get_file('popaman_exe')
+    if not popaman_exe:
+        raise RuntimeError("popaman_exe file not set")
+
+    test_package_exe = ass_tracker.get_file('test_package')
+    test_package_dir = ass_tracker.get_directory('test_package_dir')
+    if not test_package_exe or not test_package_dir:
+        raise RuntimeError("test package not set")
+
+    manifest = {'package': [
+        {
+            'source': str(test_package_dir.absolute()),
+            'keyword': MANIFEST_KEYWORDS[0],
+            'exe': test_package_exe.name,
+            'description': 'installed from a manifest',
+        },
+        {
+            # no exe, the package only has one executable to pick
+            'source': str(test_package_exe.absolute()),
+            'keyword': MANIFEST_KEYWORDS[1],
+            'global': True,
+        },
+    ]}
+    manifest_path = popaman_exe.parent.parent / 'tools.json'
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f)
+
+    command = [str(popaman_exe.absolute()), "apply", str(manifest_path.absolute())]
+    try:
+        # no prompts are answered, apply must not ask for anything
+        returncode, stdout, stderr = await run_command(command)
+        if returncode != 0:
+            raise RuntimeError(f"Installation failed: {stderr}")
+        print("Installation command completed")
+    except Exception as e:
+        print(f"Installation failed: {e}")
+        raise
+
+    print("Verifying installation...")
+    with open(ass_tracker.get_packages_json()) as f:
+        packages = json.load(f)
+        for keyword in MANIFEST_KEYWORDS:
+            assert any(p['keyword'] == keyword for p in packages['package']), \
+                f"Package {keyword} not found in packages.json"
+        assert any(p['keyword'] == MANIFEST_KEYWORDS[1] and p['global'] for p in packages['package']), \
+            "Manifest global flag not applied"
+    verify_index(ass_tracker)
+
+    # a second apply finds everything installed and leaves the registry alone
+    returncode, stdout, stderr = await run_command(command)
+    if returncode != 0:
+        raise RuntimeError(f"Reapplying the manifest failed: {stderr}")
+    with open(ass_tracker.get_packages_json()) as f:
+        packages = json.load(f)
+        for keyword in MANIFEST_KEYWORDS:
+            count = sum(1 for p in packages['package'] if p['keyword'] == keyword)
+            assert count == 1, f"Package {keyword} registered {count} times after reapplying"
+
+    # one keyword given twice in a batch, or one that is already registered, installs nothing
+    duplicate = 'test-hello-manifest-dup'
+    with open(manifest_path, 'w') as f:
+        json.dump({'package': [
+            {'source': str(test_package_dir.absolute()), 'keyword': duplicate, 'exe': test_package_exe.name},
+            {'source': str(test_package_exe.absolute()), 'keyword': duplicate},
+        ]}, f)
+    returncode, stdout, stderr = await run_command(command)
+    assert returncode != 0, "Applying a manifest with a duplicate keyword succeeded"
+    interactive = [str(popaman_exe.absolute()), "install", str(test_package_dir.absolute()),
+                   str(test_package_exe.absolute())]
+    returncode, stdout, stderr = await run_command(
+        interactive, prompts=install_prompts(duplicate) + install_prompts(duplicate))
+    assert returncode != 0, "A batch install gave one keyword to two packages"
+    returncode, stdout, stderr = await run_command(
+        interactive, prompts=[prompt for keyword in MANIFEST_KEYWORDS for prompt in install_prompts(keyword)])
+    assert returncode != 0, "A batch install took already registered keywords"
+    with open(ass_tracker.get_packages_json()) as f:
+        packages = json.load(f)
+        assert not any(p['keyword'] == duplicate for p in packages['package']), \
+            "A package with a duplicate keyword was registered"
+        for keyword in MANIFEST_KEYWORDS:
+            count = sum(1 for p in packages['package'] if p['keyword'] == keyword)
+            assert count == 1, f"Package {keyword} registered {count} times"
+    lib_dir = ass_tracker.get_packages_json().parent
+    assert not (lib_dir / duplicate).exists(), "Files of a duplicate keyword were copied into lib/"
+    manifest_path.unlink()
     print("Verification complete")
 
-async def test_package_running(ass_tracker):
+async def test_package_running(ass_tracker, packages=None):
     print("\nTesting package execution...")
     try:
         popaman_exe = ass_tracker.get_file('popaman_exe')
@@ -550,15 +1481,18 @@ async def test_package_running(ass_tracker):
             raise RuntimeError(f"Popaman executable not found at {popaman_exe}")
         
         # Test each package type
-        packages = [
-            'test-hello',
-            'test-hello-link',
-            'test-hello-exe',
-            #'test-hello-url-exe',
-            'test-hello-7z',
-            #'test-hello-url-7z',
-            'test-hello-zip'  
-        ]
+        if packages is None:
+            packages = [
+                'test-hello',
+                'test-hello-link',
+                'test-hello-exe',
+                'test-hello-url-exe',
+                'test-hello-url-ranges',
+                'test-hello-7z',
+                #'test-hello-url-7z',
+                'test-hello-zip',
+                'test-hello-tar'
+            ] + BATCH_KEYWORDS + MANIFEST_KEYWORDS
         
         for pkg in packages:
             # Use list command to avoid path quoting issues
@@ -587,62 +1521,758 @@ async def test_package_running(ass_tracker):
 
 
 async def test_installation(ass_tracker, test_tracker):
-    # Test 1: Directory Package
+    """Install every case into the shared popaman root, one after another"""
+    for key, (keywords, install) in CASES.items():
+        case = test_tracker.cases[key]
+        try:
+            async with case.step('install'):
+                await install(ass_tracker)
+        except Exception as e:
+            print(f"{case.name} installation failed: {e}")
+
+async def test_lifecycle(ass_tracker, test_case, keywords):
+    """Run and then remove the packages of an installed case, each step on its own"""
     try:
-        await test_package_installation_from_dir(ass_tracker)
-        test_tracker.cases['dir'].install = True
+        async with test_case.step('run'):
+            await test_package_running(ass_tracker, keywords)
     except Exception as e:
-        test_tracker.cases['dir'].install = False
-        print(f"Directory installation failed: {e}")
+        print(f"{test_case.name} execution failed: {e}")
 
-    # Test 2: Linked Package
     try:
-        await test_package_linking(ass_tracker)
-        test_tracker.cases['link'].install = True
+        async with test_case.step('remove'):
+            await test_package_removal(ass_tracker, keywords)
     except Exception as e:
-        test_tracker.cases['link'].install = False
-        print(f"Link installation failed: {e}")
+        print(f"{test_case.name} removal failed: {e}")
+
+# keywords each case installs under and the coroutine that installs them
+CASES = {
+    'dir': (['test-hello'], test_package_installation_from_dir),
+    'link': (['test-hello-link'], test_package_linking),
+    'exe': (['test-hello-exe'], test_package_installation_from_exe),
+    'url_exe': (['test-hello-url-exe'], test_package_installation_from_url_exe),
+    'url_ranges': (['test-hello-url-ranges'], test_package_installation_from_url_ranges),
+    '7z': (['test-hello-7z'], test_package_installation_from_7z),
+    'zip': (['test-hello-zip'], test_package_installation_from_zip),
+    'tar': (['test-hello-tar'], test_package_installation_from_tar),
+    'batch': (BATCH_KEYWORDS, test_package_installation_batch),
+    'manifest': (MANIFEST_KEYWORDS, test_package_installation_manifest),
+}
+
+def create_sandbox(ass_tracker, sandbox_root):
+    """Clone the installed popaman root into sandbox_root and return a tracker pointing at the clone"""
+    popaman_bin = ass_tracker.get_directory('popaman_bin')
+    if not popaman_bin:
+        raise RuntimeError("popaman_bin directory not set")
+
+    sandbox_dir = Path(sandbox_root) / 'popaman'
+    # symlinks=True keeps the 7zr link pointing at the system binary
+    shutil.copytree(popaman_bin.parent, sandbox_dir, symlinks=True)
+
+    sandbox = copy.deepcopy(ass_tracker)
+    sandbox.set_directory('popaman_bin', sandbox_dir / 'bin')
+    sandbox.set_file('popaman_exe', sandbox_dir / 'bin' / ass_tracker.get_file('popaman_exe').name)
+    return sandbox
+
+def populate_registry(ass_tracker, count, prefix='synthetic'):
+    """Append `count` synthetic entries to the registry, each with a stub lib/<name> directory"""
+    packages_json = ass_tracker.get_packages_json()
+    lib_dir = packages_json.parent
+    with open(packages_json) as f:
+        registry = json.load(f)
 
-    # Test 3: Executable Package
+    for i in range(count):
+        name = f'{prefix}-{i:06d}'
+        (lib_dir / name).mkdir(exist_ok=True)
+        registry['package'].append({
+            'name': name,
+            'path': 'bin/tool',
+            'keyword': name,
+            'description': f'synthetic package {i}',
+            'global': False,
+        })
+
+    with open(packages_json, 'w') as f:
+        json.dump(registry, f)
+
+# seconds `popaman list` may take on a registry of LIST_PACKAGES entries
+LIST_PACKAGES = 5000
+LIST_BUDGET = 1.0
+
+async def test_list_latency(ass_tracker, count=LIST_PACKAGES, budget=LIST_BUDGET):
+    """list and list -v must print every package of a large registry within the budget"""
+    print(f"\nTesting list latency with {count} packages...")
+    sandbox_root = tempfile.mkdtemp(prefix='popaman-list-')
     try:
-        await test_package_installation_from_exe(ass_tracker)
-        test_tracker.cases['exe'].install = True
-    except Exception as e:
-        test_tracker.cases['exe'].install = False
-        print(f"Executable installation failed: {e}")
-
-    # # Test 4: URL Executable Package
-    # try:
-    #     await test_package_installation_from_url_exe()
-    #     tracker.cases['url_exe'].install = True
-    # except Exception as e:
-    #     tracker.cases['url_exe'].install = False
-    #     print(f"URL executable installation failed: {e}")
-
-    # Test 5: 7z Archive Package
+        sandbox = await asyncio.to_thread(create_sandbox, ass_tracker, sandbox_root)
+        await asyncio.to_thread(populate_registry, sandbox, count)
+        popaman_exe = str(sandbox.get_file('popaman_exe').absolute())
+
+        for command in ([popaman_exe, 'list'], [popaman_exe, 'list', '-v']):
+            start = time.perf_counter()
+            returncode, stdout, stderr = await run_command(command)
+            elapsed = time.perf_counter() - start
+            if returncode != 0:
+                raise RuntimeError(f"{' '.join(command[1:])} failed: {stderr}")
+
+            listed = set((stdout + stderr).split())
+            missing = [i for i in range(count) if f'synthetic-{i:06d}' not in listed]
+            if missing:
+                raise RuntimeError(f"{' '.join(command[1:])} is missing {len(missing)} packages")
+            if elapsed > budget:
+                raise RuntimeError(f"{' '.join(command[1:])} took {elapsed:.3f}s, budget is {budget:.3f}s")
+            print(f"{' '.join(command[1:])}: {elapsed * 1000:.1f}ms")
+    finally:
+        await asyncio.to_thread(shutil.rmtree, sandbox_root, True)
+    print("List latency verification complete")
+
+DISCOVERY_FILES = 50000
+DISCOVERY_BUDGET = 5.0
+
+def make_discovery_package(root, test_package, count):
+    """A package of count plain files around a few real and decoy executables"""
+    package_dir = Path(root) / 'discovery-package'
+    for i in range(count):
+        path = package_dir / 'data' / f'd{i % 100}' / f'file{i}.txt'
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(b'')
+    binary = test_package.read_bytes()
+    executables = {
+        test_package.name: binary,
+        f'bin/helper{test_package.suffix}': binary,
+        'run.sh': b'#!/bin/sh\necho hello\n',
+        # decoys: executable but not runnable, or in a subtree that is never searched
+        'lib/libfoo.so.1': binary,
+        'node_modules/.bin/tool': b'#!/bin/sh\n',
+    }
+    for name, content in executables.items():
+        path = package_dir / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(content)
+        path.chmod(0o755)
+    for name in ('LICENSE', 'Makefile'):
+        (package_dir / name).write_text('not a program\n')
+    return package_dir
+
+async def test_exe_discovery(ass_tracker, count=DISCOVERY_FILES, budget=DISCOVERY_BUDGET):
+    """Linking a package of count files must list its executables, best first, within the budget"""
+    print(f"\nTesting executable discovery in a {count} file package...")
+    sandbox_root = tempfile.mkdtemp(prefix='popaman-discovery-')
     try:
-        await test_package_installation_from_7z(ass_tracker)
-        test_tracker.cases['7z'].install = True
-    except Exception as e:
-        test_tracker.cases['7z'].install = False
-        print(f"7z archive installation failed: {e}")
+        sandbox = await asyncio.to_thread(create_sandbox, ass_tracker, sandbox_root)
+        test_package = ass_tracker.get_file('test_package')
+        package_dir = await asyncio.to_thread(make_discovery_package, sandbox_root, test_package, count)
+        popaman_exe = str(sandbox.get_file('popaman_exe').absolute())
 
-    # # Test 6: URL 7z Archive Package
-    # try:
-    #     await test_package_installation_from_url_7z()
-    #     test_tracker.cases['url_7z'].install = True
-    # except Exception as e:
-    #     test_tracker.cases['url_7z'].install = False
-    #     print(f"URL 7z archive installation failed: {e}")
+        # link leaves the files in place, so the time is the walk and not a copy
+        start = time.perf_counter()
+        returncode, stdout, stderr = await run_command([popaman_exe, 'link', str(package_dir)],
+                                                       prompts=install_prompts('test-hello-discovery'))
+        elapsed = time.perf_counter() - start
+        if returncode != 0:
+            raise RuntimeError(f"link failed: {stderr}")
+
+        listing = stderr.split('Available executables', 1)[-1]
+        listed = [line.split(': ', 1)[1] for line in listing.splitlines()
+                  if line.split(': ', 1)[0].isdigit()]
+        expected = [test_package.name, str(Path('bin') / f'helper{test_package.suffix}')]
+        if os.name != 'nt':
+            expected.append('run.sh')
+        if listed != expected:
+            raise RuntimeError(f"Expected executables {expected}, got {listed}")
+        if elapsed > budget:
+            raise RuntimeError(f"link took {elapsed:.3f}s, budget is {budget:.3f}s")
+        print(f"link: {elapsed * 1000:.1f}ms")
+    finally:
+        await asyncio.to_thread(shutil.rmtree, sandbox_root, True)
+    print("Executable discovery verification complete")
 
+async def test_verify(ass_tracker):
+    """verify must pass on a fresh install and name every file that was changed,
+    deleted or added afterwards, including a same-size change with a new mtime"""
+    print("\nTesting package verification...")
+    sandbox_root = tempfile.mkdtemp(prefix='popaman-verify-')
     try:
-        await test_package_installation_from_zip(ass_tracker)
-        test_tracker.cases['zip'].install = True
-    except Exception as e:
-        test_tracker.cases['zip'].install = False
-        print(f"zip archive installation failed: {e}")
+        sandbox = await asyncio.to_thread(create_sandbox, ass_tracker, sandbox_root)
+        popaman_exe = str(sandbox.get_file('popaman_exe').absolute())
+        source = str(ass_tracker.get_directory('test_package_dir').absolute())
+
+        async def verify(*args):
+            returncode, stdout, stderr = await run_command([popaman_exe, 'verify', *args])
+            return returncode, stdout + stderr
+
+        returncode, stdout, stderr = await run_command([popaman_exe, 'install', source],
+                                                       prompts=install_prompts('test-hello-verify'))
+        if returncode != 0:
+            raise RuntimeError(f"install failed: {stderr}")
+        manifest = Path(sandbox_root) / 'popaman' / 'manifest' / 'test-hello-verify.json'
+        with open(manifest) as f:
+            recorded = {entry['path']: entry for entry in json.load(f)['files']}
+        lib_dir = sandbox.get_packages_json().parent / 'test-hello-verify'
+        on_disk = {str(p.relative_to(lib_dir)) for p in lib_dir.rglob('*') if p.is_file()}
+        if set(recorded) != on_disk:
+            raise RuntimeError(f"Manifest lists {sorted(recorded)}, lib holds {sorted(on_disk)}")
+
+        returncode, output = await verify('test-hello-verify')
+        if returncode != 0 or 'OK test-hello-verify' not in output:
+            raise RuntimeError(f"verify failed on a fresh install: {output}")
+
+        # flip one byte without changing the size, so only the hash can tell
+        victim = lib_dir / next(iter(sorted(recorded)))
+        data = bytearray(victim.read_bytes())
+        data[-1] ^= 0xFF
+        victim.write_bytes(bytes(data))
+        (lib_dir / 'planted.txt').write_text('not from the package\n')
+        returncode, output = await verify('--all')
+        if returncode == 0:
+            raise RuntimeError(f"verify passed a modified package: {output}")
+        for expected in (f"modified: {victim.name}", "extra: planted.txt"):
+            if expected not in output:
+                raise RuntimeError(f"verify did not report '{expected}': {output}")
+
+        victim.unlink()
+        returncode, output = await verify('test-hello-verify')
+        if returncode == 0 or f"missing: {victim.name}" not in output:
+            raise RuntimeError(f"verify did not report the missing file: {output}")
+
+        # remove takes the manifest with the package
+        returncode, stdout, stderr = await run_command([popaman_exe, 'remove', 'test-hello-verify'])
+        if returncode != 0 or manifest.exists():
+            raise RuntimeError(f"remove left the manifest behind: {stderr}")
+    finally:
+        await asyncio.to_thread(shutil.rmtree, sandbox_root, True)
+    print("Verification check complete")
+
+def make_package_versions(root, test_package):
+    """Two versions of a package: v2 changes one file, drops one and adds one,
+    and keeps the executable and the large data file as they were"""
+    versions = []
+    for version in ('v1', 'v2'):
+        package_dir = Path(root) / f'upgrade-{version}'
+        (package_dir / 'data').mkdir(parents=True)
+        shutil.copy2(test_package, package_dir / test_package.name)
+        (package_dir / 'data' / 'large.bin').write_bytes(bytes(range(256)) * 4096)
+        (package_dir / 'data' / 'config.txt').write_text(f'version = {version}\n')
+        versions.append(package_dir)
+    v1, v2 = versions
+    (v1 / 'data' / 'stale.txt').write_text('only in v1\n')
+    (v2 / 'data' / 'added.txt').write_text('only in v2\n')
+    return v1, v2
+
+def tree_contents(root):
+    return {str(p.relative_to(root)): p.read_bytes() for p in Path(root).rglob('*') if p.is_file()}
+
+async def test_upgrade(ass_tracker):
+    """upgrade must leave exactly the new version in lib, rewrite only what changed
+    and keep the package runnable and verifiable"""
+    print("\nTesting package upgrade...")
+    sandbox_root = tempfile.mkdtemp(prefix='popaman-upgrade-')
+    try:
+        sandbox = await asyncio.to_thread(create_sandbox, ass_tracker, sandbox_root)
+        popaman_exe = str(sandbox.get_file('popaman_exe').absolute())
+        v1, v2 = await asyncio.to_thread(make_package_versions, sandbox_root, ass_tracker.get_file('test_package'))
+
+        returncode, stdout, stderr = await run_command([popaman_exe, 'install', str(v1)],
+                                                       prompts=install_prompts('test-hello-upgrade'))
+        if returncode != 0:
+            raise RuntimeError(f"install failed: {stderr}")
+        lib_dir = sandbox.get_packages_json().parent / 'test-hello-upgrade'
+        large_before = (lib_dir / 'data' / 'large.bin').stat()
+
+        returncode, stdout, stderr = await run_command([popaman_exe, 'upgrade', 'test-hello-upgrade', str(v2)])
+        if returncode != 0:
+            raise RuntimeError(f"upgrade failed: {stderr}")
+        expected = "1 changed, 1 added, 1 removed, 2 unchanged"
+        if expected not in stdout + stderr:
+            raise RuntimeError(f"upgrade did not report '{expected}': {stderr}")
+        if tree_contents(lib_dir) != tree_contents(v2):
+            raise RuntimeError("lib does not hold exactly the new version after upgrade")
+        # an unchanged file is carried over, not written again
+        large_after = (lib_dir / 'data' / 'large.bin').stat()
+        if os.name != 'nt' and large_after.st_ino != large_before.st_ino:
+            raise RuntimeError("upgrade rewrote a file that did not change")
+
+        returncode, stdout, stderr = await run_command([popaman_exe, 'test-hello-upgrade'])
+        if returncode != 0 or 'Hello, world!' not in stdout + stderr:
+            raise RuntimeError(f"upgraded package does not run: {stderr}")
+        returncode, stdout, stderr = await run_command([popaman_exe, 'verify', 'test-hello-upgrade'])
+        if returncode != 0:
+            raise RuntimeError(f"verify failed after upgrade: {stdout + stderr}")
+
+        returncode, stdout, stderr = await run_command([popaman_exe, 'upgrade', 'test-hello-upgrade', str(v2)])
+        if returncode != 0 or 'already up to date' not in stdout + stderr:
+            raise RuntimeError(f"second upgrade was not a no-op: {stderr}")
+        leftovers = [p.name for p in lib_dir.parent.iterdir() if p.name.startswith('test-hello-upgrade.')]
+        if leftovers:
+            raise RuntimeError(f"upgrade left {leftovers} behind in lib")
+    finally:
+        await asyncio.to_thread(shutil.rmtree, sandbox_root, True)
+    print("Upgrade check complete")
+
+async def test_archive_cache(ass_tracker):
+    """An archive extracted on a cache miss is moved into lib, and installing it again
+    copies that package instead of extracting, until the package is changed"""
+    print("\nTesting archive installs through the cache...")
+    sandbox_root = tempfile.mkdtemp(prefix='popaman-archive-cache-')
+    try:
+        sandbox = await asyncio.to_thread(create_sandbox, ass_tracker, sandbox_root)
+        popaman_exe = str(sandbox.get_file('popaman_exe').absolute())
+        lib_dir = sandbox.get_packages_json().parent
+        test_package = ass_tracker.get_file('test_package')
+
+        # an archive no other check installs, so the sandbox's cache has never seen it
+        package_dir = Path(sandbox_root) / 'archive-cache'
+        package_dir.mkdir()
+        shutil.copy2(test_package, package_dir / test_package.name)
+        (package_dir / 'marker.txt').write_text(f'{sandbox_root}\n')
+        archive = Path(sandbox_root) / 'archive-cache.tar.gz'
+        await asyncio.to_thread(write_tar, archive, sorted(package_dir.iterdir()))
+
+        async def install(keyword):
+            returncode, stdout, stderr = await run_command([popaman_exe, 'install', str(archive)],
+                                                           prompts=install_prompts(keyword))
+            if returncode != 0:
+                raise RuntimeError(f"install of {keyword} failed: {stderr}")
+            if tree_contents(lib_dir / keyword) != tree_contents(package_dir):
+                raise RuntimeError(f"lib/{keyword} does not hold the archive's files")
+            return 'Using the extraction' in stdout + stderr
 
+        if await install('test-hello-cache-a'):
+            raise RuntimeError("the first install of the archive did not extract it")
+        installed = list((Path(sandbox_root) / 'popaman' / 'cache').glob('*/installed/test-hello-cache-a.json'))
+        if not installed:
+            raise RuntimeError("the cache does not refer to the installed extraction")
+        if list((Path(sandbox_root) / 'popaman' / 'cache').glob('*/extract')):
+            raise RuntimeError("the extraction was written to the cache as well as to lib")
 
+        if not await install('test-hello-cache-b'):
+            raise RuntimeError("the second install extracted the archive again")
+
+        # the keyword is taken, and the package it names must survive the attempt
+        returncode, stdout, stderr = await run_command([popaman_exe, 'install', str(archive)],
+                                                       prompts=install_prompts('test-hello-cache-a'))
+        if returncode == 0:
+            raise RuntimeError("the archive installed again under a keyword it already has")
+        if tree_contents(lib_dir / 'test-hello-cache-a') != tree_contents(package_dir):
+            raise RuntimeError("installing under a taken keyword changed the package it names")
+        with open(sandbox.get_packages_json()) as f:
+            registered = [p['keyword'] for p in json.load(f)['package']]
+        if registered.count('test-hello-cache-a') != 1:
+            raise RuntimeError(f"test-hello-cache-a is registered {registered.count('test-hello-cache-a')} times")
+
+        # a changed package is no longer what the archive extracts to
+        (lib_dir / 'test-hello-cache-a' / 'marker.txt').write_text('changed\n')
+        (lib_dir / 'test-hello-cache-b' / 'marker.txt').write_text('changed too\n')
+        if await install('test-hello-cache-c'):
+            raise RuntimeError("an install copied a package that was changed after it was installed")
+        if installed[0].exists():
+            raise RuntimeError("the reference to a changed package was kept")
+
+        # lib/test-hello-cache-c is now the only extraction to copy, and a package left there
+        # without its registry entry is replaced by a fresh extraction, not copied onto itself
+        with open(sandbox.get_packages_json()) as f:
+            registry = json.load(f)
+        registry['package'] = [p for p in registry['package'] if p['keyword'] != 'test-hello-cache-c']
+        with open(sandbox.get_packages_json(), 'w') as f:
+            json.dump(registry, f)
+        await install('test-hello-cache-c')
+        returncode, stdout, stderr = await run_command([popaman_exe, 'test-hello-cache-c'])
+        if returncode != 0:
+            raise RuntimeError(f"the package installed over its own extraction does not run: {stderr}")
+    finally:
+        await asyncio.to_thread(shutil.rmtree, sandbox_root, True)
+    print("Archive cache check complete")
+
+async def test_archive_modes(ass_tracker):
+    """An executable extracted from a tarball keeps the permission bits it was archived
+    with, minus the umask, instead of being opened up to everyone"""
+    print("\nTesting modes of extracted executables...")
+    sandbox_root = tempfile.mkdtemp(prefix='popaman-archive-modes-')
+    try:
+        sandbox = await asyncio.to_thread(create_sandbox, ass_tracker, sandbox_root)
+        popaman_exe = str(sandbox.get_file('popaman_exe').absolute())
+        test_package = ass_tracker.get_file('test_package')
+
+        archive = Path(sandbox_root) / 'modes.tar.gz'
+        with tarfile.open(archive, 'w:gz') as tar:
+            info = tar.gettarinfo(test_package, test_package.name)
+            info.mode = 0o750
+            with open(test_package, 'rb') as f:
+                tar.addfile(info, f)
+
+        returncode, stdout, stderr = await run_command([popaman_exe, 'install', str(archive)],
+                                                       prompts=install_prompts('test-hello-modes'))
+        if returncode != 0:
+            raise RuntimeError(f"install failed: {stderr}")
+        umask = os.umask(0)
+        os.umask(umask)
+        installed = sandbox.get_packages_json().parent / 'test-hello-modes' / test_package.name
+        mode = installed.stat().st_mode & 0o777
+        if os.name != 'nt' and mode != 0o750 & ~umask:
+            raise RuntimeError(f"{test_package.name} was extracted with mode {mode:o}, archived as 750")
+    finally:
+        await asyncio.to_thread(shutil.rmtree, sandbox_root, True)
+    print("Archive mode check complete")
+
+def write_hostile_archives(root, test_package, outside):
+    """Archives whose symlinks lead out of the package, each paired with the keyword it
+    is installed as. every one holds the test package, so it would install otherwise"""
+    def tar_link(name, target):
+        info = tarfile.TarInfo(name)
+        info.type = tarfile.SYMTYPE
+        info.linkname = target
+        return info
+
+    def tar_file(name, data):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        return info, io.BytesIO(data)
+
+    tarballs = {
+        # a member written through a link made by an earlier member
+        'through-absolute': [tar_link('esc', str(outside)), tar_file('esc/pwned', b'pwned\n')],
+        'through-relative': [tar_link('esc', '..'), tar_file('esc/pwned', b'pwned\n')],
+        # links that point out, whether or not anything is written through them
+        'absolute': [tar_link('bin/tool', str(outside / 'tool'))],
+        'climbing': [tar_link('bin/tool', '../../tool')],
+        'climbing-after-link': [tar_link('up', '.'), tar_link('escape', 'up/..')],
+        'link-in-link': [tar_link('up', '.'), tar_link('up/escape', '..')],
+    }
+    archives = []
+    for name, members in tarballs.items():
+        archive_path = Path(root) / f'{name}.tar.gz'
+        with tarfile.open(archive_path, 'w:gz') as archive:
+            archive.add(test_package, test_package.name)
+            for member in members:
+                if isinstance(member, tuple):
+                    archive.addfile(*member)
+                else:
+                    archive.addfile(member)
+        archives.append((archive_path, f'test-hello-hostile-{name}'))
+
+    # zip keeps a symlink as a file holding its target, with the link mode in the upper
+    # half of the external attributes
+    archive_path = Path(root) / 'through-zip.zip'
+    with zipfile.ZipFile(archive_path, 'w') as archive:
+        archive.write(test_package, test_package.name)
+        link = zipfile.ZipInfo('esc')
+        link.create_system = 3
+        link.external_attr = 0o120777 << 16
+        archive.writestr(link, str(outside))
+        archive.writestr('esc/pwned', 'pwned\n')
+    archives.append((archive_path, 'test-hello-hostile-zip'))
+    return archives
+
+def write_linked_archive(archive_path, test_package):
+    """A tarball with symlinks that stay inside it, as shared libraries and tools ship them"""
+    with tarfile.open(archive_path, 'w:gz') as archive:
+        archive.add(test_package, test_package.name)
+        library = tarfile.TarInfo('lib/libx.so.1')
+        library.size = 4
+        archive.addfile(library, io.BytesIO(b'libx'))
+        for name, target in (('tool-link', test_package.name), ('lib/libx.so', 'libx.so.1')):
+            link = tarfile.TarInfo(name)
+            link.type = tarfile.SYMTYPE
+            link.linkname = target
+            archive.addfile(link)
+
+async def test_archive_symlinks(ass_tracker):
+    """Archives with symlinks that lead out of the package must not install, and must not
+    leave anything behind outside of it. links that stay inside survive every install"""
+    print("\nTesting archives with escaping symlinks...")
+    sandbox_root = tempfile.mkdtemp(prefix='popaman-archive-links-')
+    try:
+        sandbox = await asyncio.to_thread(create_sandbox, ass_tracker, sandbox_root)
+        popaman_exe = str(sandbox.get_file('popaman_exe').absolute())
+        lib_dir = sandbox.get_packages_json().parent
+        outside = Path(sandbox_root) / 'outside'
+        outside.mkdir()
+        archives = await asyncio.to_thread(write_hostile_archives, sandbox_root,
+                                           ass_tracker.get_file('test_package'), outside)
+
+        for archive, keyword in archives:
+            # refused while extracting, before any prompt. one that is not waits at the
+            # prompt until the timeout
+            returncode, stdout, stderr = await run_command([popaman_exe, 'install', str(archive)], timeout=15)
+            if returncode == 0:
+                raise RuntimeError(f"{archive.name} installed although its symlinks leave the package")
+            if 'UnsafeSymlink' not in stdout + stderr:
+                raise RuntimeError(f"{archive.name} failed for another reason: {stderr}")
+            if (lib_dir / keyword).exists():
+                raise RuntimeError(f"{archive.name} left lib/{keyword} behind")
+
+        # links that stay inside are kept, whether the package is moved into lib from the
+        # extraction or copied there from the earlier install of the same archive
+        linked = Path(sandbox_root) / 'linked.tar.gz'
+        await asyncio.to_thread(write_linked_archive, linked, ass_tracker.get_file('test_package'))
+        links = {'tool-link': ass_tracker.get_file('test_package').name, 'lib/libx.so': 'libx.so.1'}
+        for keyword in ('test-hello-linked-a', 'test-hello-linked-b'):
+            returncode, stdout, stderr = await run_command([popaman_exe, 'install', str(linked)],
+                                                           prompts=install_prompts(keyword))
+            if returncode != 0:
+                raise RuntimeError(f"install of {keyword} failed: {stderr}")
+            for name, target in links.items():
+                link = lib_dir / keyword / name
+                if not link.is_symlink() or os.readlink(link) != target:
+                    raise RuntimeError(f"lib/{keyword}/{name} is not a symlink to {target}")
+        if 'Using the extraction' not in stdout + stderr:
+            raise RuntimeError("the second install did not copy the first one")
+
+        written = [p.name for p in outside.iterdir()] + [str(p) for p in Path(sandbox_root).rglob('pwned')]
+        if written:
+            raise RuntimeError(f"extraction wrote {written} outside of the package")
+        stray = [p.name for p in Path(sandbox_root).iterdir()
+                 if p.name not in {'popaman', 'outside'} and not p.name.endswith(('.tar.gz', '.zip'))]
+        if stray:
+            raise RuntimeError(f"extraction wrote {stray} next to the popaman root")
+    finally:
+        await asyncio.to_thread(shutil.rmtree, sandbox_root, True)
+    print("Archive symlink check complete")
+
+PROBE_SCRIPT = """#!/bin/sh
+case "$1" in
+    exit) exit "$2" ;;
+    echo) exec cat ;;
+    wait) echo "pid $$"; exec sleep 30 ;;
+esac
+"""
+
+async def test_dispatch(ass_tracker):
+    """Running a package by keyword must behave like running it directly: same pid,
+    same exit code, signals reach it and stdin/stdout stream through while it runs"""
+    print("\nTesting package dispatch...")
+    if os.name == 'nt':
+        print("Skipping dispatch check, it relies on sh and posix signals")
+        return
+    sandbox_root = tempfile.mkdtemp(prefix='popaman-dispatch-')
+    try:
+        sandbox = await asyncio.to_thread(create_sandbox, ass_tracker, sandbox_root)
+        popaman_exe = str(sandbox.get_file('popaman_exe').absolute())
+        package_dir = Path(sandbox_root) / 'probe-package'
+        package_dir.mkdir()
+        probe = package_dir / 'probe.sh'
+        probe.write_text(PROBE_SCRIPT)
+        probe.chmod(0o755)
+        returncode, stdout, stderr = await run_command([popaman_exe, 'link', str(package_dir)],
+                                                       prompts=install_prompts('probe'))
+        if returncode != 0:
+            raise RuntimeError(f"link failed: {stderr}")
+
+        for code in (0, 7, 255):
+            returncode, stdout, stderr = await run_command([popaman_exe, 'probe', 'exit', str(code)])
+            if returncode != code:
+                raise RuntimeError(f"probe exit {code} returned {returncode}: {stderr}")
+
+        # stdout must answer each line while the package is still running, not at exit
+        process = await asyncio.create_subprocess_exec(
+            popaman_exe, 'probe', 'echo',
+            stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE)
+        try:
+            for i in range(3):
+                line = f"line {i}\n".encode()
+                process.stdin.write(line)
+                await process.stdin.drain()
+                echoed = await asyncio.wait_for(process.stdout.readline(), COMMAND_TIMEOUT)
+                if echoed != line:
+                    raise RuntimeError(f"Expected {line!r} back from probe, got {echoed!r}")
+            process.stdin.close()
+            if await asyncio.wait_for(process.wait(), COMMAND_TIMEOUT) != 0:
+                raise RuntimeError("probe echo did not exit cleanly at end of input")
+        finally:
+            with contextlib.suppress(ProcessLookupError):
+                process.kill()
+
+        # the package must be the process popaman was started as, so a signal sent to
+        # that pid stops the package rather than orphaning it
+        process = await asyncio.create_subprocess_exec(
+            popaman_exe, 'probe', 'wait',
+            stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.PIPE)
+        try:
+            announced = await asyncio.wait_for(process.stdout.readline(), COMMAND_TIMEOUT)
+            if announced.decode().strip() != f"pid {process.pid}":
+                raise RuntimeError(f"probe ran as {announced.decode().strip()!r}, popaman was pid {process.pid}")
+            process.send_signal(signal.SIGTERM)
+            returncode = await asyncio.wait_for(process.wait(), COMMAND_TIMEOUT)
+            if returncode != -signal.SIGTERM:
+                raise RuntimeError(f"probe wait returned {returncode} after SIGTERM")
+        finally:
+            with contextlib.suppress(ProcessLookupError):
+                process.kill()
+    finally:
+        await asyncio.to_thread(shutil.rmtree, sandbox_root, True)
+    print("Dispatch verification complete")
+
+STARTUP_RUNS = 50
+STARTUP_SCRIPT = "#!/bin/sh\nexit 0\n"
+
+def count_syscalls(trace_path):
+    """Syscalls by name that popaman made before it exec'd the package, from an strace log"""
+    counts = {}
+    opened = []
+    execs = 0
+    for line in Path(trace_path).read_text().splitlines():
+        match = re.match(r'(\w+)\(', line)
+        if not match:
+            continue
+        name = match.group(1)
+        if name == 'execve':
+            execs += 1
+            # the first execve started popaman, the second is the package taking its place
+            if execs == 2:
+                break
+        counts[name] = counts.get(name, 0) + 1
+        if name in ('open', 'openat', 'readlink', 'readlinkat'):
+            opened.append(line)
+    return counts, opened
+
+async def test_startup(ass_tracker, runs=STARTUP_RUNS):
+    """Time popaman <keyword> up to the exec of the package and, where strace is installed,
+    count its syscalls: the root is resolved and packages.json opened only once"""
+    print(f"\nTesting startup over {runs} runs...")
+    if os.name == 'nt':
+        print("Skipping startup check, it relies on sh")
+        return
+    sandbox_root = tempfile.mkdtemp(prefix='popaman-startup-')
+    try:
+        sandbox = await asyncio.to_thread(create_sandbox, ass_tracker, sandbox_root)
+        popaman_exe = str(sandbox.get_file('popaman_exe').absolute())
+        package_dir = Path(sandbox_root) / 'startup-package'
+        package_dir.mkdir()
+        script = package_dir / 'startup.sh'
+        script.write_text(STARTUP_SCRIPT)
+        script.chmod(0o755)
+        returncode, stdout, stderr = await run_command([popaman_exe, 'link', str(package_dir)],
+                                                       prompts=install_prompts('startup'))
+        if returncode != 0:
+            raise RuntimeError(f"link failed: {stderr}")
+
+        times = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            returncode, stdout, stderr = await run_command([popaman_exe, 'startup'])
+            times.append(time.perf_counter() - start)
+            if returncode != 0:
+                raise RuntimeError(f"popaman startup returned {returncode}: {stderr}")
+        times.sort()
+        print(f"popaman startup: p50 {times[len(times) // 2] * 1000:.1f}ms, max {times[-1] * 1000:.1f}ms")
+
+        strace = shutil.which('strace')
+        if not strace:
+            print("strace is not installed, reporting wall time only")
+            return
+        trace_path = Path(sandbox_root) / 'startup.strace'
+        returncode, stdout, stderr = await run_command([strace, '-o', str(trace_path), popaman_exe, 'startup'])
+        if returncode != 0:
+            raise RuntimeError(f"strace popaman startup returned {returncode}: {stderr}")
+        counts, opened = await asyncio.to_thread(count_syscalls, trace_path)
+        print(f"popaman startup: {sum(counts.values())} syscalls before exec")
+        for name, count in sorted(counts.items(), key=lambda item: -item[1]):
+            print(f"  {name}: {count}")
+
+        registry_opens = [line for line in opened if 'packages.json' in line]
+        exe_reads = [line for line in opened if '/proc/self/exe' in line]
+        if len(registry_opens) != 1:
+            raise RuntimeError(f"packages.json was opened {len(registry_opens)} times: {registry_opens}")
+        if len(exe_reads) > 1:
+            raise RuntimeError(f"/proc/self/exe was read {len(exe_reads)} times")
+    finally:
+        await asyncio.to_thread(shutil.rmtree, sandbox_root, True)
+    print("Startup verification complete")
+
+async def test_registry_stress(ass_tracker, count):
+    """Install, remove and globalize count packages from concurrent popaman processes,
+    then check that packages.json and packages.idx hold exactly what should be left"""
+    print(f"\nStress testing the registry with {count} concurrent processes...")
+    sandbox_root = tempfile.mkdtemp(prefix='popaman-stress-')
+    try:
+        sandbox = await asyncio.to_thread(create_sandbox, ass_tracker, sandbox_root)
+        popaman_exe = str(sandbox.get_file('popaman_exe').absolute())
+        source = str(ass_tracker.get_directory('test_package_dir').absolute())
+
+        async def popaman(*args, prompts=None):
+            returncode, stdout, stderr = await run_command([popaman_exe, *args], prompts=prompts)
+            if returncode != 0:
+                raise RuntimeError(f"popaman {' '.join(args)} failed: {stderr}")
+
+        with open(sandbox.get_packages_json()) as f:
+            preinstalled = [p['keyword'] for p in json.load(f)['package']]
+
+        async def race(*commands):
+            # every process runs to completion before the first failure is reported
+            results = await asyncio.gather(*commands, return_exceptions=True)
+            errors = [result for result in results if isinstance(result, Exception)]
+            if errors:
+                raise RuntimeError(f"{len(errors)} of {len(results)} processes failed, first: {errors[0]}")
+
+        first = [f'stress-a-{i:03d}' for i in range(count)]
+        second = [f'stress-b-{i:03d}' for i in range(count // 2)]
+        await race(*(popaman('install', source, prompts=install_prompts(keyword)) for keyword in first))
+
+        # removes, globalizes and fresh installs all racing each other
+        removed, globalized = first[0::2], first[1::2]
+        await race(
+            *(popaman('remove', keyword) for keyword in removed),
+            *(popaman('globalize', keyword, '-a') for keyword in globalized),
+            *(popaman('install', source, prompts=install_prompts(keyword)) for keyword in second),
+        )
+
+        with open(sandbox.get_packages_json()) as f:
+            packages = json.load(f)['package']
+        keywords = sorted(p['keyword'] for p in packages)
+        expected = sorted(preinstalled + globalized + second)
+        if keywords != expected:
+            missing, extra = set(expected) - set(keywords), set(keywords) - set(expected)
+            raise RuntimeError(f"Registry is off: missing {sorted(missing)}, unexpected {sorted(extra)}")
+        not_global = [p['keyword'] for p in packages if p['keyword'] in globalized and not p['global']]
+        if not_global:
+            raise RuntimeError(f"Lost the global flag of {not_global}")
+        verify_index(sandbox)
+
+        # the registry still dispatches
+        await popaman(second[0])
+    finally:
+        await asyncio.to_thread(shutil.rmtree, sandbox_root, True)
+    print("Registry stress verification complete")
+
+async def run_case(key, ass_tracker, test_case, semaphore):
+    """Run the install/run/remove lifecycle of one case in its own popaman root"""
+    keywords, install = CASES[key]
+    # gather runs every case in its own task, so this only affects this case
+    TRACE_SPANS.set(test_case.spans)
+    async with semaphore:
+        sandbox_root = tempfile.mkdtemp(prefix=f'popaman-{key}-')
+        try:
+            sandbox = await asyncio.to_thread(create_sandbox, ass_tracker, sandbox_root)
+
+            try:
+                async with test_case.step('install'):
+                    await install(sandbox)
+            except Exception as e:
+                print(f"{test_case.name} installation failed: {e}")
+                return
+
+            await test_lifecycle(sandbox, test_case, keywords)
+        finally:
+            await asyncio.to_thread(shutil.rmtree, sandbox_root, True)
+
+async def run_check(test_tracker, name, label, check):
+    """Await one standalone check, recording whether it passed and how long it took"""
+    start = time.perf_counter()
+    try:
+        await check
+        test_tracker.checks[name] = True
+    except Exception as e:
+        test_tracker.checks[name] = False
+        print(f"{label} check failed: {e}")
+    finally:
+        test_tracker.check_durations[name] = time.perf_counter() - start
+
+async def test_parallel(ass_tracker, test_tracker, jobs):
+    """Run every case concurrently, at most `jobs` at a time, each in an isolated sandbox"""
+    semaphore = asyncio.Semaphore(jobs)
+    await asyncio.gather(*(
+        run_case(key, ass_tracker, case, semaphore)
+        for key, case in test_tracker.cases.items()
+    ))
 
 async def cleanup_paths(paths_to_clean):
     """Clean up specified paths in a platform-safe way"""
@@ -660,8 +2290,8 @@ async def cleanup():
     """Clean up test artifacts in a platform-safe way"""
     paths_to_clean = [
         Path("test/zig-out"),
-        Path("test/archives"),
         Path("test/.zig-cache"),
+        HARNESS_CACHE,
         Path("popaman")
     ]
     await cleanup_paths(paths_to_clean)
@@ -669,6 +2299,20 @@ async def cleanup():
 def parse_args():
     parser = argparse.ArgumentParser(description='Test script for Popaman')
     parser.add_argument('--clean', action='store_true', help='Clean up test artifacts')
+    parser.add_argument('--jobs', '-j', type=int, default=1,
+                        help='Run cases concurrently, each in its own temporary popaman root')
+    parser.add_argument('--stress', type=int, default=0, metavar='N',
+                        help='Also race N concurrent installs against removes and globalizes')
+    parser.add_argument('--trace', action='store_true',
+                        help='Collect popaman trace spans and report them per case')
+    parser.add_argument('--rebuild', action='store_true',
+                        help='Rebuild, reinstall and regenerate archives even if their inputs are unchanged')
+    parser.add_argument('--json', type=Path, metavar='PATH',
+                        help='Write the result, duration, cpu time and peak RSS of every step as JSON')
+    parser.add_argument('--junit', type=Path, metavar='PATH',
+                        help='Write the results as JUnit XML')
+    parser.add_argument('--baseline', type=Path, metavar='PATH',
+                        help='Earlier --json results; steps that got much slower or bigger fail the run')
     return parser.parse_args()
 
 async def main():
@@ -680,78 +2324,122 @@ async def main():
         await cleanup()
         return
 
+    if args.trace:
+        os.environ['POPAMAN_TRACE'] = '1'
+    cache = SetupCache(enabled=not args.rebuild)
+    # the serial run shares one popaman root, so its spans cannot be split by case
+    serial_spans = []
+
     print("++ Testing Popaman ++")
     try:
         print("Building test files...")
         try:
-            await build_installer()
+            await build_installer(cache)
         except Exception as e:
             test_tracker.cases['dir'].install = False
             print(f"Error: {e}")
 
         try:
-            await install_popaman(ass_tracker)
+            await install_popaman(ass_tracker, cache)
         except Exception as e:
             test_tracker.cases['dir'].install = False
             print(f"Error: {e}")
 
         try:
-            await build_test_package(ass_tracker)
+            await build_test_package(ass_tracker, cache)
         except Exception as e:
             test_tracker.cases['dir'].install = False
             print(f"Error: {e}")
 
         print("Creating test archives...")
         try:
-            await create_test_archives(ass_tracker)
+            await create_test_archives(ass_tracker, cache)
         except Exception as e:
             test_tracker.cases['dir'].install = False
             print(f"Error: {e}")
     
-        print("Testing installation...")
-        try:
-            await test_installation(ass_tracker,test_tracker)
-        except Exception as e:
-            test_tracker.cases['dir'].install = False
-            print(f"Error: {e}")
+        if args.jobs > 1:
+            print(f"Testing cases in parallel ({args.jobs} jobs)...")
+            start = time.perf_counter()
+            await test_parallel(ass_tracker, test_tracker, args.jobs)
+            print(f"Parallel cases finished in {time.perf_counter() - start:.2f}s")
+        else:
+            print("Testing installation...")
+            trace_token = TRACE_SPANS.set(serial_spans)
+            try:
+                await test_installation(ass_tracker,test_tracker)
+            except Exception as e:
+                test_tracker.cases['dir'].install = False
+                print(f"Error: {e}")
 
-        # Test all package execution
-        try:
-            await test_package_running(ass_tracker)
-            # If we get here, all packages ran successfully
-            for case in test_tracker.cases.values():
-                case.run = True
-        except Exception as e:
-            # If any package fails to run, mark all as failed
-            # (since we can't easily tell which one failed)
-            for case in test_tracker.cases.values():
-                case.run = False
-            print(f"Package execution failed: {e}")
+            # run and remove each case's own packages, so a failure is pinned on its case
+            print("Testing execution and removal...")
+            for key, case in test_tracker.cases.items():
+                if case.install:
+                    await test_lifecycle(ass_tracker, case, CASES[key][0])
+            TRACE_SPANS.reset(trace_token)
 
-        # Test package removal
-        try:
-            await test_package_removal(ass_tracker)
-            # If we get here, all packages were removed successfully
-            for case in test_tracker.cases.values():
-                case.remove = True
-        except Exception as e:
-            # If any package fails to remove, mark all as failed
+        await run_check(test_tracker, 'list_latency', 'List latency', test_list_latency(ass_tracker))
+
+        await run_check(test_tracker, 'exe_discovery', 'Executable discovery', test_exe_discovery(ass_tracker))
+
+        await run_check(test_tracker, 'verify', 'Verify', test_verify(ass_tracker))
+
+        await run_check(test_tracker, 'upgrade', 'Upgrade', test_upgrade(ass_tracker))
+
+        await run_check(test_tracker, 'archive_cache', 'Archive cache', test_archive_cache(ass_tracker))
+
+        await run_check(test_tracker, 'archive_symlinks', 'Archive symlinks', test_archive_symlinks(ass_tracker))
+
+        await run_check(test_tracker, 'archive_modes', 'Archive modes', test_archive_modes(ass_tracker))
+
+        await run_check(test_tracker, 'dispatch', 'Dispatch', test_dispatch(ass_tracker))
+
+        await run_check(test_tracker, 'startup', 'Startup', test_startup(ass_tracker))
+
+        if args.stress:
+            await run_check(test_tracker, 'registry_stress', 'Registry stress',
+                            test_registry_stress(ass_tracker, args.stress))
+
+        if args.trace:
+            print("\n=== Trace Spans ===")
+            report_spans("All cases (serial)", serial_spans)
             for case in test_tracker.cases.values():
-                case.remove = False
-            print(f"Package removal failed: {e}")
+                report_spans(case.name, case.spans)
 
         # Always show the test report, even if something failed
         test_tracker.report()
+
+        results = test_tracker.to_json(args.jobs)
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump(results, f, indent=2)
+            print(f"\nWrote results to {args.json}")
+        if args.junit:
+            test_tracker.to_junit().write(args.junit, encoding='utf-8', xml_declaration=True)
+            print(f"Wrote JUnit results to {args.junit}")
+        regressions = []
+        if args.baseline:
+            with open(args.baseline) as f:
+                regressions = find_regressions(results, json.load(f))
+            print(f"\n=== Compared to {args.baseline} ===")
+            for regression in regressions:
+                print(f"  REGRESSION {regression}")
+            if not regressions:
+                print("  No regressions")
         
         # Check if any tests failed
         failed_tests = any(
             any(val is False for val in [case.install, case.run, case.remove])
             for case in test_tracker.cases.values()
-        )
+        ) or any(val is False for val in test_tracker.checks.values())
         
         if failed_tests:
             print("\nSome tests failed - check the report above for details")
             sys.exit(1)  # Return failure exit code
+        elif regressions:
+            print("\nSome steps regressed against the baseline - check the report above for details")
+            sys.exit(1)
         else:
             print("\nAll tests completed successfully! 🎉")
             sys.exit(0)  # Return success exit code